@@ -175,6 +175,9 @@ def parse_files():
     # Open DB connection
     db = ConfigurationProvider(con_string)
 
+    # Log records are written by a background thread, so they don't slow down the update. Flushed at exit
+    db.enable_log_writer()
+
     # Ensure only one such process is running, to avoid duplicated records. See issues #25 #20 #19 on GitHub
     if use_interprocess_lock:
         lock_success = try_set_interprocess_lock()
@@ -3,7 +3,6 @@ Adds run_start_time and run_end_time conditions and fills them with run.start_ti
 
 """
 import argparse
-import json
 import os
 import sys
 
@@ -31,12 +30,12 @@ if __name__ == "__main__":
     # get all runs
     runs = db.get_runs(args.run_start, args.run_end)
     for run in runs:
-        rtvs_value = run.get_condition_value("rtvs")
-        if not rtvs_value:
+        rtvs_condition = run.get_condition("rtvs")
+        if not rtvs_condition or not rtvs_condition.value:
             print("Skipping run {} not 'rtvs' condition".format(run.number))
             continue
 
-        rtvs = json.loads(rtvs_value)
+        rtvs = rtvs_condition.parsed_value
         config = rtvs['%(config)']
 
         run_config_file = db.get_file(run, config)
@@ -1,6 +1,7 @@
 from .model import ConditionType
 from .provider import RCDBProvider
 from .provider import ConfigurationProvider
+from .lite_provider import RCDBLiteProvider
 from .errors import *
 
 # This thing separates cells in data blob
@@ -10,7 +11,7 @@ blob_delimiter = "|"
 # we have to encode blob_delimiter to blob_delimiter_replace on data write and decode it bach on data read
 blob_delimiter_replacement = "&delimiter;"
 
-SQL_SCHEMA_VERSION = 2
+SQL_SCHEMA_VERSION = 3
 
 
 class UpdateReasons(object):
@@ -2,6 +2,7 @@ import click
 from rcdb.provider import RCDBProvider
 from rcdb.model import ConditionType, ConfigurationFile
 from rcdb.cli.context import pass_rcdb_context
+from rcdb.app_context import parse_run_range
 from rcdb import ConditionType as CT
 
 # A helper mapping from short strings like 'bool','int','float' -> ConditionType.<XYZ>_FIELD
@@ -16,12 +17,13 @@ TYPE_MAP = {
 }
 
 
-@click.group("add", help="Add data to the RCDB (types, conditions, files).")
+@click.group("add", help="Add data to the RCDB (types, runs, conditions, files).")
 @pass_rcdb_context
 def add_command(context):
     """
     The 'add' group command. See subcommands like:
       rcdb add type - adds Condition Type
+      rcdb add runs - adds runs of a run range
       rcdb add condition - adds Condition to a run
       rcdb add file - adds File and associate it to a run
     """
@@ -54,6 +56,33 @@ def add_type(context, name, value_type, description):
     click.echo("Done.")
 
 
+@add_command.command(name="runs", help="Add runs which are not in the DB yet.")
+@click.argument("run_range", required=True)
+@click.option("--start-time", type=click.DateTime(), default=None,
+              help="Start time of the created runs.")
+@click.option("--end-time", type=click.DateTime(), default=None,
+              help="End time of the created runs.")
+@pass_rcdb_context
+def add_runs(context, run_range, start_time, end_time):
+    """
+    Adds all runs of RUN_RANGE which don't exist in the DB. Existing runs are not changed.
+
+    Example:
+      rcdb add runs 1000-2000
+      rcdb add runs 1000 --start-time "2024-01-01 10:00:00"
+    """
+    run_min, run_max = parse_run_range(run_range)
+    if run_min is None:
+        click.echo(f"ERROR: Can't parse run range '{run_range}'. Use a run number or a range like 1000-2000", err=True)
+        raise click.Abort()
+    if run_max is None:
+        run_max = run_min
+
+    db = context.db
+    created = db.create_runs(range(run_min, run_max + 1), start_time=start_time, end_time=end_time)
+    click.echo(f"Created {len(created)} runs. {run_max - run_min + 1 - len(created)} runs already existed")
+
+
 @add_command.command(name="condition", help="Add or update a condition for a run.")
 @click.argument("run_number", type=int)
 @click.argument("condition_name", type=str)
@@ -1,11 +1,16 @@
+import datetime
+import sys
+import time
+
 import click
 import sqlalchemy
-from sqlalchemy import create_engine, MetaData, Table, desc, select, text
+from sqlalchemy import create_engine, MetaData, Table, desc, select, text, bindparam
 from sqlalchemy.exc import OperationalError
 
 import rcdb
 from rcdb import RCDBProvider
-from rcdb.model import SchemaVersion, Alias, RunPeriod
+from rcdb.model import SchemaVersion, Alias, RunPeriod, Condition, ConfigurationFile, LogRecord
+from rcdb.file_archiver import CONTENT_CODECS, compress_content, decompress_content
 from rcdb.cli.context import pass_rcdb_context
 from rcdb.provider import stamp_schema_version
 
@@ -22,7 +27,7 @@ def db_command(ctx):
         provider = RCDBProvider()
         if not connection_str:
             print("ERROR connection string is missing.")
-            exit(1)
+            sys.exit(1)
         provider.connect(connection_str, check_version=False)
         query = select(SchemaVersion).order_by(SchemaVersion.version.desc())
         schema_version, = provider.session.execute(query).first()
@@ -84,9 +89,274 @@ def _print_sqlite_table_sizes(engine):
         click.echo("\n No table size info: sqlite dbstat extension is not installed. Use sqlite3_analyzer to get table sizes")
 
 
+# 'rcdb db index' times this query before and after creating indexes: values of one condition type for all runs
+_INDEX_BENCHMARK_SQL = "SELECT runs.number, c.int_value, c.float_value FROM runs " \
+                       "LEFT JOIN conditions c ON c.run_number = runs.number AND c.condition_type_id = :type_id " \
+                       "ORDER BY runs.number"
+
+# Condition type used by the benchmark query. The first condition type is used if there is no such type
+_INDEX_BENCHMARK_CONDITION = "event_count"
+
+
+def _find_missing_indexes(engine):
+    """Returns indexes of RCDB model, which are not in DB. An index is considered existing if DB has
+    an index with the same name or on the same columns. For a unique index of the model the DB index
+    (or unique constraint) must be unique too"""
+    inspector = sqlalchemy.inspect(engine)
+    missing = []
+    for table in rcdb.model.Base.metadata.sorted_tables:
+        if not table.indexes or not inspector.has_table(table.name):
+            continue
+        existing = [(index["name"], tuple(index["column_names"]), index["unique"])
+                    for index in inspector.get_indexes(table.name)]
+        existing += [(constraint["name"], tuple(constraint["column_names"]), True)
+                     for constraint in inspector.get_unique_constraints(table.name)]
+        for index in sorted(table.indexes, key=lambda ix: ix.name):
+            columns = tuple(column.name for column in index.columns)
+            if not any((name == index.name or db_columns == columns) and (unique or not index.unique)
+                       for name, db_columns, unique in existing):
+                missing.append(index)
+    return missing
+
+
+def _run_index_benchmark(engine, repeat=3):
+    """Times the benchmark query. Returns the best time in seconds or None if there are no condition types"""
+    with engine.connect() as conn:
+        type_id = conn.execute(text("SELECT id FROM condition_types WHERE name = :name"),
+                               {"name": _INDEX_BENCHMARK_CONDITION}).scalar()
+        if type_id is None:
+            type_id = conn.execute(text("SELECT MIN(id) FROM condition_types")).scalar()
+        if type_id is None:
+            return None
+
+        best_time = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            conn.execute(text(_INDEX_BENCHMARK_SQL), {"type_id": type_id}).fetchall()
+            elapsed = time.perf_counter() - start
+            best_time = elapsed if best_time is None else min(best_time, elapsed)
+        return best_time
+
+
+def _print_index_sizes(engine):
+    """Prints sizes of indexes in MB. Uses innodb_index_stats for MySQL and dbstat for SQLite"""
+    try:
+        with engine.connect() as conn:
+            if engine.dialect.name == "mysql":
+                rows = conn.execute(text("""
+                    SELECT CONCAT(table_name, '.', index_name), stat_value * @@innodb_page_size
+                    FROM mysql.innodb_index_stats
+                    WHERE database_name = :db AND stat_name = 'size'
+                    ORDER BY table_name, index_name
+                """), {"db": engine.url.database}).fetchall()
+            elif engine.dialect.name == "sqlite":
+                rows = conn.execute(text("""
+                    SELECT tbl_name || '.' || name, (SELECT SUM(pgsize) FROM dbstat WHERE dbstat.name = m.name)
+                    FROM sqlite_master m
+                    WHERE type = 'index'
+                    ORDER BY tbl_name, name
+                """)).fetchall()
+            else:
+                click.echo("Index size info: not supported for this database dialect")
+                return
+    except Exception as ex:
+        click.echo("No index size info: {}".format(ex))
+        return
+
+    click.echo("\nIndex sizes in MB:")
+    for index_name, size_bytes in rows:
+        click.echo(f"  {index_name:50} {round((size_bytes or 0) / 1024 / 1024, 2)} MB")
+
+
+@db_command.command()
+@click.option('--check', is_flag=True, help="Only report missing indexes, don't create them")
+@click.option('--no-benchmark', is_flag=True, help="Don't time the benchmark query before and after")
+@pass_rcdb_context
+def index(context, check, no_benchmark):
+    """Creates missing indexes for hot queries and reports index sizes.
+
+    Conditions are indexed by (condition_type_id, run_number, value), files by (sha256, path)
+    and logs by (related_run, id). New databases get these indexes at creation.
+    """
+    provider = RCDBProvider(context.connection_str, check_version=False)
+    engine = provider.engine
+
+    missing = _find_missing_indexes(engine)
+    if not missing:
+        click.echo("All RCDB indexes exist")
+    for idx in missing:
+        columns = ", ".join(column.name for column in idx.columns)
+        click.echo(f"Missing index {idx.name} ON {idx.table.name} ({columns})")
+
+    # Unique keys can't be created while there are duplicates. 'rcdb db unique-conditions' removes them first
+    unique_missing = [idx for idx in missing if idx.unique]
+    missing = [idx for idx in missing if not idx.unique]
+    for idx in unique_missing:
+        click.echo(f"Unique index {idx.name} is not created. Use 'rcdb db unique-conditions' to create it")
+
+    if missing and not check:
+        time_before = None if no_benchmark else _run_index_benchmark(engine)
+        for idx in missing:
+            click.echo(f"Creating index {idx.name} ...")
+            idx.create(engine)
+        if time_before is not None:
+            time_after = _run_index_benchmark(engine)
+            click.echo(f"Benchmark query: {time_before * 1000:.1f} ms before, {time_after * 1000:.1f} ms after")
+    elif not no_benchmark:
+        benchmark_time = _run_index_benchmark(engine)
+        if benchmark_time is not None:
+            click.echo(f"Benchmark query: {benchmark_time * 1000:.1f} ms")
+
+    _print_index_sizes(engine)
+    if check and (missing or unique_missing):
+        sys.exit(1)
+
+
+# Duplicated values: conditions of the same type and run besides the first added one (with the smallest id)
+_DUPLICATE_CONDITIONS_SQL = """
+    SELECT c.id, c.run_number, ct.name
+    FROM conditions c
+    JOIN (SELECT run_number, condition_type_id, MIN(id) AS keep_id
+          FROM conditions
+          GROUP BY run_number, condition_type_id
+          HAVING COUNT(*) > 1) d
+      ON c.run_number = d.run_number AND c.condition_type_id = d.condition_type_id AND c.id <> d.keep_id
+    JOIN condition_types ct ON ct.id = c.condition_type_id
+    ORDER BY c.run_number, ct.name, c.id
+"""
+
+
+@db_command.command(name="unique-conditions")
+@click.option('--confirm', is_flag=True, help='For CI automation and tests')
+@pass_rcdb_context
+def unique_conditions(context, confirm):
+    """Removes duplicated condition values and adds unique (run_number, condition_type_id) key.
+
+    Of duplicated values of a condition for a run the first added one is kept.
+    With the key add_conditions(..., replace=True) replaces values by one upsert statement.
+    """
+    provider = RCDBProvider(context.connection_str, check_version=False)
+    engine = provider.engine
+
+    unique_index = next(idx for idx in Condition.__table__.indexes if idx.unique)
+    if unique_index not in _find_missing_indexes(engine):
+        click.echo("Conditions already have a unique key")
+        return
+
+    with engine.connect() as conn:
+        duplicates = conn.execute(text(_DUPLICATE_CONDITIONS_SQL)).fetchall()
+
+    click.echo("This command removes duplicated condition values and adds a unique key to conditions table")
+    click.echo("DB: {}".format(context.connection_str))
+    click.echo("Duplicated values to remove: {}".format(len(duplicates)))
+    for condition_id, run_number, name in duplicates[:20]:
+        click.echo("   run={:<8} {:<30} id={}".format(run_number, name, condition_id))
+    if len(duplicates) > 20:
+        click.echo("   ...")
+
+    if not confirm and not click.confirm('Do you really want to continue?'):
+        return
+
+    ids = [row[0] for row in duplicates]
+    _make_conditions_unique(engine, unique_index, ids)
+    click.echo("Removed {} duplicated values. Created unique index {}".format(len(ids), unique_index.name))
+
+
+def _make_conditions_unique(engine, unique_index, ids):
+    """Removes duplicated condition values by ids and creates the unique key in one transaction
+
+    :param engine: SQLAlchemy engine
+    :param unique_index: unique (run_number, condition_type_id) index of the model
+    :param ids: ids of duplicated values to remove
+    """
+    # A not unique index with the same name is replaced
+    index_names = {index["name"] for index in sqlalchemy.inspect(engine).get_indexes(Condition.__tablename__)}
+
+    with engine.begin() as conn:
+        for i in range(0, len(ids), 1000):
+            conn.execute(text("DELETE FROM conditions WHERE id IN :ids")
+                         .bindparams(bindparam("ids", expanding=True)), {"ids": ids[i:i + 1000]})
+        if unique_index.name in index_names:
+            unique_index.drop(conn)
+        unique_index.create(conn)
+        # Deletes don't change MAX() values of the select_values result cache watermark, a log record does
+        conn.execute(LogRecord.__table__.insert(),
+                     {"table_ids": "conditions", "created": datetime.datetime.now(),
+                      "description": "Removed {} duplicated condition values, added unique key".format(len(ids))})
+
+
+@db_command.command(name="compress-files")
+@click.option('--codec', type=click.Choice(list(CONTENT_CODECS) + ["none"]), required=True,
+              help="Compression codec. 'none' decompresses files back to plain text. "
+                   "C++ and Java RCDB readers can't read compressed files")
+@click.option('--batch-size', default=100, show_default=True, help="Number of files read and updated at once")
+@click.option('--confirm', is_flag=True, help='For CI automation and tests')
+@pass_rcdb_context
+def compress_files(context, codec, batch_size, confirm):
+    """Compresses content of stored configuration files and reports space saved.
+
+    Files are read and updated by batches, each batch in its own transaction, so the command
+    can be stopped and run again. Compressed files are read transparently by python RCDB of this
+    version or newer. C++ and Java RCDB providers and older python clients get compressed content
+    as is ("\\x01<codec>:" + base64), so don't compress files of DBs they read. Use --codec=none to revert.
+    """
+    provider = RCDBProvider(context.connection_str, check_version=False)
+    engine = provider.engine
+    codec = None if codec == "none" else codec
+    files = ConfigurationFile.__table__
+
+    click.echo("This command {} content of configuration files".format("compresses" if codec else "decompresses"))
+    click.echo("DB: {}".format(context.connection_str))
+    if codec:
+        click.echo("WARNING: C++ and Java RCDB providers and older python clients can't read compressed files")
+    if not confirm and not click.confirm('Do you really want to continue?'):
+        return
+
+    last_id = 0
+    file_count = changed_count = bytes_before = bytes_after = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(select(files.c.id, files.c.content)
+                                .where(files.c.id > last_id)
+                                .order_by(files.c.id)
+                                .limit(batch_size)).fetchall()
+            if not rows:
+                break
+            updates = []
+            for file_id, stored in rows:
+                new_stored = compress_content(decompress_content(stored), codec)
+                bytes_before += len(stored.encode('utf-8'))
+                bytes_after += len(new_stored.encode('utf-8'))
+                if new_stored != stored:
+                    updates.append({"file_id": file_id, "new_content": new_stored})
+            if updates:
+                conn.execute(files.update().where(files.c.id == bindparam("file_id"))
+                             .values(content=bindparam("new_content")), updates)
+            file_count += len(rows)
+            changed_count += len(updates)
+            last_id = rows[-1][0]
+        click.echo(f"Processed {file_count} files")
+
+    saved = bytes_before - bytes_after
+    ratio = float(bytes_before) / bytes_after if bytes_after else 1.0
+    click.echo(f"Updated {changed_count} of {file_count} files. "
+               f"Content size: {bytes_before / 1024 / 1024:.2f} MB before, {bytes_after / 1024 / 1024:.2f} MB after. "
+               f"Saved {saved / 1024 / 1024:.2f} MB ({ratio:.1f}x)")
+    if engine.dialect.name == "sqlite" and saved > 0:
+        click.echo("SQLite doesn't shrink the DB file by itself. Run VACUUM to reclaim the space")
+    elif engine.dialect.name == "mysql" and saved > 0:
+        click.echo("Run 'OPTIMIZE TABLE files' to reclaim the space in MySQL")
+
+
 @db_command.command()
+@click.option('--confirm', is_flag=True, help='For CI automation and tests')
 @pass_rcdb_context
-def update(context):
+def update(context, confirm):
+    """Updates RCDB schema in DB to the current version: v1 --> v2 --> v3.
+
+    v3 removes duplicated condition values (the first added one is kept), adds unique
+    (run_number, condition_type_id) key and indexes for hot queries. The same as sql/update_db_v2_to_v3.sql
+    """
     provider = RCDBProvider(context.connection_str, check_version=False)
 
     # Check something exists
@@ -98,12 +368,14 @@ def update(context):
         # Check schema version
         current_version = provider.get_schema_version()
 
-    if current_version != 1:
-        print(f"Can't update schema version. Current version is: {current_version.version}. This command can update:")
-        print(f"   DB v1 --> v2")
+    if current_version not in (1, 2):
+        print(f"Can't update schema version. Current version is: {current_version}. This command can update:")
+        print(f"   DB v1 --> v2 --> v3")
         return
+    elif current_version == 1:
+        print("Found DB v1. Will do v1 --> v2 --> v3 update")
     else:
-        print("Found DB v1. Will do v1 --> v2 update")
+        print("Found DB v2. Will do v2 --> v3 update")
 
     # PRINTOUT PART
     print("This command changes RCDB schema in DB")
@@ -113,13 +385,25 @@ def update(context):
     print("\nDB: {}\n".format(context.connection_str))
 
     # Double check user knows what will happen
-    if not click.confirm('Do you really want to continue?'):
+    if not confirm and not click.confirm('Do you really want to continue?'):
         return
 
     # That we will need for DB
     metadata = rcdb.model.Base.metadata
     provider = RCDBProvider(context.connection_str, check_version=False)
 
+    if current_version == 1:
+        _update_v1_to_v2(provider)
+    _update_v2_to_v3(provider)
+
+    # Set correct version
+    version = stamp_schema_version(provider)
+    print("Stamped schema version: {} - '{}'".format(version.version, version.comment))
+
+
+def _update_v1_to_v2(provider):
+    """Adds aliases and run periods tables, drops tables of old DAQ configuration"""
+
     # Create alias table
     Alias.__table__.create(provider.engine)
 
@@ -152,9 +436,24 @@ def update(context):
                 print(f"Dropping table '{t}'")
                 conn.execute(sqlalchemy.text(f"DROP TABLE {t}"))
 
-    # Set correct version
-    version = stamp_schema_version(provider)
-    print("Stamped schema version: {} - '{}'".format(version.version, version.comment))
+
+def _update_v2_to_v3(provider):
+    """Removes duplicated condition values, creates the unique conditions key and indexes for hot queries"""
+    engine = provider.engine
+    missing = _find_missing_indexes(engine)
+
+    unique_index = next(idx for idx in Condition.__table__.indexes if idx.unique)
+    if unique_index in missing:
+        with engine.connect() as conn:
+            ids = [row[0] for row in conn.execute(text(_DUPLICATE_CONDITIONS_SQL))]
+        _make_conditions_unique(engine, unique_index, ids)
+        click.echo("Removed {} duplicated condition values. Created unique index {}"
+                   .format(len(ids), unique_index.name))
+
+    for idx in missing:
+        if idx is not unique_index:
+            click.echo(f"Creating index {idx.name} ...")
+            idx.create(engine)
 
 
 @db_command.command()
@@ -60,7 +60,8 @@ def select_command(rcdb_context, query, views_or_runs, is_dump_view, is_descendi
 
     conditions_to_show = view.split()
 
-    values = rcdb_context.db.select_values([], query, run_min, run_max)
+    # Rows are streamed from DB, so the dump of all runs doesn't hold the whole table in memory
+    values = rcdb_context.db.iter_values(conditions_to_show, query, run_min, run_max, sort_desc=is_descending)
 
     if not is_dump_view:
 
@@ -0,0 +1,163 @@
+"""
+Columnar storage of selection results
+
+A selection result of many runs stored as a list of lists keeps a boxed python object per cell.
+ColumnarTable keeps one typed NumPy array per selected column plus a null mask instead:
+int and float conditions take 8 bytes per cell, bool conditions 1 byte. Text, json, blob and time
+conditions are kept in object arrays as they are.
+
+Arrays are given to NumPy (masked arrays), pandas (nullable extension arrays) and Arrow without copying
+the values where these libraries allow it.
+
+NumPy is required for ColumnarTable. pandas and pyarrow are needed only for to_pandas() and to_arrow().
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from rcdb.model import ConditionType
+
+
+def is_available():
+    """True if NumPy is installed"""
+    return numpy is not None
+
+
+class ColumnarTable(object):
+    """Table of values stored by columns: typed array and null mask (True where value is None) per column"""
+
+    def __init__(self, names, columns, nulls, count):
+        """
+        :param names: column names
+        :type names: list[str]
+        :param columns: NumPy array of values per column. Values where null is True are not meaningful
+        :param nulls: NumPy bool array per column. True where value is None
+        :param count: number of rows. A table without columns still has rows
+        :type count: int
+        """
+        self.names = list(names)
+        self.columns = list(columns)
+        self.nulls = list(nulls)
+        self._count = count
+
+    @classmethod
+    def from_rows(cls, rows, names, value_types, indexes=None):
+        """Creates a table from rows
+
+        :param rows: sequence of rows. Rows may have more values than columns selected by indexes
+        :param names: column names
+        :param value_types: ConditionType.xxx_FIELD of each column. Defines array dtype
+        :param indexes: index of each column value in a row. By default columns go in order of rows values
+        :rtype: ColumnarTable
+        """
+        if numpy is None:
+            raise ImportError("NumPy is required for columnar selection results")
+
+        if not isinstance(rows, list):
+            rows = list(rows)
+        if indexes is None:
+            indexes = range(len(names))
+
+        columns = []
+        nulls = []
+        for index, value_type in zip(indexes, value_types):
+            values, null = _make_column([row[index] for row in rows], value_type)
+            columns.append(values)
+            nulls.append(null)
+        return cls(names, columns, nulls, len(rows))
+
+    def __len__(self):
+        return self._count
+
+    def copy(self):
+        """Returns a table with copies of the arrays"""
+        return ColumnarTable(self.names, [values.copy() for values in self.columns],
+                             [null.copy() for null in self.nulls], self._count)
+
+    def row(self, index):
+        """Returns row as a list of python values (None for nulls)"""
+        return [None if null[index] else values[index].item() if values.dtype != object else values[index]
+                for values, null in zip(self.columns, self.nulls)]
+
+    def iter_rows(self):
+        """Yields rows as lists of python values (None for nulls)"""
+        lists = []
+        for values, null in zip(self.columns, self.nulls):
+            column = values.tolist()
+            if null.any():
+                for index in numpy.flatnonzero(null).tolist():
+                    column[index] = None
+            lists.append(column)
+        if not lists:
+            for _ in range(self._count):
+                yield []
+            return
+        for row in zip(*lists):
+            yield list(row)
+
+    def to_numpy(self):
+        """Columns as NumPy masked arrays. Values and masks are not copied
+
+        :return: {column name: numpy.ma.MaskedArray}
+        :rtype: dict
+        """
+        return {name: numpy.ma.MaskedArray(values, mask=null, copy=False)
+                for name, values, null in zip(self.names, self.columns, self.nulls)}
+
+    def to_pandas(self):
+        """Table as pandas DataFrame. int, float and bool columns become nullable pandas arrays
+        over the same NumPy buffers
+
+        :rtype: pandas.DataFrame
+        """
+        import pandas
+
+        data = {}
+        for name, values, null in zip(self.names, self.columns, self.nulls):
+            if values.dtype.kind == 'i':
+                data[name] = pandas.arrays.IntegerArray(values, null)
+            elif values.dtype.kind == 'f':
+                data[name] = pandas.arrays.FloatingArray(values, null)
+            elif values.dtype.kind == 'b':
+                data[name] = pandas.arrays.BooleanArray(values, null)
+            else:
+                data[name] = values
+        return pandas.DataFrame(data, index=pandas.RangeIndex(self._count), copy=False)
+
+    def to_arrow(self):
+        """Table as pyarrow.Table. int and float values are not copied, null masks are packed to Arrow bitmaps
+
+        :rtype: pyarrow.Table
+        """
+        import pyarrow
+
+        arrays = []
+        for values, null in zip(self.columns, self.nulls):
+            mask = null if null.any() else None
+            arrays.append(pyarrow.array(values, mask=mask))
+        return pyarrow.Table.from_arrays(arrays, names=self.names)
+
+
+def _make_column(column, value_type):
+    """Converts list of python values to (values array, null mask)"""
+    count = len(column)
+    null = numpy.fromiter((value is None for value in column), dtype=bool, count=count)
+
+    try:
+        if value_type == ConditionType.FLOAT_FIELD:
+            return numpy.fromiter((0.0 if value is None else value for value in column),
+                                  dtype=numpy.float64, count=count), null
+        if value_type == ConditionType.INT_FIELD:
+            return numpy.fromiter((0 if value is None else value for value in column),
+                                  dtype=numpy.int64, count=count), null
+        if value_type == ConditionType.BOOL_FIELD:
+            return numpy.fromiter((False if value is None else value for value in column),
+                                  dtype=bool, count=count), null
+    except (ValueError, TypeError, OverflowError):
+        pass    # e.g. int values that don't fit to int64. Such columns are stored as objects
+
+    values = numpy.empty(count, dtype=object)
+    values[:] = column
+    return values, null
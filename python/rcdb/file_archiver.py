@@ -1,5 +1,17 @@
 import hashlib
 import base64
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Compressed content is stored in files.content (TEXT) as: marker + base64 of compressed UTF-8 bytes.
+# Text files never start with \x01, so content without a marker is plain text as it always was
+CONTENT_CODECS = ("zlib", "zstd")
+_CODEC_MARKERS = {codec: "\x01" + codec + ":" for codec in CONTENT_CODECS}
 
 
 def get_file_hash(afile, hasher, block_size=65536):
@@ -21,8 +33,28 @@ def get_file_sha256(fname):
         return base64.b64encode(get_file_hash(afile, hashlib.sha256()))
 
 
+def read_file_with_sha256(fname, block_size=65536):
+    """Reads text file and gets base64 encoded sha256 hash of its bytes in one pass
+
+    The content is decoded from UTF-8 as is (line endings are not translated), so
+    get_string_sha256 of the content gives the same hash
+
+    :return: (content, base64 encoded sha256)
+    :rtype: (str, bytes)
+    """
+    hasher = hashlib.sha256()
+    blocks = []
+    with open(fname, 'rb') as afile:
+        buf = afile.read(block_size)
+        while len(buf) > 0:
+            hasher.update(buf)
+            blocks.append(buf)
+            buf = afile.read(block_size)
+    return b''.join(blocks).decode('utf-8'), base64.b64encode(hasher.digest())
+
+
 def get_string_sha256(str_to_convert):
-    """Returns base64 encoded sha256 of the string converting it to byte array
+    """Returns base64 encoded sha256 of the string converting it to UTF-8 byte array
 
     The function is done so, that if you encode text file by get_file_sha256
     and contents of the file with this function you'll get the same results
@@ -31,5 +63,62 @@ def get_string_sha256(str_to_convert):
     :return:
     """
     hasher = hashlib.sha256()
-    hasher.update(bytearray(str_to_convert.encode('ascii')))
-    return base64.b64encode(hasher.digest())
\ No newline at end of file
+    hasher.update(str_to_convert.encode('utf-8'))
+    return base64.b64encode(hasher.digest())
+
+def get_content_codec(stored):
+    """Returns codec name ('zlib', 'zstd') of stored content or None if it is plain text"""
+    if stored and stored[0] == "\x01":
+        for codec, marker in _CODEC_MARKERS.items():
+            if stored.startswith(marker):
+                return codec
+    return None
+
+
+def compress_content(content, codec="zlib", level=9):
+    """Compresses file content to be stored in files.content
+
+    Content is left as is if codec is None or the compressed form is not shorter
+
+    :param content: text content of a file
+    :type content: str
+    :param codec: 'zlib', 'zstd' (needs zstandard package) or None
+    :param level: compression level
+    :return: content to store
+    :rtype: str
+    """
+    if codec is None or not content:
+        return content
+    if codec not in _CODEC_MARKERS:
+        raise ValueError("Unknown content codec '{}'. Known codecs: {}".format(codec, ", ".join(CONTENT_CODECS)))
+
+    data = content.encode('utf-8')
+    if codec == "zlib":
+        compressed = zlib.compress(data, level)
+    else:
+        if zstandard is None:
+            raise ImportError("'zstd' codec requires zstandard package. Install it with: pip install zstandard")
+        compressed = zstandard.ZstdCompressor(level=level).compress(data)
+
+    stored = _CODEC_MARKERS[codec] + base64.b64encode(compressed).decode('ascii')
+    return stored if len(stored) < len(content) else content
+
+
+def decompress_content(stored):
+    """Returns text content of a file from files.content, which may be compressed by compress_content
+
+    :param stored: value of files.content
+    :type stored: str
+    :rtype: str
+    """
+    codec = get_content_codec(stored)
+    if codec is None:
+        return stored
+
+    compressed = base64.b64decode(stored[len(_CODEC_MARKERS[codec]):])
+    if codec == "zlib":
+        return zlib.decompress(compressed).decode('utf-8')
+    if zstandard is None:
+        raise ImportError("File content is compressed by 'zstd'. "
+                          "Reading it requires zstandard package. Install it with: pip install zstandard")
+    return zstandard.ZstdDecompressor().decompress(compressed).decode('utf-8')
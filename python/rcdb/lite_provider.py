@@ -0,0 +1,288 @@
+"""
+Read-only RCDB provider without SQLAlchemy ORM
+
+RCDBProvider loads Run, Condition and ConditionType as ORM objects. Each of them is instrumented
+and tracked by the session identity map, which is pure cost for farm jobs that only read.
+RCDBLiteProvider has the same read API (get_run, get_runs, get_run_snapshots, get_condition,
+get_condition_types, select_values), runs SQLAlchemy Core queries and returns lightweight records with __slots__.
+It writes nothing to DB.
+
+Example:
+    db = RCDBLiteProvider("mysql://rcdb@hallddb.jlab.org/rcdb2")
+    for run_number, event_count in db.select_values(['event_count'], "@is_production", 30000, 31000):
+        print(run_number, event_count)
+
+select_values shares query preparation with RCDBProvider through rcdb.provider._SearchQueryMixin
+(aliases, pushdown to SQL, the evaluator) and returns rows as lists.
+"""
+
+import sys
+
+from sqlalchemy import create_engine, select, func
+
+import rcdb
+from rcdb.alias import default_aliases
+from rcdb.errors import NoConditionTypeFound, SqlSchemaVersionError
+from rcdb.model import Run, Condition, ConditionType, SchemaVersion, value_field_names
+from rcdb.provider import QUERY_CACHE_SIZE, RUNS_BIND_CHUNK_SIZE, _SearchQueryMixin, _fetch_run_snapshots
+from rcdb.query_cache import LruCache
+
+_runs = Run.__table__
+_conditions = Condition.__table__
+_condition_types = ConditionType.__table__
+
+
+class RunRecord(object):
+    """Run as a plain record"""
+    __slots__ = ('number', 'start_time', 'end_time')
+
+    def __init__(self, number, start_time, end_time):
+        self.number = number
+        self.start_time = start_time
+        self.end_time = end_time
+
+    def __repr__(self):
+        return "<RunRecord number='{}'>".format(self.number)
+
+
+class ConditionTypeRecord(object):
+    """Condition type as a plain record"""
+    __slots__ = ('id', 'name', 'value_type', 'created', 'description')
+
+    def __init__(self, id, name, value_type, created, description):
+        self.id = id
+        self.name = name
+        self.value_type = value_type
+        self.created = created
+        self.description = description
+
+    def get_value_field_name(self):
+        """Name of conditions table column with values of this type"""
+        return value_field_names.get(self.value_type)
+
+    def __repr__(self):
+        return "<ConditionTypeRecord id='{}', name='{}', value_type={}>".format(self.id, self.name, self.value_type)
+
+
+class ConditionRecord(object):
+    """Condition value as a plain record"""
+    __slots__ = ('id', 'run_number', 'type', 'value', 'created')
+
+    def __init__(self, id, run_number, condition_type, value, created):
+        self.id = id
+        self.run_number = run_number
+        self.type = condition_type
+        """:type: ConditionTypeRecord"""
+        self.value = value
+        self.created = created
+
+    @property
+    def name(self):
+        return self.type.name
+
+    @property
+    def value_type(self):
+        return self.type.value_type
+
+    def __repr__(self):
+        return "<ConditionRecord id='{}', run_number='{}', value={}>".format(self.id, self.run_number, self.value)
+
+
+class RCDBLiteProvider(_SearchQueryMixin):
+    """Read-only RCDB provider, that doesn't use SQLAlchemy ORM. See module description"""
+
+    def __init__(self, connection_string=None, check_version=True):
+        """
+        :param connection_string: SQLAlchemy connection string
+        :param check_version: check that DB schema version matches rcdb.SQL_SCHEMA_VERSION
+        """
+        self.engine = None
+        self.aliases = default_aliases
+        self._cnd_types_cache = None
+        self._cnd_types_by_name = None
+        self._cnd_types_version = 0
+        self._query_cache = LruCache(QUERY_CACHE_SIZE)
+        if connection_string:
+            self.connect(connection_string, check_version)
+
+    def connect(self, connection_string, check_version=True):
+        """Connects to DB
+
+        :param connection_string: SQLAlchemy connection string
+        :param check_version: check that DB schema version matches rcdb.SQL_SCHEMA_VERSION
+        """
+        if not connection_string:
+            raise ValueError("Connection string is whitespace or empty. Provide proper connection string for DB")
+
+        try:
+            self.engine = create_engine(connection_string)
+        except ImportError as err:
+            # The same fall back to pymysql as in RCDBProvider.connect
+            if connection_string.startswith("mysql://") and "No module named" in str(err) and 'MySQLdb' in str(err):
+                self.engine = create_engine(connection_string.replace("mysql://", "mysql+pymysql://"))
+            else:
+                raise
+        self._cnd_types_cache = None
+        self._cnd_types_by_name = None
+        self._cnd_types_version += 1
+        self._query_cache.clear()
+
+        if check_version:
+            db_version = self.get_schema_version()
+            if db_version != rcdb.SQL_SCHEMA_VERSION:
+                message = "SQL schema version doesn't match. " \
+                          "Retrieved DB version is {0}, required version is {1}" \
+                    .format(db_version, rcdb.SQL_SCHEMA_VERSION)
+                raise SqlSchemaVersionError(message)
+
+    def disconnect(self):
+        """Closes all DB connections"""
+        if self.engine is not None:
+            self.engine.dispose()
+            self.engine = None
+
+    def get_schema_version(self):
+        """Version of SQL schema in DB"""
+        with self.engine.connect() as connection:
+            return connection.execute(select(func.max(SchemaVersion.__table__.c.version))).scalar()
+
+    # ------------------------------------------------
+    # Runs
+    # ------------------------------------------------
+    def get_run(self, run_number):
+        """Gets run by number
+
+        :param run_number: the run number
+        :type run_number: int
+        :return: run or None if there is no such run in DB
+        :rtype: RunRecord or None
+        """
+        query = select(_runs.c.number, _runs.c.started, _runs.c.finished).where(_runs.c.number == int(run_number))
+        with self.engine.connect() as connection:
+            row = connection.execute(query).first()
+        return RunRecord(*row) if row is not None else None
+
+    def get_runs(self, run_min, run_max, sort_desc=False):
+        """Gets all runs with run_min <= run.number <= run_max
+
+        :param sort_desc: If True result runs will be sorted by descending run number
+        :rtype: list[RunRecord]
+        """
+        query = select(_runs.c.number, _runs.c.started, _runs.c.finished) \
+            .where(_runs.c.number >= run_min, _runs.c.number <= run_max) \
+            .order_by(_runs.c.number.desc() if sort_desc else _runs.c.number)
+        with self.engine.connect() as connection:
+            return [RunRecord(*row) for row in connection.execute(query)]
+
+    def get_run_snapshots(self, run_min, run_max, condition_names, sort_desc=False):
+        """Gets runs with values of the given conditions by two queries. See RCDBProvider.get_run_snapshots
+
+        :rtype: list[rcdb.provider.RunSnapshot]
+        """
+        condition_types = [self.get_condition_type(name) for name in condition_names]
+        with self.engine.connect() as connection:
+            return _fetch_run_snapshots(connection, condition_types, run_min, run_max, sort_desc)
+
+    # ------------------------------------------------
+    # Condition types
+    # ------------------------------------------------
+    def get_condition_types(self):
+        """Gets all condition types. They are read from DB once and cached
+
+        :rtype: list[ConditionTypeRecord]
+        """
+        if self._cnd_types_cache is None:
+            query = select(_condition_types.c.id, _condition_types.c.name, _condition_types.c.value_type,
+                           _condition_types.c.created, _condition_types.c.description)
+            with self.engine.connect() as connection:
+                self._cnd_types_cache = [ConditionTypeRecord(*row) for row in connection.execute(query)]
+        return self._cnd_types_cache
+
+    def get_condition_types_by_name(self):
+        """Gets all condition types as {name: ConditionTypeRecord}"""
+        if self._cnd_types_by_name is None:
+            self._cnd_types_by_name = {ct.name: ct for ct in self.get_condition_types()}
+        return self._cnd_types_by_name
+
+    def get_condition_type(self, name):
+        """Gets condition type by name. Raises NoConditionTypeFound if there is no such type
+
+        :rtype: ConditionTypeRecord
+        """
+        try:
+            return self.get_condition_types_by_name()[name]
+        except KeyError:
+            raise NoConditionTypeFound("No ConditionType with name='{}' is found in DB".format(name))
+
+    # ------------------------------------------------
+    # Conditions
+    # ------------------------------------------------
+    def get_condition(self, run_number, key):
+        """Returns condition value of the run
+
+        :param run_number: the run number
+        :type run_number: int or RunRecord
+        :param key: Condition name or ConditionTypeRecord
+        :return: Condition or None if there is no such condition for the run
+        :rtype: ConditionRecord or None
+        """
+        if isinstance(run_number, RunRecord):
+            run_number = run_number.number
+        ct = key if isinstance(key, ConditionTypeRecord) else self.get_condition_type(key)
+
+        field = _conditions.c[ct.get_value_field_name() or 'text_value']
+        query = select(_conditions.c.id, field, _conditions.c.created) \
+            .where(_conditions.c.condition_type_id == ct.id, _conditions.c.run_number == int(run_number)) \
+            .order_by(_conditions.c.id) \
+            .limit(1)
+        with self.engine.connect() as connection:
+            row = connection.execute(query).first()
+        if row is None:
+            return None
+        condition_id, value, created = row
+        return ConditionRecord(condition_id, int(run_number), ct, value, created)
+
+    # ------------------------------------------------
+    # Select values
+    # ------------------------------------------------
+    def select_values(self, val_names=None, search_str="", run_min=0, run_max=sys.maxsize, sort_desc=False,
+                      insert_run_number=True, runs=None, vectorize=None):
+        """Searches runs by query and returns values of conditions. Same as RCDBProvider.select_values,
+        but returns a plain list of rows
+
+        :param val_names: list of conditions names to select
+        :param search_str: Search pattern
+        :param run_min: minimum run to search
+        :param run_max: maximum run to search
+        :param sort_desc: if True result runs will by sorted descendant by run_number, ascendant if False
+        :param insert_run_number: If True the first column of the result will be a run number
+        :param runs: May be a list of runs to search from. In this case run_min and run_max are not used
+        :param vectorize: see RCDBProvider.select_values
+        :return: rows of selected values
+        :rtype: list[list]
+        """
+        if run_min > run_max:
+            run_min, run_max = run_max, run_min
+        val_names = list(val_names) if val_names else []
+
+        _, plan, _ = self._get_select_values_plan(val_names, search_str)
+        if runs:
+            runs = sorted({run.number if isinstance(run, RunRecord) else int(run) for run in runs}, reverse=sort_desc)
+        join_strategy = self._choose_join_strategy(plan, runs, run_min, run_max)
+        params = dict(plan.get_pushdown(join_strategy).params)
+
+        with self.engine.connect() as connection:
+            if not runs:
+                sql = plan.get_statement(join_strategy, "range", sort_desc)
+                rows = connection.execute(sql, dict(params, run_min=run_min, run_max=run_max)).fetchall()
+            else:
+                sql = plan.get_statement(join_strategy, "bind", sort_desc)
+                rows = []
+                for i in range(0, len(runs), RUNS_BIND_CHUNK_SIZE):
+                    rows.extend(connection.execute(sql, dict(params, runs=runs[i:i + RUNS_BIND_CHUNK_SIZE])))
+
+        if plan.pushdown.python_node is not None:
+            rows, _ = self._evaluate_rows(plan, rows, vectorize, search_str)
+
+        value_indexes = [0] + plan.val_indexes if insert_run_number else plan.val_indexes
+        return [[values[i] for i in value_indexes] for values in rows]
@@ -0,0 +1,129 @@
+"""
+Buffered writer of log records
+
+RCDBProvider.add_log_record writes an audit record and commits it. DAQ update scripts add several records
+per run, so the records are a noticeable part of the time of a run start update. LogRecordWriter takes them
+off this path: records are put to a bounded in-memory queue and a background thread writes them to DB
+by batches. In synchronous mode there is no thread: records are written by the caller when flush() is called
+(RCDBProvider does it after each record or at the end of a batch).
+
+See RCDBProvider.enable_log_writer
+"""
+
+import atexit
+import logging
+import queue
+import threading
+
+log = logging.getLogger("rcdb.log_writer")
+
+# Stops the background thread
+_STOP = object()
+
+
+class LogRecordWriter(object):
+    """Queues log records (as dicts of logs table columns) and writes them by batches"""
+
+    def __init__(self, write_func, synchronous=False, max_queue_size=10000, batch_size=100, put_timeout=1.0):
+        """
+        :param write_func: function(list of row dicts), that writes rows to logs table and commits.
+                           Its errors are only logged, so on error it should roll back what it started
+        :param synchronous: If True, there is no background thread and rows are written on flush()
+        :type synchronous: bool
+        :param max_queue_size: Maximum number of rows waiting to be written
+        :type max_queue_size: int
+        :param batch_size: Maximum number of rows written at once
+        :type batch_size: int
+        :param put_timeout: How long put() waits for a place in a full queue before writing the row itself
+        :type put_timeout: float
+        """
+        self.write_func = write_func
+        self.synchronous = synchronous
+        self.batch_size = batch_size
+        self.put_timeout = put_timeout
+        self.written_count = 0
+        self.error_count = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._buffer = []       # synchronous mode
+        self._queue = None      # background mode
+        if not synchronous:
+            self._queue = queue.Queue(maxsize=max_queue_size)
+            self._thread = threading.Thread(target=self._run, name="rcdb-log-writer", daemon=True)
+            self._thread.start()
+        atexit.register(self.close)
+
+    def put(self, row):
+        """Adds a row to be written
+
+        :param row: {column name: value} of logs table
+        :type row: dict
+        """
+        if self.synchronous:
+            self._buffer.append(row)
+            return
+
+        try:
+            self._queue.put(row, timeout=self.put_timeout)
+        except queue.Full:
+            log.warning("Log records queue is full. Writing the record synchronously")
+            self._write([row])
+
+    def flush(self):
+        """Writes all queued rows. In background mode waits while the thread writes them"""
+        if self.synchronous:
+            while self._buffer:
+                rows, self._buffer = self._buffer[:self.batch_size], self._buffer[self.batch_size:]
+                self._write(rows)
+        elif self._thread is not None:
+            self._queue.join()
+
+    def close(self):
+        """Writes all queued rows and stops the background thread"""
+        atexit.unregister(self.close)
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    @property
+    def pending_count(self):
+        """Number of rows waiting to be written"""
+        return len(self._buffer) if self.synchronous else self._queue.qsize()
+
+    def _write(self, rows):
+        try:
+            self.write_func(rows)
+            with self._lock:
+                self.written_count += len(rows)
+        except Exception as ex:
+            # Log records are not worth failing the update they describe
+            with self._lock:
+                self.error_count += 1
+            log.error("Error writing {} log records: {}".format(len(rows), ex))
+
+    def _run(self):
+        """Background thread. Takes rows from the queue and writes them by batches"""
+        while True:
+            rows = []
+            stop = False
+            item = self._queue.get()
+            while True:
+                if item is _STOP:
+                    stop = True
+                    break
+                rows.append(item)
+                if len(rows) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            if rows:
+                self._write(rows)
+            for _ in range(len(rows) + stop):
+                self._queue.task_done()
+            if stop:
+                return
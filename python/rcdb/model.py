@@ -1,20 +1,33 @@
 import datetime
+from collections import namedtuple
+from operator import attrgetter
 
 
+from sqlalchemy import event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.schema import Column, ForeignKey, Table
+from sqlalchemy.schema import Column, ForeignKey, Table, Index
 from sqlalchemy.types import Integer, String, Text, DateTime, Enum, Float, Boolean, UnicodeText, Date
-from sqlalchemy.orm import sessionmaker, reconstructor, object_session
+from sqlalchemy.orm import sessionmaker, reconstructor, object_session, deferred, column_property, query_expression
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.sql.expression import desc
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.sql.expression import func
 
+from rcdb.file_archiver import decompress_content, get_content_codec
+from rcdb.query_cache import json_value_cache
+
 Base = declarative_base()
 
 RCDB_MAX_RUN = 18446744073709551615   # 2**64 - 1
 
+# Session.info key with {id: ConditionType} of RCDBProvider condition types cache.
+# Condition gets its type from there instead of loading Condition.type relationship
+CONDITION_TYPES_BY_ID_KEY = "rcdb_condition_types_by_id"
+
+# Session.info key with a value, which tells DBs apart in json_value_cache keys. Set by RCDBProvider.connect
+JSON_CACHE_SCOPE_KEY = "rcdb_json_cache_scope"
+
 
 class ModelBase(Base):
     __abstract__ = True
@@ -142,11 +155,36 @@ class ConfigurationFile(ModelBase):
     id = Column(Integer, primary_key=True)
     path = Column(Text, nullable=False)
     sha256 = Column(String(44), nullable=False)
-    content = Column(Text(), nullable=False)
+    # Content is loaded on first access. Listings of files (e.g. Run.files) read only names and sizes
+    stored_content = deferred(Column('content', Text(), nullable=False))
+    """Content as it is stored in DB. May be compressed, see rcdb.file_archiver.compress_content"""
+    content_length = column_property(func.length(stored_content.expression))
+    """LENGTH() of the stored column, not of the file. Compressed content is counted with the marker and
+    in base64. MySQL counts bytes, SQLite counts characters"""
     description = Column(String(255), nullable=True)
     importance = Column(Integer, nullable=False, default=0, server_default='0')
     runs = relationship("Run", secondary=_files_have_runs_association, back_populates="files")
 
+    # add_configuration_file looks files up by hash and path. MySQL can index only a prefix of TEXT
+    __table_args__ = (Index('ix_files_sha256_path', 'sha256', 'path', mysql_length={'path': 255}),)
+
+    @hybrid_property
+    def content(self):
+        """Text content of the file. Compressed content is decompressed"""
+        return decompress_content(self.stored_content)
+
+    @content.setter
+    def content(self, value):
+        self.stored_content = value
+
+    @content.expression
+    def content(cls):
+        return cls.stored_content
+
+    @property
+    def is_compressed(self):
+        return get_content_codec(self.stored_content) is not None
+
     def __repr__(self):
         return "<ConfigurationFile id='{0}', path='{1}'>".format(self.id, self.path)
 
@@ -207,82 +245,36 @@ class ConditionType(ModelBase):
             .join(Condition, Condition.run_number == Run.number) \
             .filter(Condition.type == self)
 
+    @property
+    def value_accessors(self):
+        """Field name, getter, setter and converter of values of this type. They are resolved once
+        by value_type and cached on the object
+
+        :rtype: ValueAccessors
+        """
+        accessors = self.__dict__.get('_value_accessors')
+        if accessors is None:
+            accessors = self._value_accessors = _resolve_value_accessors(self)
+        return accessors
+
     def get_condition_alias_value_field(self, alias):
         """ Gets appropriate aliased(Condition).xxx_value field according to type """
-        field = None
-        if self.value_type == ConditionType.INT_FIELD:
-            field = alias.int_value
-        if self.value_type == ConditionType.STRING_FIELD \
-                or self.value_type == ConditionType.JSON_FIELD \
-                or self.value_type == ConditionType.BLOB_FIELD:
-            field = alias.text_value
-        if self.value_type == ConditionType.FLOAT_FIELD:
-            field = alias.float_value
-        if self.value_type == ConditionType.BOOL_FIELD:
-            field = alias.bool_value
-        if self.value_type == ConditionType.TIME_FIELD:
-            field = alias.time_value
-        return field
+        name = self.value_accessors.field_name
+        return getattr(alias, name) if name else None
 
     def get_value_field_name(self):
         """ Gets appropriate aliased(Condition).xxx_value field according to type """
-        name = None
-        if self.value_type == ConditionType.INT_FIELD:
-            name = 'int_value'
-        if self.value_type == ConditionType.STRING_FIELD \
-                or self.value_type == ConditionType.JSON_FIELD \
-                or self.value_type == ConditionType.BLOB_FIELD:
-            name = 'text_value'
-        if self.value_type == ConditionType.FLOAT_FIELD:
-            name = 'float_value'
-        if self.value_type == ConditionType.BOOL_FIELD:
-            name = 'bool_value'
-        if self.value_type == ConditionType.TIME_FIELD:
-            name = 'time_value'
-        return name
+        return self.value_accessors.field_name
 
     @hybrid_property
     def value_field(self):
         """ Gets appropriate Condition.xxx_value field according to type """
-        field = None
-        if self.value_type == ConditionType.INT_FIELD:
-            field = Condition.int_value
-        if self.value_type == ConditionType.STRING_FIELD \
-                or self.value_type == ConditionType.JSON_FIELD \
-                or self.value_type == ConditionType.BLOB_FIELD:
-            field = Condition.text_value
-        if self.value_type == ConditionType.FLOAT_FIELD:
-            field = Condition.float_value
-        if self.value_type == ConditionType.BOOL_FIELD:
-            field = Condition.bool_value
-        if self.value_type == ConditionType.TIME_FIELD:
-            field = Condition.time_value
-        return field
+        name = self.value_accessors.field_name
+        return getattr(Condition, name) if name else None
 
     def convert_value(self, value):
-        # validate value
-        if self.value_type == ConditionType.FLOAT_FIELD:
-            try:
-                value = float(value)
-            except ValueError as err:
-                message = "Condition type '{}' awaits float as value. {}".format(self, err)
-                raise ValueError(message)
-        elif self.value_type == ConditionType.INT_FIELD:
-            try:
-                value = int(value)
-            except ValueError as err:
-                message = "Condition type '{}' awaits int as value. {}".format(self, err)
-                raise ValueError(message)
-        elif self.value_type == ConditionType.TIME_FIELD and not isinstance(value, datetime.datetime):
-            message = "Condition type '{}' awaits datetime as value. '{}' is given".format(self, type(value))
-            raise ValueError(message)
-        elif self.value_type == ConditionType.BOOL_FIELD:
-            try:
-                value = bool(value)
-            except ValueError as err:
-                message = "Condition type '{}' awaits bool as value. {}".format(self, err)
-                raise ValueError(message)
-        return value
+        """Validates and converts value to the type of this condition type. Raises ValueError"""
+        return self.value_accessors.converter(value)
 
     def values_are_equal(self, left_value, right_value):
         """Function compares 2 values and return true if values are differ.
@@ -311,6 +303,79 @@ class ConditionType(ModelBase):
             .format(self.id, self.name, self.value_type)
 
 
+@event.listens_for(ConditionType.value_type, "set")
+def _reset_value_accessors(target, value, old_value, initiator):
+    target.__dict__.pop('_value_accessors', None)
+
+
+# Condition field, which stores values of a value type
+value_field_names = {
+    ConditionType.INT_FIELD: 'int_value',
+    ConditionType.STRING_FIELD: 'text_value',
+    ConditionType.JSON_FIELD: 'text_value',
+    ConditionType.BLOB_FIELD: 'text_value',
+    ConditionType.FLOAT_FIELD: 'float_value',
+    ConditionType.BOOL_FIELD: 'bool_value',
+    ConditionType.TIME_FIELD: 'time_value',
+}
+
+ValueAccessors = namedtuple('ValueAccessors', ['field_name', 'getter', 'setter', 'converter'])
+"""Functions to work with values of a condition type. See ConditionType.value_accessors
+
+    field_name - name of Condition field with values or None if the type is unknown
+    getter(condition) - gets value of a condition
+    setter(condition, value) - sets value of a condition
+    converter(value) - validates and converts a value to the type. Raises ValueError
+"""
+
+
+def _resolve_value_accessors(condition_type):
+    """Creates ValueAccessors for value_type of the condition type"""
+    value_type = condition_type.value_type
+    field_name = value_field_names.get(value_type)
+
+    if field_name:
+        getter = attrgetter(field_name)
+
+        def setter(condition, value):
+            setattr(condition, field_name, value)
+    else:
+        # Values of unknown types are read as text and can't be set
+        getter = attrgetter('text_value')
+
+        def setter(condition, value):
+            raise ValueError("Unknown field type! field_type='{}'".format(value_type))
+
+    def convert_number(value, number_type):
+        try:
+            return number_type(value)
+        except ValueError as err:
+            message = "Condition type '{}' awaits {} as value. {}".format(condition_type, number_type.__name__, err)
+            raise ValueError(message)
+
+    if value_type == ConditionType.FLOAT_FIELD:
+        def converter(value):
+            return convert_number(value, float)
+    elif value_type == ConditionType.INT_FIELD:
+        def converter(value):
+            return convert_number(value, int)
+    elif value_type == ConditionType.BOOL_FIELD:
+        def converter(value):
+            return convert_number(value, bool)
+    elif value_type == ConditionType.TIME_FIELD:
+        def converter(value):
+            if not isinstance(value, datetime.datetime):
+                message = "Condition type '{}' awaits datetime as value. '{}' is given" \
+                    .format(condition_type, type(value))
+                raise ValueError(message)
+            return value
+    else:
+        def converter(value):
+            return value
+
+    return ValueAccessors(field_name, getter, setter, converter)
+
+
 all_value_types = [
     ConditionType.BOOL_FIELD,
     ConditionType.JSON_FIELD,
@@ -338,6 +403,10 @@ class Condition(ModelBase):
     bool_value = Column(Boolean, nullable=False, default=False)
     time_value = Column(DateTime, nullable=True, default=None)
 
+    loaded_text_value = query_expression()
+    """text_value of conditions of small types, when text_value is deferred.
+    See RCDBProvider.enable_lazy_text_values and RCDBProvider._on_orm_execute"""
+
     run_number = Column(Integer, ForeignKey('runs.number'))
     run = relationship("Run", back_populates="conditions")
 
@@ -347,9 +416,37 @@ class Condition(ModelBase):
 
     created = Column(DateTime, default=datetime.datetime.now)
 
+    # Every select filters conditions by type and run. Numeric values are read from the index only.
+    # Only one value of a condition type per run is allowed. The unique key makes it safe for concurrent writers
+    # and allows add_conditions to upsert. Older DBs get it with 'rcdb db unique-conditions'.
+    # MAX(created) of the select_values result cache watermark is read from ix_conditions_created
+    __table_args__ = (Index('ix_conditions_type_run_int', 'condition_type_id', 'run_number', 'int_value'),
+                      Index('ix_conditions_type_run_float', 'condition_type_id', 'run_number', 'float_value'),
+                      Index('uq_conditions_run_type', 'run_number', 'condition_type_id', unique=True),
+                      Index('ix_conditions_created', 'created'))
+
+    @property
+    def condition_type(self):
+        """ConditionType of the condition. It is taken from RCDBProvider condition types cache if possible,
+        so Condition.type relationship is not loaded
+
+        :rtype: ConditionType
+        """
+        instance_dict = self.__dict__
+        condition_type = instance_dict.get('type') or instance_dict.get('_cached_condition_type')
+        if condition_type is None:
+            session = object_session(self)
+            types_by_id = session.info.get(CONDITION_TYPES_BY_ID_KEY) if session is not None else None
+            if types_by_id:
+                condition_type = types_by_id.get(self.condition_type_id)
+            if condition_type is None:
+                return self.type
+            self._cached_condition_type = condition_type
+        return condition_type
+
     @hybrid_property
     def name(self):
-        return self.type.name
+        return self.condition_type.name
 
     @name.expression
     def balance(self):
@@ -357,49 +454,44 @@ class Condition(ModelBase):
 
     @hybrid_property
     def value_type(self):
-        return self.type.value_type
+        return self.condition_type.value_type
 
     @hybrid_property
     def value(self):
         """ Gets value of the corrected type """
-        field_type = self.type.value_type
-        if field_type == ConditionType.INT_FIELD:
-            return self.int_value
-        if field_type == ConditionType.STRING_FIELD \
-                or field_type == ConditionType.JSON_FIELD \
-                or field_type == ConditionType.BLOB_FIELD:
-            return self.text_value
-        if field_type == ConditionType.FLOAT_FIELD:
-            return self.float_value
-        if field_type == ConditionType.BOOL_FIELD:
-            return self.bool_value
-        if field_type == ConditionType.TIME_FIELD:
-            return self.time_value
-        return self.text_value
+        return self.condition_type.value_accessors.getter(self)
 
     @value.setter
     def value(self, val):
         """ Gets value of the corrected type """
-        field_type = self.type.value_type
-        if field_type == ConditionType.INT_FIELD:
-            self.int_value = val
-        elif field_type == ConditionType.STRING_FIELD \
-                or field_type == ConditionType.JSON_FIELD \
-                or field_type == ConditionType.BLOB_FIELD:
-            self.text_value = val
-        elif field_type == ConditionType.FLOAT_FIELD:
-            self.float_value = val
-        elif field_type == ConditionType.BOOL_FIELD:
-            self.bool_value = val
-        elif field_type == ConditionType.TIME_FIELD:
-            self.time_value = val
-        else:
-            raise ValueError("Unknown field type! field_type='{}'".format(field_type))
+        self.condition_type.value_accessors.setter(self, val)
+
+    @property
+    def parsed_value(self):
+        """Value of JSON or BLOB condition parsed with json.loads. Values of other types are returned as is
+
+        The parsed value is cached by DB and condition id, and checked by created time and length of the text
+        (see rcdb.query_cache.json_value_cache), so the same value is parsed once. Conditions, which are not in
+        a session of RCDBProvider, are parsed every time. The returned object is shared and should not be modified
+        """
+        if self.value_type not in (ConditionType.JSON_FIELD, ConditionType.BLOB_FIELD):
+            return self.value
+        text = self.text_value
+        session = object_session(self)
+        scope = session.info.get(JSON_CACHE_SCOPE_KEY) if session is not None else None
+        if scope is None or self.id is None or text is None:
+            return json_value_cache.parse(text)
+        return json_value_cache.parse(text, (scope, self.id), (self.created, len(text)))
 
     def __repr__(self):
         return "<Condition id='{}', run_number='{}', value={}>".format(self.id, self.run_number, self.value)
 
 
+@event.listens_for(Condition.condition_type_id, "set")
+def _reset_cached_condition_type(target, value, old_value, initiator):
+    target.__dict__.pop('_cached_condition_type', None)
+
+
 class SchemaVersion(ModelBase):
     __tablename__ = 'schema_versions'
     version = Column(Integer, primary_key=True, autoincrement=False)
@@ -421,6 +513,9 @@ class LogRecord(ModelBase):
     created = Column(DateTime, default=datetime.datetime.now)
     user_name = Column(String(255), nullable=True)
 
+    # Logs of a run sorted by id
+    __table_args__ = (Index('ix_logs_related_run_id', 'related_run', 'id'),)
+
     def __repr__(self):
         return "<LogRecord id='{0}', description='{1}'>".format(self.id, self.description)
 
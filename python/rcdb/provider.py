@@ -6,16 +6,20 @@ More details.
 
 import os
 import re
+import itertools
+from contextlib import contextmanager
 import logging
 import sys
 from time import mktime
 from collections.abc import MutableSequence
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
 
-from sqlalchemy import text
+from sqlalchemy import text, bindparam, select, func, case, update, event
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.exc import OperationalError, ProgrammingError, NoResultFound
 
-from ply.lex import LexToken
-
 import sqlalchemy.orm
 from sqlalchemy.orm import aliased
 # from sqlalchemy.orm.exc import NoResultFound
@@ -24,8 +28,15 @@ import rcdb
 import rcdb.file_archiver
 from rcdb.alias import default_aliases
 from rcdb.log_format import BraceMessage as Lf
-from rcdb import lexer
+from rcdb import query_parser
 from rcdb.stopwatch import StopWatchTimer
+from rcdb.query_pushdown import translate_query
+from rcdb.query_evaluator import compile_evaluator, NoneValueError
+from rcdb import query_numpy
+from rcdb.query_cache import LruCache, ResultCache, normalize_query, json_value_cache
+from rcdb import query_planner
+from rcdb.columnar import ColumnarTable
+from rcdb.log_writer import LogRecordWriter
 from rcdb.errors import OverrideConditionTypeError, NoConditionTypeFound, \
     NoRunFoundError, OverrideConditionValueError, QueryFormatError, QueryEvaluationError
 from rcdb.model import *
@@ -37,9 +48,237 @@ if sys.version_info[0] == 3:
     # noinspection PyUnresolvedReferences
     basestring = str,
 
+# Session.info key with ids of condition types, which text_value is deferred. See enable_lazy_text_values
+_LAZY_TEXT_TYPE_IDS_KEY = "rcdb_lazy_text_type_ids"
+
+# How many prepared search queries RCDBProvider keeps. 0 disables the cache
+QUERY_CACHE_SIZE = 128
+
+# select_values(runs=[...]): run lists up to this size are passed as bound parameters of one query,
+# longer lists are split into chunks of this size
+RUNS_BIND_CHUNK_SIZE = 500
+
+# select_values(runs=[...]): run lists of this size and longer are loaded to a temporary table
+RUNS_TEMP_TABLE_MIN = 5000
+
+# select_values: the pivot query (one scan of conditions instead of a join per condition type) is used
+# if there are at least this many condition types and at least this many runs to select from
+PIVOT_MIN_CONDITIONS = 5
+PIVOT_MIN_RUNS = 1000
+
+# RunSelectionResult.get_values fetches values by chunks of this many runs
+GET_VALUES_CHUNK_SIZE = 1000
+
+# select_values(shards=...): maximum number of shards queried at once
+SHARDS_MAX_WORKERS = 8
+
+# add_conditions_bulk: number of (run, name, value) rows checked and written in one transaction
+BULK_CHUNK_SIZE = 1000
+
+# create_runs: number of runs inserted by one multi-row INSERT
+CREATE_RUNS_CHUNK_SIZE = 1000
+
+# @alias_name in search queries
+_alias_regex = re.compile(r'@(\w+)')
+
+# Numbers of in-memory SQLite DBs in json_value_cache scopes. Such DBs have the same URL
+_memory_db_counter = itertools.count(1)
+
+
+def _json_cache_scope(engine):
+    """The part of json_value_cache keys, which tells DBs apart: DB URL without password
+    or a unique number for in-memory SQLite DB"""
+    url = engine.url
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        return "sqlite-memory-{}".format(next(_memory_db_counter))
+    return url.render_as_string(hide_password=True)
+
+
+@event.listens_for(Condition, "load")
+@event.listens_for(Condition, "refresh")
+def _set_loaded_text_value(target, context, attrs=None):
+    """Sets text_value of a condition loaded with deferred text_value, if it is not of JSON or BLOB type"""
+    large_type_ids = context.session.info.get(_LAZY_TEXT_TYPE_IDS_KEY)
+    if large_type_ids is None or target.condition_type_id in large_type_ids:
+        return
+    state = sqlalchemy.inspect(target)
+    if "text_value" in state.unloaded and "loaded_text_value" not in state.unloaded:
+        sqlalchemy.orm.attributes.set_committed_value(target, "text_value", target.loaded_text_value)
+
+
+class _SearchQueryMixin(object):
+    """Search query parsing, caching of prepared select_values queries and evaluation of their results
+
+    Shared by RCDBProvider and RCDBLiteProvider. A class using it should have: aliases, engine,
+    _query_cache (LruCache), _cnd_types_version (changes when condition types change) and
+    get_condition_types_by_name(). It may override _get_planner_statistics
+    """
+
+    def _expand_aliases(self, search_str):
+        """Replaces @alias_name-s in the search query by alias expressions in parentheses
+
+        Unknown aliases are left as is, so the parser reports them
+
+        :param search_str: Search query like "event_count > 1000 and @is_production"
+        :type search_str: str
+        :rtype: str
+        """
+        if '@' not in search_str:
+            return search_str
+
+        aliases_by_name = {alias.name: alias for alias in self.aliases}
+
+        def replace(match):
+            alias = aliases_by_name.get(match.group(1))
+            return '(' + alias.expression + ')' if alias else match.group(0)
+
+        return _alias_regex.sub(replace, search_str)
+
+    def _parse_search_query(self, search_str):
+        """Expands aliases, parses and validates search query
+
+        :param search_str: Search query like "event_count > 1000 and @is_production"
+        :type search_str: str
+        :return: (query AST or None if query is empty, list of condition names used in the query)
+        :rtype: (rcdb.query_parser.Node, list[str])
+        """
+        search_str = self._expand_aliases(str(search_str))
+        query_node = query_parser.parse_query(search_str)
+        names = query_parser.validate(query_node, self.get_condition_types_by_name())
+        return query_node, names
+
+    def _query_cache_key(self, kind, search_str, *args):
+        """Key of a prepared query in the query cache
+
+        A prepared query depends on the query text, aliases (only if the query uses them)
+        and condition types, which are all in the key. So changed aliases or a new condition type
+        never hit an old entry
+
+        :param kind: what the query is prepared for, e.g. "select_values"
+        :param search_str: Search query
+        :param args: other arguments the prepared query depends on
+        :rtype: tuple
+        """
+        search_str = normalize_query(search_str)
+        aliases_key = None
+        if '@' in search_str:
+            aliases_key = tuple((alias.name, alias.expression) for alias in self.aliases)
+        return (kind, search_str, aliases_key, self._cnd_types_version) + args
+
+    def _prepare_select_values(self, val_names, search_str):
+        """Parses search query and prepares SQL and the evaluator for select_values
+
+        :param val_names: list of conditions names to select
+        :param search_str: Search pattern
+        :rtype: _SelectValuesPlan
+        """
+        # get all condition types
+        all_cnd_types_by_name = self.get_condition_types_by_name()
+
+        # getting what to search from search_str
+        query_node, query_names = self._parse_search_query(search_str)
+
+        target_cnd_types = [all_cnd_types_by_name[name] for name in query_names]
+        names = ["run"] + query_names
+
+        # result values table
+        val_indexes = []
+
+        for name in val_names:
+            if name in names:
+                val_indexes.append(names.index(name))
+            else:
+                cnd_type = all_cnd_types_by_name[name]
+                target_cnd_types.append(cnd_type)
+                val_indexes.append(len(names))
+                names.append(name)
+
+        statistics = self._get_planner_statistics([all_cnd_types_by_name[name] for name in query_names])
+
+        return _SelectValuesPlan(names, target_cnd_types, val_indexes, query_node, self.engine.dialect.name,
+                                 statistics)
+
+    def _get_planner_statistics(self, condition_types):
+        """Statistics of the condition types used by the query planner. No statistics by default
+
+        :return: {condition name: rcdb.query_planner.ConditionStatistics}
+        """
+        return {}
+
+    def _get_select_values_plan(self, val_names, search_str):
+        """Returns prepared select_values query from the cache or prepares it
+
+        :return: (cache key, plan, "hit" or "miss")
+        :rtype: (tuple, _SelectValuesPlan, str)
+        """
+        cache_key = self._query_cache_key("select_values", search_str, tuple(val_names))
+        plan = self._query_cache.get(cache_key)
+        if plan is not None:
+            return cache_key, plan, "hit"
+        plan = self._prepare_select_values(val_names, search_str)
+        self._query_cache.put(cache_key, plan)
+        return cache_key, plan, "miss"
+
+    @staticmethod
+    def _choose_join_strategy(plan, runs, run_min, run_max):
+        """Chooses how values of the prepared query are selected from DB: "joins" or "pivot"
+
+        Each join of conditions table is a lookup per run, so for few condition types or few runs joins are fine.
+        For many condition types over many runs one scan of conditions table is cheaper
+        """
+        run_count = len(runs) if runs else run_max - run_min + 1
+        if len(plan.target_cnd_types) >= PIVOT_MIN_CONDITIONS and run_count >= PIVOT_MIN_RUNS:
+            return "pivot"
+        return "joins"
+
+    def _evaluate_rows(self, plan, rows, vectorize, search_str):
+        """Evaluates the part of the query which is not done by SQL
+
+        :return: (selected rows, "numpy" or "row" - how they were evaluated)
+        """
+        if vectorize is not False and query_numpy.is_available() \
+                and (vectorize or len(rows) >= query_numpy.VECTORIZE_MIN_ROWS):
+            selected_rows = self._select_rows_vectorized(plan, rows)
+            if selected_rows is not None:
+                return selected_rows, "numpy"
+
+        return self._select_rows(plan.evaluator, rows, search_str, plan.names), "row"
+
+    @staticmethod
+    def _select_rows(evaluator, rows, search_str, names):
+        """Evaluates query for each row and returns rows where it is True"""
+        selected_rows = []
+        for values in rows:
+            try:
+                if evaluator(values):
+                    selected_rows.append(values)
+            except NoneValueError:
+                # Condition value might be None if it's not added to a run. Such runs are not selected
+                continue
+            except Exception as ex:
+                message = 'Error evaluating search query.\n' \
+                          + '  Query: <<"{}">>, \n'.format(search_str) \
+                          + '  Names: {}, \n'.format(names) \
+                          + '  Values: {} \n'.format(values) \
+                          + '  Error ({}): {}'.format(type(ex), ex)
+                raise QueryEvaluationError(msg=message)
+        return selected_rows
+
+    @staticmethod
+    def _select_rows_vectorized(plan, rows):
+        """Evaluates query over NumPy arrays. Returns rows where it is True or None if it can't be vectorized"""
+        try:
+            evaluate = plan.get_vectorized_evaluator()
+            columns = query_numpy.make_columns(rows, plan.value_indexes, plan.value_types)
+            mask = evaluate(columns, len(rows))
+        except query_numpy.Unvectorizable as ex:
+            log.debug(Lf("Query can't be vectorized ({}), evaluating row by row", ex))
+            return None
+        return [row for row, is_selected in zip(rows, mask) if is_selected]
+
 
 # noinspection PyTypeChecker
-class RCDBProvider(object):
+class RCDBProvider(_SearchQueryMixin):
     """ RCDB data provider that uses SQLAlchemy for accessing databases """
 
     def __init__(self, connection_string=None, user_name="", check_version=True):
@@ -51,8 +290,21 @@ class RCDBProvider(object):
         self.session = None
         self._cnd_types_cache = None
         self._cnd_types_by_name = None
+        self._cnd_types_version = 0
         self.aliases = default_aliases
         self._run_periods_cache = None
+        self._query_cache = LruCache(QUERY_CACHE_SIZE)
+        self.result_cache = None
+        """:type: ResultCache"""
+        self._condition_statistics = None      # {condition type id: ConditionStatistics}. None - not used
+        self._conditions_unique_key = None     # True if DB has unique conditions key. None - not checked yet
+        self._batch_depth = 0                   # > 0 inside 'with db.batch()'
+        self.log_writer = None
+        """:type: LogRecordWriter"""
+        self.file_compression = None
+        """Codec ('zlib' or 'zstd') to compress content of added configuration files. None - store plain text.
+        C++ and Java providers can't read compressed content"""
+        self._lazy_text_values = False          # See enable_lazy_text_values
 
         # username for record
         self.user_name = user_name
@@ -112,7 +364,17 @@ class RCDBProvider(object):
 
         session_type = sessionmaker(bind=self.engine)
         self.session = session_type()
+        event.listen(self.session, "do_orm_execute", self._on_orm_execute)
+        self.session.info[JSON_CACHE_SCOPE_KEY] = _json_cache_scope(self.engine)
+        self._clear_condition_types_cache()
         self._is_connected = True
+        self._query_cache.clear()
+        if self.result_cache is not None:
+            self.result_cache.clear()
+            self.result_cache.watermark = None
+        if self._condition_statistics is not None:
+            self._condition_statistics = {}
+        self._conditions_unique_key = None
         self._connection_string = connection_string
 
         if check_version:
@@ -128,6 +390,7 @@ class RCDBProvider(object):
     # ------------------------------------------------
     def disconnect(self):
         """Closes connection to database"""
+        self.disable_log_writer()
         self._is_connected = False
         self.session.close()
 
@@ -157,6 +420,109 @@ class RCDBProvider(object):
         """
         return self._connection_string
 
+    # -------------------------------------------------------------------
+    # Transactions
+    # -------------------------------------------------------------------
+    @contextmanager
+    def batch(self):
+        """Context manager which makes all changes inside it one transaction
+
+        Methods like add_conditions, create_run, add_configuration_file or add_log_record commit changes
+        when called outside of a batch. Inside a batch they only flush changes to DB, and the
+        batch commits once at its end. If an exception is raised, all changes of the batch are rolled back.
+        Batches may be nested, the outermost one commits
+
+        Example:
+            with db.batch():
+                db.create_run(1000)
+                db.add_conditions(1000, {"event_count": 10, "run_type": "test"})
+                db.add_log_record("", "Run 1000 added", 1000)
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+            if self._batch_depth == 1:
+                self.session.commit()
+        except:
+            if self._batch_depth == 1:
+                self._rollback()
+            raise
+        finally:
+            self._batch_depth -= 1
+            # Log records of the batch are written even if it failed
+            if not self._batch_depth and self.log_writer is not None and self.log_writer.synchronous:
+                self.log_writer.flush()
+
+    @property
+    def in_batch(self):
+        """True inside 'with db.batch()'"""
+        return self._batch_depth > 0
+
+    def _commit(self):
+        """Commits changes or only flushes them inside a batch"""
+        if self._batch_depth:
+            self.session.flush()
+        else:
+            self.session.commit()
+
+    def _rollback(self):
+        """Rolls back the transaction. Inside a batch all changes of the batch are rolled back"""
+        self.session.rollback()
+        # Condition types and run periods created in the transaction are gone
+        self._clear_condition_types_cache()
+        self._run_periods_cache = None
+
+    def _clear_condition_types_cache(self):
+        self._cnd_types_cache = None
+        self._cnd_types_by_name = None
+        self._cnd_types_version += 1
+        if self.session is not None:
+            self.session.info.pop(CONDITION_TYPES_BY_ID_KEY, None)
+
+    # -------------------------------------------------------------------
+    # Log records writer
+    # -------------------------------------------------------------------
+    def enable_log_writer(self, synchronous=None, max_queue_size=10000, batch_size=100):
+        """Makes add_log_record queue records instead of writing each one right away
+
+        In background mode a thread writes queued records by batches on its own connection.
+        In synchronous mode records are written by the calling thread right after being added or,
+        inside 'with db.batch()', at the end of the batch. Queued records are written on
+        disable_log_writer, disconnect or at exit
+
+        :param synchronous: Write records in the calling thread. None - for SQLite, which has one writer at a time
+                            anyway, and background for other DBs
+        :type synchronous: bool or None
+        :param max_queue_size: Maximum number of records waiting to be written
+        :param batch_size: Maximum number of records written at once
+        """
+        self.disable_log_writer()
+        if synchronous is None:
+            synchronous = self.engine.dialect.name == 'sqlite'
+        write_func = self._write_log_rows_in_session if synchronous else self._write_log_rows
+        self.log_writer = LogRecordWriter(write_func, synchronous, max_queue_size, batch_size)
+
+    def disable_log_writer(self):
+        """Writes all queued log records and makes add_log_record write records right away"""
+        if self.log_writer is not None:
+            self.log_writer.close()
+            self.log_writer = None
+
+    def _write_log_rows(self, rows):
+        """Inserts rows to logs table on a separate connection"""
+        with self.engine.begin() as connection:
+            connection.execute(LogRecord.__table__.insert(), rows)
+
+    def _write_log_rows_in_session(self, rows):
+        """Inserts rows to logs table in the session transaction. On error the transaction is rolled back,
+        LogRecordWriter only logs the error, so the session has to stay usable for the next writes"""
+        try:
+            self.session.connection().execute(LogRecord.__table__.insert(), rows)
+            self._commit()
+        except:
+            self._rollback()
+            raise
+
     # -------------------------------------------------------------------
     # Adds log record to the database
     # -------------------------------------------------------------------
@@ -178,19 +544,21 @@ class RCDBProvider(object):
         if isinstance(related_run_number, Run):
             related_run_number = related_run_number.number
 
+        if self.log_writer is not None:
+            self.log_writer.put({"table_ids": self._log_table_ids(table_ids),
+                                 "description": str(description),
+                                 "related_run": related_run_number,
+                                 "created": datetime.datetime.now(),
+                                 "user_name": self.user_name or None})
+            if self.log_writer.synchronous and do_commit and not self._batch_depth:
+                self.log_writer.flush()
+            log.info(description)
+            return
+
         record = LogRecord()
 
         # table ids?
-        if isinstance(table_ids, Base):
-            record.table_ids = table_ids.log_id
-        elif isinstance(table_ids, list):
-            if table_ids:
-                if isinstance(table_ids[0], ModelBase):
-                    record.table_ids = list_to_db_text([item.log_id for item in table_ids])
-                elif isinstance(table_ids[0], str):
-                    record.table_ids = list_to_db_text(table_ids)
-        elif isinstance(table_ids, str):
-            record.table_ids = table_ids
+        record.table_ids = self._log_table_ids(table_ids)
 
         # description
         record.description = str(description)
@@ -202,9 +570,25 @@ class RCDBProvider(object):
         # save
         self.session.add(record)
         if do_commit:
-            self.session.commit()
+            self._commit()
         log.info(description)
 
+    @staticmethod
+    def _log_table_ids(table_ids):
+        """LogRecord.table_ids text from ids, objects or lists of them"""
+        if isinstance(table_ids, Base):
+            return table_ids.log_id
+        if isinstance(table_ids, list):
+            if table_ids:
+                if isinstance(table_ids[0], ModelBase):
+                    return list_to_db_text([item.log_id for item in table_ids])
+                elif isinstance(table_ids[0], str):
+                    return list_to_db_text(table_ids)
+            return None
+        if isinstance(table_ids, str):
+            return table_ids
+        return None
+
     # ------------------------------------------------
     # Gets Run or returns None
     # ------------------------------------------------
@@ -244,6 +628,22 @@ class RCDBProvider(object):
 
         return query.all()
 
+    def get_run_snapshots(self, run_min, run_max, condition_names, sort_desc=False):
+        """Gets runs with values of the given conditions as compact immutable RunSnapshot objects
+
+        Runs and all the values are selected by two queries, while Run objects of get_runs load
+        conditions run by run. Use it in scripts, which walk over many runs and read a few conditions
+
+        :param run_min: minimum run number
+        :param run_max: maximum run number
+        :param condition_names: names of conditions, which values are selected
+        :type condition_names: list[str]
+        :param sort_desc: If True result runs will be sorted by descending run number
+        :rtype: list[RunSnapshot]
+        """
+        condition_types = [self.get_condition_type(name) for name in condition_names]
+        return _fetch_run_snapshots(self.session.connection(), condition_types, run_min, run_max, sort_desc)
+
     # ------------------------------------------------
     # Gets Run or returns None
     # ------------------------------------------------
@@ -297,10 +697,54 @@ class RCDBProvider(object):
             run = Run()
             run.number = run_number
             self.session.add(run)
-            self.session.commit()
+            self._commit()
 
         return run
 
+    def create_runs(self, run_numbers, start_time=None, end_time=None):
+        """Creates runs which don't exist yet
+
+        Existing runs in the range of run_numbers are found by one query, the missing ones are inserted
+        by multi-row INSERTs of CREATE_RUNS_CHUNK_SIZE runs and committed once. Existing runs are not changed
+
+        Example:
+            db.create_runs(range(1000, 2000))
+            db.create_runs([1000, 1005], start_time={1000: datetime(2024, 1, 1, 10, 0)})
+
+        :param run_numbers: iterable of run numbers, e.g. range(1000, 2000) or a list
+        :param start_time: start time of all created runs or {run_number: start time}
+        :type start_time: datetime.datetime or dict or None
+        :param end_time: end time of all created runs or {run_number: end time}
+        :type end_time: datetime.datetime or dict or None
+        :return: sorted list of numbers of created runs
+        :rtype: list[int]
+        """
+        run_numbers = sorted({int(run_number) for run_number in run_numbers})
+        if not run_numbers:
+            return []
+
+        connection = self.session.connection()
+        existing = {number for number, in connection.execute(
+            select(Run.number).where(Run.number >= run_numbers[0], Run.number <= run_numbers[-1]))}
+        new_numbers = [number for number in run_numbers if number not in existing]
+
+        def run_time(time_param, number):
+            return time_param.get(number) if isinstance(time_param, dict) else time_param
+
+        table = Run.__table__
+        try:
+            for i in range(0, len(new_numbers), CREATE_RUNS_CHUNK_SIZE):
+                rows = [{"number": number,
+                         "started": run_time(start_time, number),
+                         "finished": run_time(end_time, number)}
+                        for number in new_numbers[i:i + CREATE_RUNS_CHUNK_SIZE]]
+                connection.execute(table.insert().values(rows))
+            self._commit()
+        except:
+            self._rollback()
+            raise
+        return new_numbers
+
     # ------------------------------------------------
     # Returns run periods
     # ------------------------------------------------
@@ -359,11 +803,11 @@ class RCDBProvider(object):
 
             try:
                 self.session.add(rp)
-                self.session.commit()
+                self._commit()
                 # clear cache
                 self._run_periods_cache = None
             except:
-                self.session.rollback()
+                self._rollback()
                 raise
 
             log_desc = f"RunPeriod created with name='{name}', run_min='{run_min}' run_max='{run_max}'"
@@ -422,6 +866,8 @@ class RCDBProvider(object):
             return self._cnd_types_cache
         try:
             self._cnd_types_cache = self.session.query(ConditionType).all()
+            # Conditions get their types from here, see Condition.condition_type
+            self.session.info[CONDITION_TYPES_BY_ID_KEY] = {ct.id: ct for ct in self._cnd_types_cache}
             return self._cnd_types_cache
         except NoResultFound:
             return []
@@ -475,12 +921,10 @@ class RCDBProvider(object):
             ct.description = description
             try:
                 self.session.add(ct)
-                self.session.commit()
-                # clear cache
-                self._cnd_types_cache = None
-                self._cnd_types_by_name = None
+                self._commit()
+                self._clear_condition_types_cache()
             except:
-                self.session.rollback()
+                self._rollback()
                 raise
 
             self.add_log_record(ct, "ConditionType created with name='{}', type='{}'"
@@ -506,6 +950,10 @@ class RCDBProvider(object):
             1. It value is the same the func does nothing
             2. If value is different than in DB, function check 'replace' flag and do accordingly
 
+        If replace=True and DB has the unique (run_number, condition_type_id) key (see 'rcdb db unique-conditions'),
+        values are written by one INSERT ... ON DUPLICATE KEY UPDATE (MySQL) or INSERT ... ON CONFLICT (SQLite)
+        statement per value field, without reading existing values first. It is safe for concurrent writers
+
         Example:
             db.add_condition(1, "event_count", 1000)                  # Ok. First addition to DB
             db.add_condition(1, "event_count", 1000)                  # Ok. Do nothing, such value already exists
@@ -570,6 +1018,12 @@ class RCDBProvider(object):
             value = ct.convert_value(value)
             values_by_ct[ct] = value
 
+        # Fast path. Values are replaced anyway, so DB decides what to insert and what to update
+        # without reading existing values first
+        if replace and values_by_ct and self._can_upsert_conditions():
+            written = self._upsert_conditions(run, values_by_ct)
+            return list(written.values()) + [ct for ct in values_by_ct if ct not in written]
+
         # 2. Check which conditions are in the database
         add_list = []  # List of conditions to be added for the first time for the run
         ignore_list = []  # List of conditions that are exist and values are the same as DB
@@ -636,6 +1090,7 @@ class RCDBProvider(object):
                     db_condition.value = values_by_ct[ct]
                     db_condition.created = datetime.datetime.now()
                     result.append(db_condition)
+            self._discard_json_values([c.id for c in result if c.type.get_value_field_name() == "text_value"])
 
         # 4. Add values
         with self.session.no_autoflush:
@@ -649,10 +1104,263 @@ class RCDBProvider(object):
                 result.append(condition)
 
         # 5. Commit changes
-        self.session.commit()
+        self._commit()
 
         return result + ignore_list
 
+    def add_conditions_bulk(self, rows, replace=False, chunk_size=None):
+        """Adds condition values for many runs
+
+        Rows are processed by chunks. For each chunk existing values are read by one query, then new values
+        are inserted and changed values are updated by executemany in one transaction.
+        As in add_conditions, a value which is the same as in DB is ignored and a different value
+        raises OverrideConditionValueError unless replace=True. If an error is raised, the chunk
+        is not written, while previous chunks are already committed
+
+        Example:
+            db.add_conditions_bulk([(1000, "event_count", 10), (1001, "event_count", 20)])
+
+        :param rows: iterable of (run, key, value) tuples. run - run number or Run, key - condition name or ConditionType
+        :param replace: If true, function replaces existing values
+        :type replace: bool
+        :param chunk_size: number of rows in a chunk. BULK_CHUNK_SIZE by default
+        :type chunk_size: int
+        :return: (added count, updated count, ignored count)
+        :rtype: (int, int, int)
+        """
+        chunk_size = chunk_size or BULK_CHUNK_SIZE
+        ct_dict = self.get_condition_types_by_name()
+
+        added_count = updated_count = ignored_count = 0
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+
+            # 1. Validate and convert values
+            values = {}     # (run_number, ConditionType) => converted value
+            for run, key, value in chunk:
+                run_number = run.number if isinstance(run, Run) else int(run)
+                ct = key if isinstance(key, ConditionType) else ct_dict[key]
+                value = ct.convert_value(value)
+                if (run_number, ct) in values:
+                    if ct.values_are_equal(value, values[(run_number, ct)]):
+                        continue
+                    message = "add_conditions_bulk rows contain several different values for '{}' of run {}" \
+                        .format(ct.name, run_number)
+                    raise KeyError(message)
+                values[(run_number, ct)] = value
+
+            try:
+                added, updated, ignored = self._write_conditions_chunk(values, replace)
+                self._commit()
+            except:
+                self._rollback()
+                raise
+            added_count += added
+            updated_count += updated
+            ignored_count += ignored
+
+        return added_count, updated_count, ignored_count
+
+    def _write_conditions_chunk(self, values, replace):
+        """Compares values with DB by one query and writes new and changed values. Doesn't commit
+
+        :param values: {(run_number, ConditionType): converted value}
+        :return: (added count, updated count, ignored count)
+        """
+        connection = self.session.connection()
+        table = Condition.__table__
+        run_numbers = sorted({run_number for run_number, _ in values})
+        type_ids = sorted({ct.id for _, ct in values})
+
+        # Runs must exist
+        existing_runs = {number for number, in connection.execute(
+            select(Run.number).where(Run.number.in_(run_numbers)))}
+        missing_runs = [run_number for run_number in run_numbers if run_number not in existing_runs]
+        if missing_runs:
+            message = "No run with run_number='{}' found".format(missing_runs[0])
+            raise NoRunFoundError(message)
+
+        # Existing values. If DB has duplicated values, the first one is used
+        existing = {}
+        query = select(table.c.id, table.c.run_number, table.c.condition_type_id, table.c.int_value,
+                       table.c.float_value, table.c.bool_value, table.c.text_value, table.c.time_value) \
+            .where(table.c.run_number.in_(run_numbers)) \
+            .where(table.c.condition_type_id.in_(type_ids)) \
+            .order_by(table.c.id.desc())
+        for row in connection.execute(query):
+            existing[(row.run_number, row.condition_type_id)] = row
+
+        inserts_by_field = {}
+        updates_by_field = {}
+        ignored = 0
+        created = datetime.datetime.now()
+        for (run_number, ct), value in values.items():
+            field = ct.get_value_field_name()
+            db_row = existing.get((run_number, ct.id))
+            if db_row is None:
+                inserts_by_field.setdefault(field, []).append(
+                    {"run_number": run_number, "condition_type_id": ct.id, field: value, "created": created})
+                continue
+
+            db_value = getattr(db_row, field)
+            if ct.value_type == ConditionType.FLOAT_FIELD:
+                value_is_differ = abs(db_value - value) >= 1e-12
+            else:
+                value_is_differ = db_value != value
+            if not value_is_differ:
+                ignored += 1
+                continue
+
+            if not replace:
+                message = "Conditions {} already exists for the run_number='{}' " \
+                          "but the values are different. DB saved value='{}', new value='{}'. " \
+                          "(Add replace=True if you want to replace the old value)" \
+                    .format(ct.name, run_number, db_value, value)
+                raise OverrideConditionValueError(message)
+            updates_by_field.setdefault(field, []).append(
+                {"condition_id": db_row.id, "value": value, "new_created": created})
+
+        for field, rows in inserts_by_field.items():
+            connection.execute(table.insert(), rows)
+        for field, rows in updates_by_field.items():
+            statement = update(table).where(table.c.id == bindparam("condition_id"))\
+                .values({field: bindparam("value"), "created": bindparam("new_created")})
+            connection.execute(statement, rows)
+        self._discard_json_values([row["condition_id"] for row in updates_by_field.get("text_value", [])])
+
+        added = sum(len(rows) for rows in inserts_by_field.values())
+        updated = sum(len(rows) for rows in updates_by_field.values())
+        return added, updated, ignored
+
+    def _discard_json_values(self, condition_ids):
+        """Removes parsed values of replaced conditions from json_value_cache. Replaced values keep
+        their ids and the new created time may be the same as the old one with DATETIME precision"""
+        if condition_ids:
+            scope = self.session.info[JSON_CACHE_SCOPE_KEY]
+            json_value_cache.discard((scope, condition_id) for condition_id in condition_ids)
+
+    def _can_upsert_conditions(self):
+        """True if DB supports upserts and has the unique (run_number, condition_type_id) key of conditions"""
+        if self._conditions_unique_key is None:
+            dialect = self.engine.dialect
+            if dialect.name == "sqlite" and dialect.dbapi.sqlite_version_info < (3, 24, 0):
+                self._conditions_unique_key = False     # no ON CONFLICT in older SQLite
+            elif dialect.name not in ("mysql", "sqlite"):
+                self._conditions_unique_key = False
+            else:
+                inspector = sqlalchemy.inspect(self.session.connection())
+                table_name = Condition.__tablename__
+                keys = [index["column_names"] for index in inspector.get_indexes(table_name) if index["unique"]]
+                keys += [constraint["column_names"] for constraint in inspector.get_unique_constraints(table_name)]
+                self._conditions_unique_key = any(set(columns) == {"run_number", "condition_type_id"}
+                                                  for columns in keys)
+        return self._conditions_unique_key
+
+    def _upsert_conditions(self, run, values_by_ct):
+        """Inserts or replaces values of conditions by one statement per value column. Values which are
+        the same as in DB are not touched
+
+        With RETURNING (SQLite 3.35+) the statements tell which values they wrote. MySQL has no RETURNING
+        for ON DUPLICATE KEY UPDATE, so written values are found by one more query as the ones with
+        the creation time of this call. Conditions of the written values, which are already in the session,
+        are updated in place, others are added to the session without loading them
+
+        :param run: Run
+        :param values_by_ct: {ConditionType: converted value}
+        :return: {ConditionType: Condition} of inserted and replaced values
+        :rtype: dict
+        """
+        table = Condition.__table__
+        dialect = self.engine.dialect
+        use_returning = dialect.name == "sqlite" and dialect.dbapi.sqlite_version_info >= (3, 35, 0)
+        created = datetime.datetime.now()
+        if not use_returning:
+            created = created.replace(microsecond=0)    # to find values by created time with DATETIME precision
+
+        rows_by_field = {}
+        for ct, value in values_by_ct.items():
+            field = ct.get_value_field_name()
+            rows_by_field.setdefault(field, []).append({"run_number": run.number,
+                                                        "condition_type_id": ct.id,
+                                                        field: value,
+                                                        "created": created})
+        written_ids = {}    # condition type id => condition id
+        connection = self.session.connection()
+        try:
+            for field, rows in rows_by_field.items():
+                statement = self._get_upsert_statement(field)
+                if use_returning:
+                    statement = statement.returning(table.c.id, table.c.condition_type_id)
+                    written_ids.update((type_id, condition_id)
+                                       for condition_id, type_id in connection.execute(statement, rows))
+                else:
+                    connection.execute(statement, rows)
+            if not use_returning:
+                query = select(table.c.id, table.c.condition_type_id) \
+                    .where(table.c.run_number == run.number,
+                           table.c.condition_type_id.in_([ct.id for ct in values_by_ct]),
+                           table.c.created == created)
+                written_ids = {type_id: condition_id for condition_id, type_id in connection.execute(query)}
+            self._commit()
+        except:
+            self._rollback()
+            raise
+
+        written = {}
+        for ct, value in values_by_ct.items():
+            condition_id = written_ids.get(ct.id)
+            if condition_id is None:
+                continue    # the same value is in DB
+            condition = self.session.identity_map.get(sqlalchemy.orm.util.identity_key(Condition, condition_id))
+            if condition is None:
+                condition = Condition()
+                condition.id = condition_id
+                condition.run_number = run.number
+                condition.condition_type_id = ct.id
+                sqlalchemy.orm.make_transient_to_detached(condition)
+                self.session.add(condition)
+            sqlalchemy.orm.attributes.set_committed_value(condition, ct.get_value_field_name(), value)
+            sqlalchemy.orm.attributes.set_committed_value(condition, "created", created)
+            written[ct] = condition
+
+        if written:
+            self.session.expire(run, ['conditions'])
+            self._discard_json_values([condition.id for ct, condition in written.items()
+                                       if ct.get_value_field_name() == "text_value"])
+        return written
+
+    def _get_upsert_statement(self, field):
+        """INSERT of a condition value which updates the value of an existing condition instead
+
+        :param field: value field name: 'int_value', 'text_value', ...
+        """
+        table = Condition.__table__
+        column = table.c[field]
+        if self.engine.dialect.name == "mysql":
+            statement = mysql_insert(table)
+            new_value = statement.inserted[field]
+        else:
+            statement = sqlite_insert(table)
+            new_value = statement.excluded[field]
+
+        if field == "float_value":
+            is_same = func.abs(column - new_value) < 1e-12    # the same precision as add_conditions uses
+        else:
+            is_same = column.is_not_distinct_from(new_value)
+
+        if self.engine.dialect.name == "mysql":
+            # MySQL assigns columns in order, so 'created' is compared with the old value
+            return statement.on_duplicate_key_update([
+                ("created", case((is_same, table.c.created), else_=statement.inserted.created)),
+                (field, case((is_same, column), else_=new_value))])
+
+        return statement.on_conflict_do_update(index_elements=["run_number", "condition_type_id"],
+                                               set_={field: new_value, "created": statement.excluded.created},
+                                               where=~is_same)
+
     # ------------------------------------------------
     # Gets condition
     # ------------------------------------------------
@@ -686,6 +1394,66 @@ class RCDBProvider(object):
 
         return query.first()
 
+    def get_parsed_values(self, key, run_min=0, run_max=sys.maxsize, runs=None):
+        """Returns parsed JSON values of a condition for many runs at once
+
+        Values are parsed once and cached like Condition.parsed_value. Texts of values, which are already
+        parsed (the same id, created time and text length), are not read from DB.
+        Runs without the condition are not in the result
+
+        :param key: Condition name or ConditionType object of JSON or BLOB type
+        :type key: str or ConditionType
+        :param run_min: minimum run
+        :param run_max: maximum run
+        :param runs: list of runs. In this case run_min and run_max are not used
+        :return: {run number: parsed value}
+        :rtype: dict
+        """
+        ct = key if isinstance(key, ConditionType) else self.get_condition_type(str(key))
+        if ct.value_type not in (ConditionType.JSON_FIELD, ConditionType.BLOB_FIELD):
+            raise ValueError("Condition '{}' is of type '{}'. Only JSON and BLOB values can be parsed"
+                             .format(ct.name, ct.value_type))
+
+        # LENGTH() of MySQL counts bytes, while cached values are checked by length in characters
+        text_length = func.char_length if self.engine.dialect.name == "mysql" else func.length
+        query = select(Condition.run_number, Condition.id, Condition.created, text_length(Condition.text_value)) \
+            .where(Condition.condition_type_id == ct.id) \
+            .order_by(Condition.id)
+        if runs is None:
+            queries = [query.where(Condition.run_number.between(run_min, run_max))]
+        else:
+            run_numbers = sorted({int(run) for run in runs})
+            queries = [query.where(Condition.run_number.in_(run_numbers[i:i + RUNS_BIND_CHUNK_SIZE]))
+                       for i in range(0, len(run_numbers), RUNS_BIND_CHUNK_SIZE)]
+
+        scope = self.session.info[JSON_CACHE_SCOPE_KEY]
+        result = {}
+        keys_by_id = {}
+        seen_runs = set()
+        missing = object()
+        for chunk_query in queries:
+            for run_number, condition_id, created, length in self.session.execute(chunk_query):
+                if run_number in seen_runs:
+                    continue        # Duplicated values of old DBs. The first one is used
+                seen_runs.add(run_number)
+                value = json_value_cache.get((scope, condition_id), missing, (created, length))
+                if value is missing:
+                    keys_by_id[condition_id] = (run_number, created)
+                else:
+                    result[run_number] = value
+
+        # Parse values, which are not cached
+        ids = list(keys_by_id)
+        for i in range(0, len(ids), RUNS_BIND_CHUNK_SIZE):
+            text_query = select(Condition.id, Condition.text_value) \
+                .where(Condition.id.in_(ids[i:i + RUNS_BIND_CHUNK_SIZE]))
+            for condition_id, text_value in self.session.execute(text_query):
+                run_number, created = keys_by_id[condition_id]
+                version = (created, len(text_value)) if text_value is not None else None
+                result[run_number] = json_value_cache.parse(text_value, (scope, condition_id), version)
+
+        return dict(sorted(result.items()))
+
     # ------------------------------------------------
     # Gets file
     # ------------------------------------------------
@@ -733,7 +1501,7 @@ class RCDBProvider(object):
         log.debug(Lf("Setting start time '{}' to run '{}'", dtm, run.number))
 
         run.start_time = dtm
-        self.session.commit()
+        self._commit()
 
     # ------------------------------------------------
     # Adds end time
@@ -750,7 +1518,7 @@ class RCDBProvider(object):
 
         log.debug(Lf("Setting end time '{}' to run '{}'", dtm, run.number))
         run.end_time = dtm
-        self.session.commit()
+        self._commit()
 
     # ------------------------------------------------
     #
@@ -761,21 +1529,17 @@ class RCDBProvider(object):
         :param overwrite: If this flag is true, such file for this run exists but checksumm is different,
                           file content will be overwritten
         :param content: Content of a file. If not given, func tryes to open file by path.
+                        It is compressed if file_compression is set
         :param path: Path of the file
         :param run: Run number
         """
 
-        def get_content():
-            if content:
-                return content
-            with open(path) as io_file:
-                return io_file.read()
-
         log.debug("Processing configuration file")
 
+        # The file is read and hashed in one pass. The hash is of the same bytes, which are stored
         if content is None:
             log.debug(Lf("|- Content is not provided as func param, reading from FS '{}'", path))
-            check_sum = rcdb.file_archiver.get_file_sha256(path)
+            content, check_sum = rcdb.file_archiver.read_file_with_sha256(path)
         else:
             log.debug(Lf("|- Content is NOT none, using it to put to DB", path))
             check_sum = rcdb.file_archiver.get_string_sha256(content)
@@ -786,28 +1550,29 @@ class RCDBProvider(object):
         if overwrite:
             # If we have to potentially overwrite the file, we have to apply another logic
             # First, we look at file with this name in this run
-            query = self.session.query(ConfigurationFile) \
+            conf_file = self.session.query(ConfigurationFile) \
                 .filter(ConfigurationFile.runs.contains(run)) \
                 .filter(ConfigurationFile.path == path) \
-                .order_by(desc(ConfigurationFile.id))  # we want latest
-            if query.count():
+                .order_by(desc(ConfigurationFile.id)) \
+                .first()  # we want latest
+            if conf_file is not None:
                 # There are file to overwrite!
-                conf_file = query.first()
                 conf_file.sha256 = check_sum
                 conf_file.path = path
-                conf_file.content = get_content()
+                conf_file.content = rcdb.file_archiver.compress_content(content, self.file_compression)
                 conf_file.importance = importance
                 log.debug(Lf("|- File '{}' is getting overwritten", path))
 
-                self.session.commit()
+                self._commit()
                 return conf_file
 
         # Overwrite = false or is not possible
         # Look, do we have a file with such name and checksumm?
-        file_query = self.session.query(ConfigurationFile) \
-            .filter(ConfigurationFile.sha256 == check_sum, ConfigurationFile.path == path)
+        conf_file = self.session.query(ConfigurationFile) \
+            .filter(ConfigurationFile.sha256 == check_sum, ConfigurationFile.path == path) \
+            .first()
 
-        if not file_query.count():
+        if conf_file is None:
             # no such file found!
             log.debug(Lf("|- File '{}' not found in DB", path))
 
@@ -815,36 +1580,33 @@ class RCDBProvider(object):
             conf_file = ConfigurationFile()
             conf_file.sha256 = check_sum
             conf_file.path = path
-            conf_file.content = get_content()
+            conf_file.content = rcdb.file_archiver.compress_content(content, self.file_compression)
             conf_file.importance = importance
 
-            # put it to DB and associate with run
+            # put it to DB, associate with run and save
             self.session.add(conf_file)
-            self.session.commit()
-
             conf_file.runs.append(run)
-
-            # save and exit
-            self.session.commit()
+            self._commit()
             self.add_log_record(conf_file, "File added to DB. Path: '{}'. Run: '{}'".format(path, run), run.number)
             return conf_file
 
-        # such file already exists! Get it from database
-        conf_file = file_query.first()
+        # such file already exists!
         log.debug(Lf("|- File '{}' found in DB by id: '{}'", path, conf_file.id))
 
         # maybe... we even have this file in run conf?
         if conf_file not in run.files:
             conf_file.runs.append(run)
             # run_conf.files.append(conf_file)
-            self.session.commit()  # save and exit
+            self._commit()  # save and exit
             self.add_log_record(conf_file, "File associated. Path: '{}'. Run: '{}'".format(path, run), run.number)
         else:
             log.debug(Lf("|- File already associated with run'{}'", run))
 
         return conf_file
 
-
+    # ------------------------------------------------
+    # Search
+    # ------------------------------------------------
     def select_runs(self, search_str="", run_min=0, run_max=sys.maxsize, sort_desc=False):
         """ Obsolete. Searches RCDB for runs with e
 
@@ -881,59 +1643,20 @@ class RCDBProvider(object):
 
             return result
 
-        # get all condition types
-        all_cnt_types = self.get_condition_types()
-        all_cnd_types_by_name = {cnd.name: cnd for cnd in all_cnt_types}
-        all_cnd_names = [str(key) for key in all_cnd_types_by_name.keys()]
-
         # PHASE 1: getting what to search from search_str
+        cache_key = self._query_cache_key("select_runs", search_str)
+        prepared = self._query_cache.get(cache_key)
+        if prepared is None:
+            query_node, names = self._parse_search_query(search_str)
+            evaluator = compile_evaluator(query_node, {name: i for i, name in enumerate(names)})
+            prepared = (names, evaluator)
+            self._query_cache.put(cache_key, prepared)
+        names, evaluator = prepared
 
-        search_str = str(search_str)
-        if '__' in search_str:
-            raise QueryFormatError("Query contains restricted symbol: '__'")
-
-        for alias in self.aliases:
-            al_name = "@" + alias.name
-            if al_name in search_str:
-                search_str = search_str.replace(al_name, '(' + alias.expression + ')')
-
-        search_str = search_str.replace('\n', ' ')
-        search_str = search_str.replace('\r', ' ')
-
-        tokens = [token for token in lexer.tokenize(search_str)]
-
-        target_cnd_types = []
-        names = []
-        aliased_cnd_types = []
-        aliased_cnd = []
-        names_count = 0
-        for token in tokens:
-            if token.type in lexer.rcdb_query_restricted:
-                raise QueryFormatError("Query contains restricted symbol: '{}'".format(token.value))
-
-            if token.type != "NAME":
-                continue
-
-            if token.value == 'math':
-                continue
-
-            if token.value == 'startswith':
-                continue
-
-            if token.value not in all_cnd_names:
-                message = "Name '{}' is not found in ConditionTypes".format(token.value)
-                raise QueryFormatError(message)
-            else:
-                cnd_name = token.value
-                cnd_type = all_cnd_types_by_name[token.value]
-                target_cnd_types.append(cnd_type)
-
-                token.value = "value[{}].value".format(names_count)
-                names_count += 1
-
-                names.append(cnd_name)
-                aliased_cnd.append(aliased(Condition))
-                aliased_cnd_types.append(aliased(ConditionType))
+        all_cnd_types_by_name = self.get_condition_types_by_name()
+        target_cnd_types = [all_cnd_types_by_name[name] for name in names]
+        aliased_cnd = [aliased(Condition) for _ in names]
+        names_count = len(names)
 
         # PHASE 2: Database query
         query = self.session.query()
@@ -941,8 +1664,6 @@ class RCDBProvider(object):
         if not names_count:
             return None
 
-        search_eval = " ".join([token.value for token in tokens if isinstance(token, LexToken)])
-
         for (i, alias_cnd) in enumerate(aliased_cnd):
             query = query.add_entity(alias_cnd).filter(alias_cnd.condition_type_id == target_cnd_types[i].id)
             if i != 0:
@@ -967,22 +1688,23 @@ class RCDBProvider(object):
         selection_sw = StopWatchTimer()
 
         # PHASE 3: Selecting runs
-        compiled_search_eval = compile(search_eval, '<string>', 'eval')
-
         sel_runs = []
 
         for value in values:
             if isinstance(value, Condition):
                 value = (value,)
             run = value[0].run
+            cnd_values = [condition.value for condition in value]
             try:
-                if eval(compiled_search_eval):
+                if evaluator(cnd_values):
                     sel_runs.append(run)
+            except NoneValueError:
+                continue
             except Exception as ex:
                 message = 'Error evaluating search query.\n' \
-                          + '  Query: <<"{}">>, \n'.format(search_eval) \
+                          + '  Query: <<"{}">>, \n'.format(search_str) \
                           + '  Names: {}, \n'.format(names) \
-                          + '  Values: {} \n'.format(values) \
+                          + '  Values: {} \n'.format(cnd_values) \
                           + '  Error ({}): {}'.format(type(ex), ex)
                 raise QueryEvaluationError(msg=message)
 
@@ -998,8 +1720,140 @@ class RCDBProvider(object):
 
         return result
 
+    def enable_result_cache(self, max_entries=64, max_cells=1000000):
+        """Enables caching of select_values results
+
+        Before each select_values call a tiny query gets the database watermark: max ids of runs, conditions,
+        condition types and log records and the last condition creation time. All of them are read from indexes.
+        While the watermark is the same, the same select_values call returns the cached rows without querying
+        conditions. Any added run or condition, replaced condition value or added log record drops all cached
+        results.
+
+        Deleted rows don't change the maximums. Code which deletes runs or conditions adds a log record
+        ('rcdb db unique-conditions' does), and the new log id changes the watermark. The watermark also can't
+        see a replaced value if its new creation time equals the current MAX(created). MySQL DATETIME has
+        seconds precision, so this happens when the value is replaced within the same second as the last change.
+        Don't enable the cache where such writes happen while results are read.
+
+        :param max_entries: maximum number of cached results
+        :type max_entries: int
+        :param max_cells: maximum total number of values (rows * columns) in all cached results
+        :type max_cells: int
+        """
+        self.result_cache = ResultCache(max_entries, max_cells)
+
+    def disable_result_cache(self):
+        """Disables caching of select_values results"""
+        self.result_cache = None
+
+    def enable_statistics(self):
+        """Enables planning of select_values queries by condition values statistics
+
+        Statistics of a condition type (see get_condition_statistics) are collected when it is first used
+        in a query and kept until refresh_statistics is called. They are used to join and evaluate the most
+        selective conditions first. Without statistics the query planner only turns joins of conditions,
+        which must be set for a run to be selected, to INNER JOINs
+        """
+        self._condition_statistics = {}
+        self._query_cache.clear()
+
+    def disable_statistics(self):
+        """Disables planning of select_values queries by condition values statistics"""
+        self._condition_statistics = None
+        self._query_cache.clear()
+
+    def refresh_statistics(self):
+        """Drops collected statistics, so they are collected again from the current DB"""
+        if self._condition_statistics is not None:
+            self._condition_statistics = {}
+        self._query_cache.clear()
+
+    def get_condition_statistics(self, condition_type):
+        """Statistics of condition values of one type: number of runs with values, min, max and number of
+        distinct values
+
+        :param condition_type: condition type or its name
+        :type condition_type: ConditionType | str
+        :rtype: rcdb.query_planner.ConditionStatistics
+        """
+        if not isinstance(condition_type, ConditionType):
+            condition_type = self.get_condition_type(str(condition_type))
+
+        if self._condition_statistics is not None and condition_type.id in self._condition_statistics:
+            return self._condition_statistics[condition_type.id]
+
+        sql = text("SELECT COUNT(DISTINCT run_number), MIN({0}), MAX({0}), COUNT(DISTINCT {0}), "
+                   "(SELECT COUNT(*) FROM runs) "
+                   "FROM conditions WHERE condition_type_id = :type_id"
+                   .format(condition_type.get_value_field_name()))
+        count, min_value, max_value, distinct_count, run_count = \
+            self.session.connection().execute(sql, {"type_id": condition_type.id}).fetchone()
+        statistics = query_planner.ConditionStatistics(condition_type.name, count, min_value, max_value,
+                                                       distinct_count, run_count)
+        if self._condition_statistics is not None:
+            self._condition_statistics[condition_type.id] = statistics
+        return statistics
+
+    def _get_planner_statistics(self, condition_types):
+        """Statistics of the condition types for the query planner if statistics are enabled"""
+        if self._condition_statistics is None:
+            return {}
+        return {ct.name: self.get_condition_statistics(ct) for ct in condition_types}
+
+    def enable_lazy_text_values(self):
+        """Conditions of JSON and BLOB types load text_value on first access
+
+        Run.conditions and condition queries load values of other types as usual. Large JSON values
+        such as component_stats are not read, until .value or .text_value of such a condition is used
+        """
+        self._lazy_text_values = True
+
+    def disable_lazy_text_values(self):
+        """Conditions load text_value of all types at once (the default)"""
+        self._lazy_text_values = False
+        if self.session is not None:
+            self.session.info.pop(_LAZY_TEXT_TYPE_IDS_KEY, None)
+
+    def _on_orm_execute(self, orm_execute_state):
+        """Session event. Defers conditions.text_value in queries of Condition and Run, if lazy text values
+        are enabled. text_value of types which are not JSON or BLOB is loaded as loaded_text_value and set
+        by _set_loaded_text_value"""
+        if not self._lazy_text_values or not orm_execute_state.is_select or orm_execute_state.is_column_load:
+            return
+
+        statement = orm_execute_state.statement
+        entities = {description.get("entity") for description in statement.column_descriptions}
+        if Condition not in entities and Run not in entities:
+            return
+
+        large_type_ids = [ct.id for ct in self.get_condition_types()
+                          if ct.value_type in (ConditionType.JSON_FIELD, ConditionType.BLOB_FIELD)]
+        self.session.info[_LAZY_TEXT_TYPE_IDS_KEY] = set(large_type_ids)
+        if not large_type_ids:
+            return
+
+        loaded_text = case((Condition.condition_type_id.in_(large_type_ids), None), else_=Condition.text_value)
+        options = (sqlalchemy.orm.defer(Condition.text_value),
+                   sqlalchemy.orm.with_expression(Condition.loaded_text_value, loaded_text))
+        if Condition in entities:
+            statement = statement.options(*options)
+        if Run in entities:
+            statement = statement.options(sqlalchemy.orm.defaultload(Run.conditions).options(*options))
+        orm_execute_state.statement = statement
+
+    def _get_db_watermark(self):
+        """Returns a tuple of values which changes if runs or conditions in DB are added or changed.
+        Deletes are seen through log records, see enable_result_cache"""
+        sql = text("SELECT (SELECT MAX(number) FROM runs), "
+                   "(SELECT MAX(id) FROM conditions), "
+                   "(SELECT MAX(created) FROM conditions), "
+                   "(SELECT MAX(id) FROM condition_types), "
+                   "(SELECT MAX(id) FROM logs)")
+        return tuple(self.session.connection().execute(sql).fetchone())
+
     def select_values(self, val_names=None, search_str="", run_min=0, run_max=sys.maxsize, sort_desc=False,
-                      insert_run_number=True, runs=None):
+                      insert_run_number=True, runs=None, vectorize=None, join_strategy=None, columnar=False,
+                      shards=None, max_workers=None):
         """ Searches RCDB for runs with e
         
         :param val_names: list of conditions names to select
@@ -1010,6 +1864,24 @@ class RCDBProvider(object):
         :param insert_run_number: If True the first column of the result will be a run number
         :param search_str: Search pattern
         :type search_str: str
+        :param vectorize: Evaluate the query over NumPy arrays instead of row by row. None - automatically
+                          if NumPy is installed and there are many rows. False - never. The row evaluator is
+                          used anyway if the query can't be vectorized
+        :type vectorize: bool or None
+        :param join_strategy: How values are selected from DB. "joins" - a join of conditions table per
+                              condition type, "pivot" - one scan of conditions table grouped by run.
+                              None - chosen automatically by number of conditions and runs
+        :type join_strategy: str or None
+        :param columnar: Store result values by columns in typed NumPy arrays instead of a list of lists.
+                         Rows are still available as a lazy view. Requires NumPy
+        :type columnar: bool
+        :param shards: Split [run_min, run_max] to shards, which are queried in parallel on separate pooled
+                       connections. int - number of equal blocks of run numbers, "run_periods" - by RunPeriod
+                       boundaries. Not used with a list of runs. With in-memory SQLite shards are queried
+                       one by one
+        :type shards: int or str or None
+        :param max_workers: Maximum number of shards queried at once. Default is min(shards, SHARDS_MAX_WORKERS)
+        :type max_workers: int or None
         :return: List of runs matching criteria
         :rtype: RcdbSelectionResult
         """
@@ -1020,184 +1892,540 @@ class RCDBProvider(object):
         if run_min > run_max:
             run_min, run_max = run_max, run_min
 
-        # get all condition types
-        all_cnd_types_by_name = self.get_condition_types_by_name()
-        all_cnd_names = [str(key) for key in all_cnd_types_by_name.keys()]
+        # Check if val_names are given
+        if not val_names:
+            val_names = []
 
-        # PHASE 1: getting what to search from search_str
+        # PHASE 1: getting what to search from search_str. Prepared queries are cached
+        cache_key, plan, query_cache = self._get_select_values_plan(val_names, search_str)
+        names = plan.names
+        pushdown = plan.pushdown
+        selected_conditions = ['run'] + val_names if insert_run_number else [] + val_names
+        selected_value_types = [ConditionType.INT_FIELD if name == "run" else plan.value_types[name]
+                                for name in val_names]
+        if insert_run_number:
+            selected_value_types.insert(0, ConditionType.INT_FIELD)
 
-        search_str = str(search_str)
-        if '__' in search_str:
-            raise QueryFormatError("Query contains restricted symbol: '__'")
+        if runs:
+            runs = [run.number if isinstance(run, Run) else int(run) for run in runs]
 
-        for alias in self.aliases:
-            al_name = "@" + alias.name
-            if al_name in search_str:
-                search_str = search_str.replace(al_name, '(' + alias.expression + ')')
+        # Maybe the result is cached and DB hasn't changed since then?
+        result_cache_key = None
+        if self.result_cache is not None:
+            self.result_cache.validate(self._get_db_watermark())
+            result_cache_key = (cache_key, tuple(runs) if runs else (run_min, run_max), sort_desc, insert_run_number,
+                                columnar)
+            cached = self.result_cache.get(result_cache_key)
+            if cached is not None:
+                preparation_sw.stop()
+                total_sw.stop()
+                if columnar:
+                    result = RcdbSelectionResult(db=self, table=cached.copy())
+                else:
+                    result = RcdbSelectionResult([list(row) for row in cached], self)
+                result.filter_condition_names = names
+                result.filter_condition_types = plan.target_cnd_types
+                result.sort_desc = sort_desc
+                result.selected_conditions = selected_conditions
+                result.selected_value_types = selected_value_types
+                result.performance["preparation"] = preparation_sw.elapsed
+                result.performance["start_time_stamp"] = start_time_stamp
+                result.performance["total"] = total_sw.elapsed
+                result.performance["evaluation"] = "cache"
+                result.performance["query_cache"] = query_cache
+                result.performance["plan"] = None
+                self._add_result_cache_performance(result, "hit")
+                return result
 
-        search_str = search_str.replace('\n', ' ')
-        search_str = search_str.replace('\r', ' ')
+        preparation_sw.stop()
+        query_sw = StopWatchTimer()
 
-        tokens = [token for token in lexer.tokenize(search_str)]
+        # PHASE 2: Database query
+        join_strategy = join_strategy or self._choose_join_strategy(plan, runs, run_min, run_max)
+        shard_count = 0
+        if shards and not runs:
+            shard_ranges = self._get_shard_ranges(shards, run_min, run_max)
+            shard_count = len(shard_ranges)
+            runs_strategy = "range"
+            results = self._execute_shards(plan, join_strategy, shard_ranges, sort_desc, max_workers)
+        else:
+            runs_strategy, results = self._execute_select_values(plan, join_strategy, runs, run_min, run_max,
+                                                                 sort_desc)
+        rows = [row for result in results for row in result]
 
-        target_cnd_types = []
-        names = ["run"]
-        for token in tokens:
-            if token.type in lexer.rcdb_query_restricted:
-                raise QueryFormatError("Query contains restricted symbol: '{}'".format(token.value))
+        query_sw.stop()
 
-            if token.type != "NAME":
-                continue
 
-            if token.value == 'math':
-                continue
+        selection_sw = StopWatchTimer()
 
-            if token.value == 'startswith':
-                continue
+        # PHASE 3: Selecting runs
+        # Only the part of the query that is not fully done by SQL is evaluated in python
+        evaluation = "sql"
+        selected_rows = rows
+        if pushdown.python_node is not None:
+            selected_rows, evaluation = self._evaluate_rows(plan, rows, vectorize, search_str)
+
+        value_indexes = [0] + plan.val_indexes if insert_run_number else plan.val_indexes
+        if columnar:
+            table = ColumnarTable.from_rows(selected_rows, selected_conditions, selected_value_types, value_indexes)
+            result = RcdbSelectionResult(db=self, table=table)
+        else:
+            result_table = [[values[i] for i in value_indexes] for values in selected_rows]
+            result = RcdbSelectionResult(result_table, self)
 
-            if token.value not in all_cnd_names:
-                message = "Name '{}' is not found in ConditionTypes".format(token.value)
-                raise QueryFormatError(message)
+        selection_sw.stop()
+        total_sw.stop()
+        result.filter_condition_names = names
+        result.filter_condition_types = plan.target_cnd_types
+        result.sort_desc = sort_desc
+        result.selected_conditions = selected_conditions
+        result.selected_value_types = selected_value_types
+        result.performance["preparation"] = preparation_sw.elapsed
+        result.performance["query"] = query_sw.elapsed
+        result.performance["selection"] = selection_sw.elapsed
+        result.performance["start_time_stamp"] = start_time_stamp
+        result.performance["total"] = total_sw.elapsed
+        result.performance["evaluation"] = evaluation
+        result.performance["query_cache"] = query_cache
+        result.performance["runs_strategy"] = runs_strategy
+        result.performance["join_strategy"] = join_strategy
+        result.performance["shards"] = shard_count
+        result.performance["plan"] = plan.describe(join_strategy)
+
+        if result_cache_key is not None:
+            if columnar:
+                self.result_cache.put(result_cache_key, table.copy(), len(table) * len(selected_conditions))
             else:
-                cnd_name = token.value
-                if cnd_name not in names:
-                    cnd_type = all_cnd_types_by_name[token.value]
-                    isinstance(cnd_type, ConditionType)
+                self.result_cache.put(result_cache_key, [tuple(row) for row in result_table])
+            self._add_result_cache_performance(result, "miss")
+        else:
+            result.performance["result_cache"] = "off"
 
-                    target_cnd_types.append(cnd_type)
+        return result
 
-                    token.value = "values[{}]".format(len(names))
-                    names.append(cnd_name)
-                else:
-                    # we already has such name. We have to set token.value right
-                    token.value = "values[{}]".format(names.index(cnd_name))  # +1 because run_num is alwais 0
+    def _add_result_cache_performance(self, result, status):
+        """Adds result cache hit/miss status and statistics to result.performance"""
+        result.performance["result_cache"] = status
+        result.performance["result_cache_hits"] = self.result_cache.hits
+        result.performance["result_cache_misses"] = self.result_cache.misses
+        result.performance["result_cache_entries"] = len(self.result_cache)
 
-        # result values table
-        val_indexes = []
+    def iter_values(self, val_names=None, search_str="", run_min=0, run_max=sys.maxsize, sort_desc=False,
+                    insert_run_number=True, runs=None, vectorize=None, join_strategy=None, yield_per=1000):
+        """ Same as select_values, but returns a generator of result rows instead of the whole result table
 
-        # Check if val_names are given
-        if not val_names:
-            val_names = []
+        Rows are fetched from DB with a server side cursor (where the DB driver supports it) by chunks
+        of yield_per rows. The chunks are evaluated and yielded one by one, so memory doesn't grow with
+        the number of selected runs. The DB connection is busy while the generator is not exhausted or closed,
+        so don't make other queries through this provider in between
 
-        for name in val_names:
-            if name in names:
-                val_indexes.append(names.index(name))
-            else:
-                cnd_type = all_cnd_types_by_name[name]
-                target_cnd_types.append(cnd_type)
-                val_indexes.append(len(names))
-                names.append(name)
+        Example:
+            for run_number, event_count in db.iter_values(['event_count'], "@is_production"):
+                print(run_number, event_count)
 
-        # PHASE 2: Database query
-        query = self.session.query()
+        :param val_names: list of conditions names to select
+        :param search_str: Search pattern
+        :type search_str: str
+        :param run_min: minimum run to search
+        :param run_max: maximum run to search
+        :param sort_desc: if True result runs will by sorted descendant by run_number, ascendant if False
+        :param insert_run_number: If True the first column of the result will be a run number
+        :param runs: May be a list of runs to search from. In this case run_min and run_max are not used
+        :param vectorize: see select_values. Applies to each chunk of rows
+        :param join_strategy: see select_values
+        :param yield_per: number of rows fetched from DB at once
+        :type yield_per: int
+        :return: generator of result rows (lists)
+        """
+        if run_min > run_max:
+            run_min, run_max = run_max, run_min
+
+        if not val_names:
+            val_names = []
 
-        # do we have a list of runs?
+        # Query is prepared here, so errors in it are raised right away, not on the first iteration
+        _, plan, _ = self._get_select_values_plan(val_names, search_str)
         if runs:
             runs = [run.number if isinstance(run, Run) else int(run) for run in runs]
-            where_clause = " WHERE runs.number in ({})".format(','.join([str(run) for run in runs]))
-        else:
-            where_clause = " WHERE runs.number >= :run_min AND runs.number <=:run_max"
+        join_strategy = join_strategy or self._choose_join_strategy(plan, runs, run_min, run_max)
+        _, results = self._execute_select_values(plan, join_strategy, runs, run_min, run_max, sort_desc,
+                                                 {"stream_results": True, "yield_per": yield_per})
+        return self._iter_values_rows(plan, results, insert_run_number, vectorize, yield_per, search_str)
+
+    def _iter_values_rows(self, plan, results, insert_run_number, vectorize, yield_per, search_str):
+        """Generator behind iter_values"""
+        for result in results:
+            try:
+                for rows in result.partitions(yield_per):
+                    if plan.pushdown.python_node is not None:
+                        rows, _ = self._evaluate_rows(plan, rows, vectorize, search_str)
+                    for values in rows:
+                        result_row = [values[0]] if insert_run_number else []
+                        for i in plan.val_indexes:
+                            result_row.append(values[i])
+                        yield result_row
+            finally:
+                result.close()
+
+    def _execute_select_values(self, plan, join_strategy, runs, run_min, run_max, sort_desc,
+                               execution_options=None):
+        """Executes prepared select_values query for a run range or a list of runs
+
+        How a list of runs is passed to DB depends on its size:
+            "bind"       - one query with run numbers as bound parameters
+            "chunked"    - several such queries for chunks of RUNS_BIND_CHUNK_SIZE runs
+            "temp_table" - runs are loaded to a temporary table, which is used in one query
+                           (falls back to "chunked" if temporary tables can't be created)
+        Without a list of runs the strategy is "range"
+
+        :return: (strategy, iterator of query results). Queries for chunks are executed one by one while iterating
+        :rtype: (str, iterator)
+        """
+        connection = self.session.connection()
+        sql_params = dict(plan.get_pushdown(join_strategy).params)
 
-        # build query
-        query = "SELECT  runs.number run" + os.linesep
-        query_joins = " FROM runs " + os.linesep
-        for ct in target_cnd_types:
-            assert isinstance(ct, ConditionType)
-            table_name = ct.name + "_table"
-            value_str = "  ,{}.{} {}{}".format(table_name, ct.get_value_field_name(), ct.name, os.linesep)
-            if not value_str in query:
-                query += value_str  # safe for duplicate entries which trigger DB errors
+        if not runs:
+            sql_params.update({"run_min": run_min, "run_max": run_max})
+            sql = plan.get_statement(join_strategy, "range", sort_desc)
+            return "range", iter([connection.execute(sql, sql_params, execution_options=execution_options)])
 
-            # Now joins region
-            join_str = "  LEFT JOIN conditions {0} " \
-                       "  ON {0}.run_number = runs.number AND {0}.condition_type_id = {1}{2}" \
-                .format(table_name, ct.id, os.linesep)
+        runs = sorted(set(runs), reverse=sort_desc)
 
-            if join_str not in query_joins:
-                query_joins += join_str  # safe for duplicate entries which trigger DB errors
+        if len(runs) >= RUNS_TEMP_TABLE_MIN and self._load_temp_runs(runs):
+            sql_params.update({"run_min": min(runs), "run_max": max(runs)})
+            sql = plan.get_statement(join_strategy, "temp_table", sort_desc)
+            return "temp_table", iter([connection.execute(sql, sql_params, execution_options=execution_options)])
 
-        mighty_query = query + os.linesep \
-                       + query_joins + os.linesep \
-                       + where_clause
+        sql = plan.get_statement(join_strategy, "bind", sort_desc)
+        chunks = [runs[i:i + RUNS_BIND_CHUNK_SIZE] for i in range(0, len(runs), RUNS_BIND_CHUNK_SIZE)]
+        results = (connection.execute(sql, dict(sql_params, runs=chunk), execution_options=execution_options)
+                   for chunk in chunks)
+        return ("bind" if len(chunks) == 1 else "chunked"), results
 
-        if not sort_desc:
-            mighty_query = mighty_query + os.linesep + "ORDER BY runs.number"
+    def _get_shard_ranges(self, shards, run_min, run_max):
+        """Splits run range to shards
+
+        :param shards: number of equal blocks of run numbers or "run_periods" to split by RunPeriod boundaries
+        :return: list of (run_min, run_max) in ascending order, covering all runs of the range in DB
+        """
+        # Narrow down the range to runs which exist. run_max is often sys.maxsize
+        sql = text("SELECT MIN(number), MAX(number) FROM runs WHERE number >= :run_min AND number <= :run_max")
+        first_run, last_run = self.session.connection().execute(sql, {"run_min": run_min,
+                                                                      "run_max": run_max}).fetchone()
+        if first_run is None:
+            return [(run_min, run_max)]
+
+        if shards == "run_periods":
+            cuts = set()
+            for period in self.get_run_periods():
+                cuts.add(period.run_min)
+                cuts.add(period.run_max + 1)
+            starts = [first_run] + sorted(cut for cut in cuts if first_run < cut <= last_run)
         else:
-            mighty_query = mighty_query + os.linesep + "ORDER BY runs.number DESC"
+            shard_size = max(1, (last_run - first_run + 1 + int(shards) - 1) // int(shards))
+            starts = list(range(first_run, last_run + 1, shard_size))
 
-        preparation_sw.stop()
-        query_sw = StopWatchTimer()
+        ends = [start - 1 for start in starts[1:]] + [last_run]
+        return list(zip(starts, ends))
 
-        sql = text(mighty_query)
-        if runs:
-            result = self.session.connection().execute(sql)  # runs are already in query
-        else:
+    def _execute_shards(self, plan, join_strategy, shard_ranges, sort_desc, max_workers=None):
+        """Executes prepared select_values query for each shard of runs, in parallel if possible
 
-            #sql.bindparams(run_max=run_max, run_min=run_min)
-            #result = self.session.connection().execute(sql)
-            result = self.session.connection().execute(sql, {"run_min": run_min, "run_max":run_max})
+        :return: list of selected rows of each shard in the sort order
+        """
+        sql = plan.get_statement(join_strategy, "range", sort_desc)
+        params = plan.get_pushdown(join_strategy).params
+        if sort_desc:
+            shard_ranges = list(reversed(shard_ranges))
+        shard_params = [dict(params, run_min=shard_min, run_max=shard_max) for shard_min, shard_max in shard_ranges]
 
-        query_sw.stop()
+        max_workers = max_workers or min(len(shard_params), SHARDS_MAX_WORKERS)
+        if max_workers < 2 or len(shard_params) < 2 or not self._supports_concurrent_connections():
+            connection = self.session.connection()
+            return [connection.execute(sql, sql_params).fetchall() for sql_params in shard_params]
 
-        search_eval = " ".join([token.value for token in tokens if isinstance(token, LexToken)])
+        def fetch_shard(sql_params):
+            with self.engine.connect() as shard_connection:
+                return shard_connection.execute(sql, sql_params).fetchall()
 
-        selection_sw = StopWatchTimer()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(fetch_shard, shard_params))
 
-        # PHASE 3: Selecting runs
-        if search_eval:
-            # did user set search string at all?
-            compiled_search_eval = compile(search_eval, '<string>', 'eval')
+    def _supports_concurrent_connections(self):
+        """False if connections from the engine pool don't see the same DB (in-memory SQLite)"""
+        return self.engine.dialect.name != 'sqlite' or self.engine.url.database not in (None, '', ':memory:')
+
+    def _load_temp_runs(self, runs):
+        """Loads run numbers to rcdb_selected_runs temporary table. Returns False if it can't be done"""
+        connection = self.session.connection()
+        try:
+            connection.execute(text("CREATE TEMPORARY TABLE IF NOT EXISTS rcdb_selected_runs "
+                                    "(number INTEGER NOT NULL PRIMARY KEY)"))
+        except (OperationalError, ProgrammingError) as err:
+            log.debug(Lf("Can't create temporary table for runs, using chunked query. Error: {}", err))
+            return False
+        connection.execute(text("DELETE FROM rcdb_selected_runs"))
+        connection.execute(text("INSERT INTO rcdb_selected_runs (number) VALUES (:number)"),
+                           [{"number": run} for run in runs])
+        return True
+
+
+class _SelectValuesPlan(object):
+    """Prepared select_values query. Everything here depends only on the query and selected value names
+
+    Values may be selected from DB in two ways (join strategies):
+        "joins" - runs LEFT JOIN conditions once per condition type
+        "pivot" - one scan of conditions of all needed types, grouped by run with a column per condition type
+
+    Conditions which must be set for a run to be selected are joined with INNER JOIN (see rcdb.query_planner)
+    """
+
+    def __init__(self, names, target_cnd_types, val_indexes, query_node, dialect, statistics=None):
+        """
+        :param names: names of the selected columns. The first one is "run"
+        :param target_cnd_types: ConditionType-s of the selected columns
+        :param val_indexes: indexes of the values requested by user in a selected row
+        :param query_node: parsed search query
+        :type query_node: rcdb.query_parser.Node
+        :param dialect: SQLAlchemy dialect name
+        :param statistics: {condition name: ConditionStatistics} to order joins and python checks by selectivity
+        """
+        self.names = names
+        self.target_cnd_types = target_cnd_types
+        self.val_indexes = val_indexes
+        self.query_node = query_node
+        self.dialect = dialect
+        self._pushdowns = {}
+        self.pushdown = self.get_pushdown("joins")
+        self.index_by_name = {name: i for i, name in enumerate(names)}
+        self.value_types = {ct.name: ct.value_type for ct in target_cnd_types}
+        self.value_indexes = {name: self.index_by_name[name] for name in self.value_types}
+        self.statistics = statistics or {}
+        self.join_order, self.inner_names = query_planner.plan_joins(
+            query_node, [ct.name for ct in target_cnd_types], self.statistics)
+
+        # The python part of the query with 'and' operands in the order they should be checked
+        self.python_node, self.python_reordered = self.pushdown.python_node, False
+        self.evaluator = None
+        if self.python_node is not None:
+            self.python_node, self.python_reordered = query_planner.order_conjuncts(
+                self.python_node, self.statistics, self.value_types)
+            self.evaluator = compile_evaluator(self.python_node, self.index_by_name)
+        self._statements = {}
+        self._vectorized_evaluator = None
+        self._unvectorizable_reason = None
+
+    def get_pushdown(self, join_strategy):
+        """The search query translated to SQL over columns of the join strategy
+
+        :rtype: rcdb.query_pushdown.PushdownResult
+        """
+        pushdown = self._pushdowns.get(join_strategy)
+        if pushdown is None:
+            if join_strategy == "joins":
+                value_columns = {ct.name: ("{}_table.{}".format(ct.name, ct.get_value_field_name()), ct)
+                                 for ct in self.target_cnd_types}
+            else:
+                value_columns = {ct.name: ("pivot_table." + ct.name, ct) for ct in self.target_cnd_types}
+            pushdown = translate_query(self.query_node, value_columns, self.dialect)
+            self._pushdowns[join_strategy] = pushdown
+        return pushdown
+
+    @staticmethod
+    def _runs_filter_sql(runs_filter, column):
+        """SQL condition that selects runs in column. rcdb_selected_runs is joined in FROM instead (see
+        _select_from_sql), so for "temp_table" the condition only limits runs to :run_min - :run_max"""
+        if runs_filter == "bind":
+            return "{} IN :runs".format(column)
+        return "{0} >= :run_min AND {0} <=:run_max".format(column)
+
+    def _select_from_sql(self, join_strategy, runs_filter):
+        """SELECT ... FROM ... part of the query"""
+        query = "SELECT  runs.number run" + os.linesep
+        query_joins = " FROM runs " + os.linesep
+        if runs_filter == "temp_table":
+            # MySQL can't refer to a TEMPORARY table twice in one statement (error 1137),
+            # so it is joined here once and is not used in the pivot subquery or WHERE
+            query_joins += "  INNER JOIN rcdb_selected_runs ON rcdb_selected_runs.number = runs.number" + os.linesep
+
+        if join_strategy == "joins":
+            cnd_types_by_name = {}
+            for ct in self.target_cnd_types:
+                table_name = ct.name + "_table"
+                value_str = "  ,{}.{} {}{}".format(table_name, ct.get_value_field_name(), ct.name, os.linesep)
+                if not value_str in query:
+                    query += value_str  # safe for duplicate entries which trigger DB errors
+                cnd_types_by_name[ct.name] = ct
+
+            # Now joins region. Joins go in the planned order: INNER JOINs of the most selective conditions first
+            for name in self.join_order:
+                join_str = "  {0} JOIN conditions {1} " \
+                           "  ON {1}.run_number = runs.number AND {1}.condition_type_id = {2}{3}" \
+                    .format("INNER" if name in self.inner_names else "LEFT", name + "_table",
+                            cnd_types_by_name[name].id, os.linesep)
+
+                if join_str not in query_joins:
+                    query_joins += join_str  # safe for duplicate entries which trigger DB errors
+            return query + os.linesep + query_joins
+
+        # pivot: values of all condition types for a run are aggregated to one row
+        pivot_values = ""
+        for ct in self.target_cnd_types:
+            query += "  ,pivot_table.{0} {0}{1}".format(ct.name, os.linesep)
+            pivot_values += "    ,MAX(CASE WHEN condition_type_id = {} THEN {} END) {}{}"\
+                .format(ct.id, ct.get_value_field_name(), ct.name, os.linesep)
+
+        type_ids = ",".join(str(ct.id) for ct in self.target_cnd_types)
+        join_type = "INNER" if self.inner_names else "LEFT"
+        query_joins += "  " + join_type + " JOIN (SELECT run_number" + os.linesep \
+                       + pivot_values \
+                       + "    FROM conditions" + os.linesep \
+                       + "    WHERE condition_type_id IN ({}) AND {}{}" \
+                           .format(type_ids, self._runs_filter_sql(runs_filter, "run_number"), os.linesep) \
+                       + "    GROUP BY run_number) pivot_table ON pivot_table.run_number = runs.number" + os.linesep
+        return query + os.linesep + query_joins
+
+    def get_statement(self, join_strategy, runs_filter, sort_desc):
+        """SQL statement of the query. The text is the same for any runs, so DB and SQLAlchemy can cache it
+
+        :param join_strategy: "joins" or "pivot"
+        :param runs_filter: "range" - runs between :run_min and :run_max,
+                            "bind" - runs from :runs list parameter,
+                            "temp_table" - runs from rcdb_selected_runs temporary table,
+                                           :run_min and :run_max are the first and the last of them
+        :param sort_desc: sort by run number descending
+        """
+        key = (join_strategy, runs_filter, sort_desc)
+        statement = self._statements.get(key)
+        if statement is None:
+            # Runs of the temporary table are selected by the join. :run_min - :run_max are their bounds
+            where_clause = " WHERE " + self._runs_filter_sql(runs_filter, "runs.number")
+            pushdown = self.get_pushdown(join_strategy)
+            if pushdown.where_sql:
+                where_clause += " AND " + pushdown.where_sql
+            order_clause = "ORDER BY runs.number DESC" if sort_desc else "ORDER BY runs.number"
+            statement = text(self._select_from_sql(join_strategy, runs_filter) + os.linesep
+                             + where_clause + os.linesep + order_clause)
+            if runs_filter == "bind":
+                statement = statement.bindparams(bindparam("runs", expanding=True))
+            self._statements[key] = statement
+        return statement
+
+    def describe(self, join_strategy):
+        """The chosen plan for select_values performance report
+
+        :return: {"joins": [(joined table, "inner" or "left"), ...] in join order,
+                  "python_reordered": True if 'and' operands evaluated in python were reordered by selectivity,
+                  "statistics": True if the plan is made by condition values statistics}
+        :rtype: dict
+        """
+        if join_strategy == "joins":
+            joins = [(name + "_table", "inner" if name in self.inner_names else "left") for name in self.join_order]
         else:
-            compiled_search_eval = None
+            joins = [("pivot_table", "inner" if self.inner_names else "left")]
+        return {"joins": joins,
+                "python_reordered": self.python_reordered,
+                "statistics": bool(self.statistics)}
 
-        result_table = []
+    def get_vectorized_evaluator(self):
+        """NumPy evaluator of the part of the query which is not done by SQL
 
-        for values in result:
-            run = values[0]
+        :raises query_numpy.Unvectorizable: if the query can't be vectorized
+        """
+        if self._unvectorizable_reason is not None:
+            raise query_numpy.Unvectorizable(self._unvectorizable_reason)
+        if self._vectorized_evaluator is None:
             try:
-                if not search_eval or eval(compiled_search_eval):
-                    result_row = [run] if insert_run_number else []
-                    for i in val_indexes:
-                        val = values[i]
-                        result_row.append(val)
-                    result_table.append(result_row)
-            except Exception as ex:
-                # Condition value might be NoneType if it's not added to a run
-                # TypeError arises when comparing none with value and it's OK
-                if isinstance(ex, TypeError) and "NoneType" in str(ex):
-                    continue
+                self._vectorized_evaluator = query_numpy.compile_vectorized(self.python_node, self.value_types)
+            except query_numpy.Unvectorizable as ex:
+                self._unvectorizable_reason = str(ex)
+                raise
+        return self._vectorized_evaluator
 
-                message = 'Error evaluating search query.\n' \
-                          + '  Query: <<"{}">>, \n'.format(search_eval) \
-                          + '  Names: {}, \n'.format(names) \
-                          + '  Values: {} \n'.format(values) \
-                          + '  Error ({}): {}'.format(type(ex), ex)
-                raise QueryEvaluationError(msg=message)
 
-        selection_sw.stop()
-        total_sw.stop()
-        result = RcdbSelectionResult(result_table, self)
-        result.filter_condition_names = names
-        result.filter_condition_types = target_cnd_types
-        result.sort_desc = sort_desc
-        result.selected_conditions = ['run'] + val_names if insert_run_number else [] + val_names
-        result.performance["preparation"] = preparation_sw.elapsed
-        result.performance["query"] = query_sw.elapsed
-        result.performance["selection"] = selection_sw.elapsed
-        result.performance["start_time_stamp"] = start_time_stamp
-        result.performance["total"] = total_sw.elapsed
+class RunSnapshot(object):
+    """Immutable run with values of some of its conditions. See RCDBProvider.get_run_snapshots
 
-        return result
+    Example:
+        for run in db.get_run_snapshots(30000, 31000, ['event_count', 'run_type']):
+            print(run.number, run.start_time, run.values['event_count'])
+    """
+    __slots__ = ('number', 'start_time', 'end_time', 'values')
+
+    def __init__(self, number, start_time, end_time, values):
+        """
+        :param values: {condition name: value}. None if the run doesn't have the condition
+        :type values: dict
+        """
+        object.__setattr__(self, 'number', number)
+        object.__setattr__(self, 'start_time', start_time)
+        object.__setattr__(self, 'end_time', end_time)
+        object.__setattr__(self, 'values', MappingProxyType(values))
+
+    def __setattr__(self, key, value):
+        raise AttributeError("RunSnapshot is immutable")
+
+    def get_condition_value(self, condition_name):
+        """Value of the condition or None, the same as Run.get_condition_value"""
+        return self.values.get(condition_name)
+
+    def __repr__(self):
+        return "<RunSnapshot number='{}'>".format(self.number)
+
+
+def _fetch_run_snapshots(connection, condition_types, run_min, run_max, sort_desc=False):
+    """Selects runs and values of conditions of given types by two queries and makes RunSnapshot-s
+
+    :param connection: SQLAlchemy connection
+    :param condition_types: objects with id, name and get_value_field_name() of the conditions to select
+    :rtype: list[RunSnapshot]
+    """
+    runs_query = select(Run.number, Run.start_time, Run.end_time) \
+        .where(Run.number >= run_min, Run.number <= run_max) \
+        .order_by(Run.number.desc() if sort_desc else Run.number)
+    runs = connection.execute(runs_query).fetchall()
+
+    # Only value columns of the needed types are selected
+    field_names = []
+    field_index_by_type_id = {}
+    name_by_type_id = {}
+    for cnd_type in condition_types:
+        field_name = cnd_type.get_value_field_name() or 'text_value'
+        if field_name not in field_names:
+            field_names.append(field_name)
+        field_index_by_type_id[cnd_type.id] = 2 + field_names.index(field_name)
+        name_by_type_id[cnd_type.id] = cnd_type.name
+
+    values_by_run = {row[0]: dict.fromkeys(name_by_type_id.values()) for row in runs}
+    if runs and condition_types:
+        value_fields = [getattr(Condition, field_name) for field_name in field_names]
+        values_query = select(Condition.run_number, Condition.condition_type_id, *value_fields) \
+            .where(Condition.condition_type_id.in_(list(name_by_type_id)),
+                   Condition.run_number >= run_min, Condition.run_number <= run_max) \
+            .order_by(Condition.id.desc())      # So the first added of duplicated values is set the last
+        for row in connection.execute(values_query):
+            values = values_by_run.get(row[0])
+            if values is not None:
+                values[name_by_type_id[row[1]]] = row[field_index_by_type_id[row[1]]]
+
+    return [RunSnapshot(number, start_time, end_time, values_by_run[number])
+            for number, start_time, end_time in runs]
 
 
 class RcdbSelectionResult(MutableSequence):
-    """Define a list format, which I can customize"""
+    """Define a list format, which I can customize
+
+    Rows are kept either as a list of lists or in a columnar table (see rcdb.columnar), if the result was
+    selected with columnar=True. Columnar result works as a read-only lazy view of rows: a row list is made
+    when the row is accessed. Any modification or access to .rows converts it to a list of lists
+    """
 
-    def __init__(self, rows=None, db=None):
+    def __init__(self, rows=None, db=None, table=None):
         super(RcdbSelectionResult, self).__init__()
         self.filter_condition_types = []
         self.filter_condition_names = []
         self.selected_conditions = []
+        self.selected_value_types = []
         self.db = db
         self.sort_desc = False
 
@@ -1211,16 +2439,75 @@ class RcdbSelectionResult(MutableSequence):
                             "total": 0
                             }
 
+        self._table = table
+        """:type: rcdb.columnar.ColumnarTable"""
         if rows is not None:
-            self.rows = list(rows)
+            self._rows = list(rows)
         else:
-            self.rows = list()
+            self._rows = list()
+
+    @property
+    def rows(self):
+        """Result rows as a list of lists"""
+        if self._table is not None:
+            self._rows = list(self._table.iter_rows())
+            self._table = None
+        return self._rows
+
+    @rows.setter
+    def rows(self, rows):
+        self._table = None
+        self._rows = rows
+
+    @property
+    def is_columnar(self):
+        """True if values are stored by columns"""
+        return self._table is not None
+
+    def get_table(self):
+        """Values as a columnar table. If the result is stored by rows, the table is created from them
+
+        :rtype: rcdb.columnar.ColumnarTable
+        """
+        if self._table is not None:
+            return self._table
+        value_types = self.selected_value_types
+        if len(value_types) != len(self.selected_conditions):
+            value_types = [None] * len(self.selected_conditions)   # unknown types are stored as objects
+        return ColumnarTable.from_rows(self._rows, self.selected_conditions, value_types)
+
+    def to_numpy(self):
+        """Selected values as NumPy masked arrays: {condition name: numpy.ma.MaskedArray}"""
+        return self.get_table().to_numpy()
+
+    def to_pandas(self):
+        """Selected values as pandas.DataFrame with a column per selected condition"""
+        return self.get_table().to_pandas()
+
+    def to_arrow(self):
+        """Selected values as pyarrow.Table with a column per selected condition"""
+        return self.get_table().to_arrow()
 
     def __len__(self):
-        return len(self.rows)
+        if self._table is not None:
+            return len(self._table)
+        return len(self._rows)
 
     def __getitem__(self, ii):
-        return self.rows[ii]
+        if self._table is not None:
+            if isinstance(ii, slice):
+                return [self._table.row(i) for i in range(*ii.indices(len(self._table)))]
+            if ii < 0:
+                ii += len(self._table)
+            if not 0 <= ii < len(self._table):
+                raise IndexError("RcdbSelectionResult index out of range")
+            return self._table.row(ii)
+        return self._rows[ii]
+
+    def __iter__(self):
+        if self._table is not None:
+            return self._table.iter_rows()
+        return iter(self._rows)
 
     def __delitem__(self, ii):
         del self.rows[ii]
@@ -1273,6 +2560,9 @@ class RunSelectionResult(RcdbSelectionResult):
     def __getitem__(self, ii):
         return self.runs[ii]
 
+    def __iter__(self):
+        return iter(self.runs)
+
     def __delitem__(self, ii):
         del self.runs[ii]
 
@@ -1294,7 +2584,20 @@ class RunSelectionResult(RcdbSelectionResult):
         self.insert(list_idx, val)
 
     # noinspection PyUnresolvedReferences
-    def get_values(self, condition_names, insert_run_number=False):
+    def get_values(self, condition_names, insert_run_number=False, max_workers=1):
+        """Gets values of conditions for the selected runs
+
+        Values are fetched by chunks of GET_VALUES_CHUNK_SIZE runs (a chunk of consecutive run numbers
+        is fetched by range)
+
+        :param condition_names: condition name or list of names
+        :param insert_run_number: If True the first column of each row is a run number
+        :param max_workers: Number of chunks fetched concurrently, each on its own pooled DB connection.
+                            Not used with in-memory SQLite
+        :type max_workers: int
+        :return: rows of values in order of runs
+        :rtype: list[list]
+        """
 
         if self.db is None or not self.runs:
             return [[]]
@@ -1311,108 +2614,69 @@ class RunSelectionResult(RcdbSelectionResult):
                 # noinspection PyUnusedLocal
                 return [[] for run in self.runs]
 
-        target_cnd_names = condition_names
-
         sw = StopWatchTimer()
 
-        all_cnt_types = self.db.get_condition_types()
-        all_cnd_types_by_name = {cnd.name: cnd for cnd in all_cnt_types}
-
-        # getting target conditions types and sorting them by id
-        target_cnd_types = [all_cnd_types_by_name[cnd_name] for cnd_name in target_cnd_names]
-        ct_id_to_user_defined_order = {}
-        for cnd_type in target_cnd_types:
-            for i in range(0, len(condition_names)):
-                if cnd_type.name == condition_names[i]:
-                    ct_id_to_user_defined_order[cnd_type.id] = i
-                    break
-
-        target_cnd_types = sorted(target_cnd_types, key=lambda x: x.id)
-        target_cnd_types_len = len(target_cnd_types)
-
-        ids = [ct.id for ct in target_cnd_types]
-
-        runs_asc = self.runs if not self.sort_desc else list(reversed(self.runs))
-
-        run_numbers = [r.number for r in runs_asc]
-
-        query = self.db.session.query(Condition) \
-            .filter(Condition.condition_type_id.in_(ids), Condition.run_number.in_(run_numbers)) \
-            .order_by(Condition.run_number, Condition.condition_type_id)
-
-        conditions = query.all()
+        all_cnd_types_by_name = self.db.get_condition_types_by_name()
+        target_cnd_types = [all_cnd_types_by_name[cnd_name] for cnd_name in condition_names]
+
+        # Only value columns of the needed types are selected. Cell index in a row by condition type id
+        field_names = []
+        field_index_by_type_id = {}
+        cell_index_by_type_id = {}
+        for cell_index, cnd_type in enumerate(target_cnd_types):
+            field_name = cnd_type.get_value_field_name()
+            if field_name not in field_names:
+                field_names.append(field_name)
+            field_index_by_type_id[cnd_type.id] = 2 + field_names.index(field_name)
+            cell_index_by_type_id.setdefault(cnd_type.id, []).append(cell_index)
+
+        value_fields = [getattr(Condition, field_name) for field_name in field_names]
+        query = select(Condition.run_number, Condition.condition_type_id, *value_fields) \
+            .where(Condition.condition_type_id.in_(list(cell_index_by_type_id.keys()))) \
+            .order_by(Condition.run_number, Condition.id)
+
+        run_numbers = sorted(set(run.number for run in self.runs))
+        chunks = [run_numbers[i:i + GET_VALUES_CHUNK_SIZE] for i in range(0, len(run_numbers), GET_VALUES_CHUNK_SIZE)]
+        chunk_queries = [query.where(Condition.run_number.between(chunk[0], chunk[-1]))
+                         if chunk[-1] - chunk[0] + 1 == len(chunk)
+                         else query.where(Condition.run_number.in_(chunk))
+                         for chunk in chunks]
+
+        if max_workers > 1 and len(chunk_queries) > 1 and self.db._supports_concurrent_connections():
+            def fetch_chunk(chunk_query):
+                with self.db.engine.connect() as connection:
+                    return connection.execute(chunk_query).fetchall()
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                chunk_results = list(executor.map(fetch_chunk, chunk_queries))
+        else:
+            connection = self.db.session.connection()
+            chunk_results = [connection.execute(chunk_query).fetchall() for chunk_query in chunk_queries]
 
         # performance measurement
         sw.stop()
         self.performance["get_conditions"] = sw.elapsed
         sw = StopWatchTimer()
 
-        # create empty rows
-        rows = []
-
-        def get_empty_row(run_number=0):
-            """Creates empty rows properly
-            :param run_number: run number to add
-            """
-            if insert_run_number:
-                # noinspection PyTypeChecker
-                return [run_number] + ([None] * target_cnd_types_len)
-            else:
-                return [None] * target_cnd_types_len
-
-        type_index = 0
-        prev_run = conditions[0].run_number
-
-        row = get_empty_row(runs_asc[0].number)
-        run_index = 0
-
-        while runs_asc[run_index].number != prev_run:
-            rows.append(row)
-            run_index += 1
-            row = get_empty_row(runs_asc[run_index].number)
-
-        for condition in conditions:
-            assert isinstance(condition, Condition)
-
-            type_id = condition.condition_type_id
-            if condition.run_number != prev_run:
-                prev_run = condition.run_number
-
-                while runs_asc[run_index].number != prev_run:
-                    rows.append(row)
-                    run_index += 1
-                    row = get_empty_row(runs_asc[run_index].number)
-
-                type_index = 0
-
-            while type_index < target_cnd_types_len and type_id != target_cnd_types[type_index].id:
-                type_index += 1
-                if type_index == target_cnd_types_len:
-                    type_index = 0
-
-            cell_index = ct_id_to_user_defined_order[target_cnd_types[type_index].id]
-            if insert_run_number:
-                row[cell_index + 1] = condition.value
-            else:
-                row[cell_index] = condition.value
-
-        # We have always have to
-        rows.append(row)
-        run_index += 1
-
-        # It may happen that we run out of selected conditions, because condition is not set for all runs after
-        # for example we have run=> condition   1=>x, 2=>y, 3=>None, 4=>None. DB will select only x and y conditions
-        # and 2 rows [[1],[2]], while it should [[1],[2],[None],[None]]. So we have to put missing rows in the end
-        while run_index < len(runs_asc):
-            rows.append(get_empty_row(runs_asc[run_index].number))
-            run_index += 1
+        # Fill values by run. Rows go backward, so of duplicated values the first added one is set last
+        values_by_run = {run_number: [None] * len(target_cnd_types) for run_number in run_numbers}
+        for chunk_result in chunk_results:
+            for db_row in reversed(chunk_result):
+                values = values_by_run[db_row[0]]
+                type_id = db_row[1]
+                value = db_row[field_index_by_type_id[type_id]]
+                for cell_index in cell_index_by_type_id[type_id]:
+                    values[cell_index] = value
+
+        if insert_run_number:
+            rows = [[run.number] + values_by_run[run.number] for run in self.runs]
+        else:
+            rows = [list(values_by_run[run.number]) for run in self.runs]
 
         # performance measure
         sw.stop()
         self.performance["tabling_values"] = sw.elapsed
 
-        if self.sort_desc:
-            rows.reverse()
         return rows
 
 
@@ -0,0 +1,251 @@
+"""
+Cache of prepared search queries
+
+Preparing a query (alias expansion, tokenizing, parsing, SQL building and compiling the evaluator) takes
+much longer than running it for a typical web or farm request, while the same few queries are repeated
+over and over. RCDBProvider keeps prepared queries in a small LRU cache. The cache key includes everything
+the prepared query depends on (see _SearchQueryMixin._query_cache_key in rcdb.provider) so stale entries are never hit.
+
+Optionally RCDBProvider may also cache select_values results (see RCDBProvider.enable_result_cache).
+
+JSON condition values (component_stats, rtvs, ...) are parsed once and kept in json_value_cache,
+see Condition.parsed_value and RCDBProvider.get_parsed_values.
+"""
+
+import json
+import threading
+from collections import OrderedDict
+
+# Default size of json_value_cache: total length of cached JSON texts
+JSON_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+class LruCache(object):
+    """Dictionary with a limited size, which drops least recently used items first"""
+
+    def __init__(self, max_size=128):
+        """
+        :param max_size: Maximum number of items to keep. 0 disables caching
+        :type max_size: int
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        """Returns cached value or default if there is no such key"""
+        try:
+            value = self._items[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Adds value to the cache, dropping the least recently used item if the cache is full"""
+        if self.max_size <= 0:
+            return
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        """Removes all cached items"""
+        self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+
+def normalize_query(search_str):
+    """Normalizes search query text to be used as a cache key
+
+    Whitespace is collapsed only if the query has no string literals, where whitespace is significant
+
+    :param search_str: search query
+    :type search_str: str
+    :rtype: str
+    """
+    search_str = str(search_str).strip()
+    if "'" in search_str or '"' in search_str:
+        return search_str
+    return " ".join(search_str.split())
+
+
+class ResultCache(object):
+    """Cache of select_values results, which is valid while the database watermark is the same
+
+    The watermark is a few MAX() values over runs, conditions, condition types and logs tables, read from indexes
+    (see RCDBProvider._get_db_watermark). Any added run or condition, replaced condition value or log record
+    changes it and drops all cached results. Deletes are seen by the log records added with them
+    The cache is bounded by number of entries and by the total number of cached cells (rows * columns)
+    """
+
+    def __init__(self, max_entries=64, max_cells=1000000):
+        """
+        :param max_entries: maximum number of cached results
+        :type max_entries: int
+        :param max_cells: maximum total number of cached values in all results. Bigger results are not cached
+        :type max_cells: int
+        """
+        self.max_entries = max_entries
+        self.max_cells = max_cells
+        self.hits = 0
+        self.misses = 0
+        self.watermark = None
+        self.cells = 0
+        self._items = OrderedDict()     # key => (result, cells)
+
+    def validate(self, watermark):
+        """Drops all cached results if the database watermark has changed"""
+        if watermark != self.watermark:
+            self.clear()
+            self.watermark = watermark
+
+    def get(self, key):
+        """Returns cached result or None"""
+        try:
+            result, _ = self._items[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def put(self, key, result, cells=None):
+        """Adds result to the cache, dropping the least recently used results if the cache is full
+
+        :param key: cache key
+        :param result: result rows or any other result object
+        :param cells: number of values in the result. If None, result is treated as a list of rows
+        """
+        if cells is None:
+            cells = sum(len(row) for row in result)
+        if cells > self.max_cells or self.max_entries <= 0:
+            return
+        if key in self._items:
+            self.cells -= self._items.pop(key)[1]
+        self._items[key] = (result, cells)
+        self.cells += cells
+        while len(self._items) > self.max_entries or self.cells > self.max_cells:
+            _, (_, dropped_cells) = self._items.popitem(last=False)
+            self.cells -= dropped_cells
+
+    def clear(self):
+        """Removes all cached results"""
+        self._items.clear()
+        self.cells = 0
+
+    def __len__(self):
+        return len(self._items)
+
+
+class JsonValueCache(object):
+    """Parsed JSON values by a key, e.g. (DB, condition id), and a version of the value, e.g. (created, length)
+
+    A cached value is returned only if its version matches the requested one. Writers, which replace
+    a value keeping its key, should also discard the key. The cache is bounded by the total length
+    of parsed JSON texts. Parsed values are shared, they should not be modified by users.
+    The cache may be used from several threads
+    """
+
+    def __init__(self, max_bytes=JSON_CACHE_MAX_BYTES):
+        """
+        :param max_bytes: maximum total length of JSON texts, which parsed values are kept.
+                          Longer texts are parsed but not cached. 0 disables caching
+        :type max_bytes: int
+        """
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._items = OrderedDict()     # key => (parsed value, text length, version)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None, version=None):
+        """Returns the cached parsed value of this version or default"""
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[2] != version:
+                return default
+            self._items.move_to_end(key)
+            return item[0]
+
+    def parse(self, text, key=None, version=None):
+        """Returns json.loads(text), parsing the text only if it is not cached by this key and version yet
+
+        :param text: JSON text
+        :type text: str
+        :param key: hashable key of the text. If None, the text is parsed and not cached
+        :param version: hashable version of the text, e.g. (created, len(text))
+        """
+        if text is None:
+            return None
+        if key is not None:
+            with self._lock:
+                item = self._items.get(key)
+                if item is not None and item[2] == version:
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return item[0]
+                self.misses += 1
+
+        value = json.loads(text)
+        if key is not None:
+            self.put(key, value, len(text), version)
+        return value
+
+    def put(self, key, value, size, version=None):
+        """Adds a parsed value, dropping the least recently used values if the cache is full
+
+        :param key: hashable key
+        :param value: parsed value
+        :param size: length of the JSON text of the value
+        :param version: hashable version of the value
+        """
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self.bytes -= self._items.pop(key)[1]
+            self._items[key] = (value, size, version)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, dropped_size, _) = self._items.popitem(last=False)
+                self.bytes -= dropped_size
+
+    def discard(self, keys):
+        """Removes cached values of the keys if there are such
+
+        :param keys: iterable of keys
+        """
+        with self._lock:
+            for key in keys:
+                item = self._items.pop(key, None)
+                if item is not None:
+                    self.bytes -= item[1]
+
+    def clear(self):
+        """Removes all cached values"""
+        with self._lock:
+            self._items.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+
+json_value_cache = JsonValueCache()
+"""Parsed JSON condition values by (DB scope, condition id) with (created, text length) versions.
+Used by Condition.parsed_value and RCDBProvider.get_parsed_values"""
@@ -0,0 +1,228 @@
+"""
+Evaluation of RCDB search queries
+
+Compiles query AST (see rcdb.query_parser) to a tree of python closures once. Then the resulting function
+is called for each row of values selected from DB. This is what eval() of a rewritten query string did before,
+but without parsing python code and with explicit None handling:
+
+    - ==, !=, 'not', 'and', 'or', truth value and 'x in [...]' work with None as python does
+    - any other operation with None value (None > 1, None + 1, 'a' in None, None.startswith('a'))
+      raises NoneValueError. Which means the row is not selected
+"""
+
+import math
+import operator
+
+from rcdb.query_parser import Name, Literal, Sequence, UnaryOp, Not, BinOp, BoolOp, Compare, Attribute, Call, \
+    Subscript
+
+
+class NoneValueError(Exception):
+    """Raised when operation is done with a value, which is None (condition is not set for a run)"""
+    pass
+
+
+_binary_ops = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+    '//': operator.floordiv,
+    '%': operator.mod,
+    '**': operator.pow,
+    '|': operator.or_,
+    '^': operator.xor,
+    '&': operator.and_,
+    '<<': operator.lshift,
+    '>>': operator.rshift,
+}
+
+_unary_ops = {
+    '-': operator.neg,
+    '+': operator.pos,
+    '~': operator.invert,
+}
+
+_comparison_ops = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '>': operator.gt,
+    '<=': operator.le,
+    '>=': operator.ge,
+    'in': lambda left, right: left in right,
+    'not in': lambda left, right: left not in right,
+}
+
+# Comparisons which are fine with None operands
+_none_safe_comparisons = ('==', '!=')
+
+
+def _none_checked(op):
+    """Wraps binary operation so it raises NoneValueError if any operand is None"""
+
+    def checked(left, right):
+        if left is None or right is None:
+            raise NoneValueError()
+        return op(left, right)
+
+    return checked
+
+
+def _compile_compare(node, compile_node):
+    left_func = compile_node(node.left)
+    right_funcs = []
+    for op_name, comparator in zip(node.ops, node.comparators):
+        # 'x in [1, 2, 3]' - the most common case. Use frozenset for constant lists
+        if op_name in ('in', 'not in') and isinstance(comparator, Sequence) and comparator.is_constant:
+            items = [item.value for item in comparator.items]
+            try:
+                container = frozenset(items)
+            except TypeError:
+                container = tuple(items)
+            right_funcs.append((_comparison_ops[op_name], lambda values, c=container: c))
+            continue
+
+        op = _comparison_ops[op_name]
+        if op_name == 'in' or op_name == 'not in':
+            op = _in_checked(op)
+        elif op_name not in _none_safe_comparisons:
+            op = _none_checked(op)
+        right_funcs.append((op, compile_node(comparator)))
+
+    if len(right_funcs) == 1:
+        op, right_func = right_funcs[0]
+        return lambda values: op(left_func(values), right_func(values))
+
+    def compare_chain(values):
+        left = left_func(values)
+        for chain_op, chain_right_func in right_funcs:
+            right = chain_right_func(values)
+            if not chain_op(left, right):
+                return False
+            left = right
+        return True
+
+    return compare_chain
+
+
+def _in_checked(op):
+    """None in [1, 2] is fine, 'a' in None is not"""
+
+    def checked(left, right):
+        if right is None:
+            raise NoneValueError()
+        return op(left, right)
+
+    return checked
+
+
+def compile_evaluator(node, index_by_name):
+    """Compiles query AST to a function which takes a row of values and returns value of the query
+
+    :param node: AST root
+    :type node: rcdb.query_parser.Node
+    :param index_by_name: {condition_name: index of its value in a row}
+    :type index_by_name: dict
+    :return: function(values) -> query result. Raises NoneValueError if operation with None happened
+    """
+
+    def compile_node(sub_node):
+
+        if isinstance(sub_node, Name):
+            return operator.itemgetter(index_by_name[sub_node.name])
+
+        if isinstance(sub_node, Literal):
+            value = sub_node.value
+            return lambda values: value
+
+        if isinstance(sub_node, Sequence):
+            item_funcs = [compile_node(item) for item in sub_node.items]
+            if sub_node.is_tuple:
+                return lambda values: tuple(f(values) for f in item_funcs)
+            return lambda values: [f(values) for f in item_funcs]
+
+        if isinstance(sub_node, Not):
+            operand_func = compile_node(sub_node.operand)
+            return lambda values: not operand_func(values)
+
+        if isinstance(sub_node, BoolOp):
+            funcs = [compile_node(value) for value in sub_node.values]
+            if sub_node.op == BoolOp.AND:
+                def and_func(values):
+                    result = True
+                    for func in funcs:
+                        result = func(values)
+                        if not result:
+                            return result
+                    return result
+                return and_func
+
+            def or_func(values):
+                result = False
+                for func in funcs:
+                    result = func(values)
+                    if result:
+                        return result
+                return result
+            return or_func
+
+        if isinstance(sub_node, Compare):
+            return _compile_compare(sub_node, compile_node)
+
+        if isinstance(sub_node, UnaryOp):
+            op = _unary_ops[sub_node.op]
+            operand_func = compile_node(sub_node.operand)
+
+            def unary_func(values):
+                value = operand_func(values)
+                if value is None:
+                    raise NoneValueError()
+                return op(value)
+            return unary_func
+
+        if isinstance(sub_node, BinOp):
+            op = _none_checked(_binary_ops[sub_node.op])
+            left_func = compile_node(sub_node.left)
+            right_func = compile_node(sub_node.right)
+            return lambda values: op(left_func(values), right_func(values))
+
+        if isinstance(sub_node, Subscript):
+            op = _none_checked(operator.getitem)
+            value_func = compile_node(sub_node.value)
+            index_func = compile_node(sub_node.index)
+            return lambda values: op(value_func(values), index_func(values))
+
+        if isinstance(sub_node, Attribute):
+            # Only math.xxx attributes are not called. Validator ensures that
+            constant = getattr(math, sub_node.attr)
+            return lambda values: constant
+
+        if isinstance(sub_node, Call):
+            func = sub_node.func
+            arg_funcs = [compile_node(arg) for arg in sub_node.args]
+
+            if isinstance(func.value, Name) and func.value.name == 'math':
+                math_func = getattr(math, func.attr)
+
+                def math_call(values):
+                    args = [f(values) for f in arg_funcs]
+                    if any(arg is None for arg in args):
+                        raise NoneValueError()
+                    return math_func(*args)
+                return math_call
+
+            # method call like run_config.startswith('x')
+            method_name = func.attr
+            obj_func = compile_node(func.value)
+
+            def method_call(values):
+                obj = obj_func(values)
+                if obj is None:
+                    raise NoneValueError()
+                return getattr(obj, method_name)(*[f(values) for f in arg_funcs])
+            return method_call
+
+        raise ValueError("Unknown query node {}".format(sub_node))
+
+    return compile_node(node)
@@ -0,0 +1,398 @@
+"""
+Vectorized evaluation of RCDB search queries with NumPy
+
+For large run ranges, evaluation of a query for each row in python dominates select_values time.
+This module evaluates query AST (see rcdb.query_parser) on whole columns of values at once:
+each condition becomes a typed NumPy array plus a null mask, and the query becomes array operations.
+The result is a boolean mask over rows.
+
+The semantics is the same as of rcdb.query_evaluator. Each intermediate result has an error mask -
+rows where the row evaluator would raise NoneValueError (and so the row is not selected).
+Short circuit of 'and'/'or' is taken into account: 'a and b' raises only where a is True and b raises.
+
+Not everything can be vectorized (math functions, subscripts, comparisons of different types, ...).
+compile_vectorized raises Unvectorizable for such queries, and the caller should use the row evaluator.
+Unvectorizable may also be raised during evaluation (e.g. division by zero), so the row evaluator
+can report the error as usual.
+
+NumPy is an optional dependency. is_available() tells if it is installed.
+"""
+
+import operator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from rcdb.model import ConditionType
+from rcdb.query_parser import Name, Literal, Sequence, UnaryOp, Not, BinOp, BoolOp, Compare, Attribute, Call
+
+
+# select_values uses vectorized evaluation automatically if there are at least this number of rows
+VECTORIZE_MIN_ROWS = 1000
+
+
+class Unvectorizable(Exception):
+    """Query (or its part) can't be evaluated with NumPy arrays"""
+    pass
+
+
+def is_available():
+    """True if NumPy is installed"""
+    return numpy is not None
+
+
+# Kinds of values
+_NUMERIC = 'numeric'
+_TEXT = 'text'
+_TIME = 'time'
+_NONE = 'none'
+
+_kind_by_value_type = {
+    ConditionType.INT_FIELD: _NUMERIC,
+    ConditionType.FLOAT_FIELD: _NUMERIC,
+    ConditionType.BOOL_FIELD: _NUMERIC,
+    ConditionType.STRING_FIELD: _TEXT,
+    ConditionType.JSON_FIELD: _TEXT,
+    ConditionType.BLOB_FIELD: _TEXT,
+    ConditionType.TIME_FIELD: _TIME,
+}
+
+_comparisons = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '>': operator.gt,
+    '<=': operator.le,
+    '>=': operator.ge,
+}
+
+_arithmetic = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+}
+
+
+class _Values(object):
+    """Intermediate result: values array (or python scalar for literals), null mask and error mask.
+    Masks are 0-d arrays for literals, so they broadcast over rows"""
+
+    def __init__(self, values, null=False, error=False):
+        self.values = values
+        self.null = numpy.asarray(null, dtype=bool)
+        self.error = numpy.asarray(error, dtype=bool)
+
+
+class _Truth(object):
+    """Intermediate result in boolean context: truth mask and error mask"""
+
+    def __init__(self, truth, error=False):
+        self.truth = numpy.asarray(truth, dtype=bool)
+        self.error = numpy.asarray(error, dtype=bool)
+
+
+def _literal_kind(value):
+    if value is None:
+        return _NONE
+    if isinstance(value, (int, float)):     # bool is int too
+        return _NUMERIC
+    if isinstance(value, str):
+        return _TEXT
+    raise Unvectorizable()
+
+
+def _elementwise(func, values, null):
+    """Applies python func to each not null element of object array. Returns bool array"""
+    return numpy.fromiter((False if is_null else bool(func(value)) for value, is_null in zip(values, null)),
+                          dtype=bool, count=len(values))
+
+
+def _fill_nulls(values, null, fill):
+    """Replaces None values of object array by fill. Scalars are returned as is"""
+    if isinstance(values, numpy.ndarray):
+        result = values.copy()
+        result[null] = fill
+        return result
+    return values
+
+
+def make_columns(rows, index_by_name, value_types_by_name):
+    """Converts rows selected from DB to typed NumPy arrays
+
+    :param rows: list of rows (tuples) as selected from DB
+    :param index_by_name: {condition name: index of its value in a row}
+    :param value_types_by_name: {condition name: ConditionType.xxx_FIELD}
+    :return: {condition name: (values array, null mask)}
+    :raises Unvectorizable: if DB values can't be converted to arrays of the column type
+    """
+    try:
+        return _make_columns(rows, index_by_name, value_types_by_name)
+    except (ValueError, TypeError, OverflowError) as err:
+        raise Unvectorizable(str(err))
+
+
+def _make_columns(rows, index_by_name, value_types_by_name):
+    columns = {}
+    count = len(rows)
+    for name, index in index_by_name.items():
+        column = [row[index] for row in rows]
+        null = numpy.fromiter((value is None for value in column), dtype=bool, count=count)
+        value_type = value_types_by_name[name]
+
+        if value_type == ConditionType.FLOAT_FIELD:
+            values = numpy.fromiter((0.0 if value is None else value for value in column), dtype=float, count=count)
+        elif _kind_by_value_type[value_type] == _NUMERIC:
+            values = numpy.fromiter((0 if value is None else value for value in column), dtype=numpy.int64,
+                                    count=count)
+        else:
+            values = numpy.empty(count, dtype=object)
+            values[:] = column
+        columns[name] = (values, null)
+    return columns
+
+
+def compile_vectorized(node, value_types_by_name):
+    """Compiles query AST to a function, that evaluates query over NumPy columns
+
+    :param node: AST root
+    :type node: rcdb.query_parser.Node
+    :param value_types_by_name: {condition name: ConditionType.xxx_FIELD}
+    :return: function(columns, count) -> bool mask of selected rows. Where columns are made by make_columns
+    :raises Unvectorizable: if the query can't be vectorized
+    """
+    if numpy is None:
+        raise Unvectorizable("NumPy is not installed")
+
+    def kind_of(sub_node):
+        """Kind of value, that node produces"""
+        if isinstance(sub_node, Name):
+            return _kind_by_value_type[value_types_by_name[sub_node.name]]
+        if isinstance(sub_node, Literal):
+            return _literal_kind(sub_node.value)
+        if isinstance(sub_node, (BinOp, UnaryOp)):
+            return _NUMERIC
+        raise Unvectorizable()
+
+    def compile_value(sub_node):
+        """Compiles node which produces values. Returns function(columns) -> _Values"""
+
+        if isinstance(sub_node, Name):
+            name = sub_node.name
+            return lambda columns: _Values(*columns[name])
+
+        if isinstance(sub_node, Literal):
+            _literal_kind(sub_node.value)
+            value = sub_node.value
+            return lambda columns: _Values(value, value is None)
+
+        if isinstance(sub_node, UnaryOp) and sub_node.op in ('-', '+'):
+            if kind_of(sub_node.operand) != _NUMERIC:
+                raise Unvectorizable()
+            operand_func = compile_value(sub_node.operand)
+            negate = sub_node.op == '-'
+
+            def unary(columns):
+                operand = operand_func(columns)
+                values = -operand.values if negate else operand.values
+                return _Values(values, operand.null, operand.error | operand.null)
+            return unary
+
+        if isinstance(sub_node, BinOp) and sub_node.op in _arithmetic:
+            if kind_of(sub_node.left) != _NUMERIC or kind_of(sub_node.right) != _NUMERIC:
+                raise Unvectorizable()
+            op = _arithmetic[sub_node.op]
+            left_func = compile_value(sub_node.left)
+            right_func = compile_value(sub_node.right)
+            is_division = sub_node.op == '/'
+
+            def binary(columns):
+                left = left_func(columns)
+                right = right_func(columns)
+                null = left.null | right.null
+                error = left.error | right.error | null
+                if is_division:
+                    if numpy.any(~error & (numpy.asarray(right.values) == 0)):
+                        raise Unvectorizable("Division by zero")      # row evaluator will report it
+                    with numpy.errstate(divide='ignore', invalid='ignore'):
+                        values = op(left.values, numpy.where(error, 1, right.values))
+                else:
+                    values = op(left.values, right.values)
+                return _Values(values, null, error)
+            return binary
+
+        raise Unvectorizable()
+
+    def compile_compare(left_node, op_name, right_node):
+        """Compiles one comparison. Returns function(columns) -> _Truth"""
+
+        if op_name in ('in', 'not in'):
+            negate = op_name == 'not in'
+
+            # x in [1, 2, 3]
+            if isinstance(right_node, Sequence) and right_node.is_constant:
+                left_kind = kind_of(left_node)
+                if left_kind not in (_NUMERIC, _TEXT) or (left_kind == _TEXT and not isinstance(left_node, Name)):
+                    raise Unvectorizable()
+                left_func = compile_value(left_node)
+                items = [item.value for item in right_node.items]
+                none_in_items = any(item is None for item in items)
+                if left_kind == _NUMERIC:
+                    items = [item for item in items if isinstance(item, (int, float))]
+                else:
+                    items = set(item for item in items if isinstance(item, str))
+
+                def contains(columns):
+                    left = left_func(columns)
+                    if left_kind == _NUMERIC:
+                        truth = numpy.isin(left.values, items) & ~left.null
+                    else:
+                        truth = _elementwise(items.__contains__, left.values, left.null)
+                    if none_in_items:
+                        truth = truth | left.null
+                    return _Truth(~truth if negate else truth, left.error)
+                return contains
+
+            # 'substring' in text
+            if isinstance(left_node, Literal) and isinstance(left_node.value, str) \
+                    and isinstance(right_node, Name) and kind_of(right_node) == _TEXT:
+                substring = left_node.value
+                right_func = compile_value(right_node)
+
+                def substring_in(columns):
+                    right = right_func(columns)
+                    truth = _elementwise(lambda value: substring in value, right.values, right.null)
+                    return _Truth(~truth if negate else truth, right.error | right.null)
+                return substring_in
+
+            raise Unvectorizable()
+
+        left_kind = kind_of(left_node)
+        right_kind = kind_of(right_node)
+        op = _comparisons[op_name]
+        left_func = compile_value(left_node)
+        right_func = compile_value(right_node)
+
+        # a == None, a != None
+        if op_name in ('==', '!=') and _NONE in (left_kind, right_kind):
+            def compare_none(columns):
+                left = left_func(columns)
+                right = right_func(columns)
+                truth = left.null & right.null
+                return _Truth(truth if op_name == '==' else ~truth, left.error | right.error)
+            return compare_none
+
+        if left_kind != right_kind or left_kind not in (_NUMERIC, _TEXT):
+            raise Unvectorizable()
+
+        def compare(columns):
+            left = left_func(columns)
+            right = right_func(columns)
+            null = left.null | right.null
+            error = left.error | right.error
+            if left_kind == _TEXT:
+                left_values = _fill_nulls(left.values, left.null, '')
+                right_values = _fill_nulls(right.values, right.null, '')
+                truth = numpy.asarray(op(left_values, right_values)).astype(bool)
+            else:
+                truth = op(left.values, right.values)
+
+            if op_name == '==':
+                # None == None is True in python
+                truth = (truth & ~null) | (left.null & right.null)
+            elif op_name == '!=':
+                truth = (truth & ~null) | (left.null ^ right.null)
+            else:
+                # None < 1 raises
+                error = error | null
+                truth = truth & ~null
+            return _Truth(truth, error)
+        return compare
+
+    def compile_truth(sub_node):
+        """Compiles node in boolean context. Returns function(columns) -> _Truth"""
+
+        if isinstance(sub_node, Not):
+            operand_func = compile_truth(sub_node.operand)
+
+            def not_func(columns):
+                operand = operand_func(columns)
+                return _Truth(~operand.truth, operand.error)
+            return not_func
+
+        if isinstance(sub_node, BoolOp):
+            funcs = [compile_truth(value) for value in sub_node.values]
+            is_and = sub_node.op == BoolOp.AND
+
+            def bool_op(columns):
+                result = funcs[0](columns)
+                truth, error = result.truth, result.error
+                for func in funcs[1:]:
+                    operand = func(columns)
+                    if is_and:
+                        # python evaluates the next operand only where previous ones are True
+                        error = error | (truth & operand.error)
+                        truth = truth & operand.truth
+                    else:
+                        error = error | (~truth & operand.error)
+                        truth = truth | operand.truth
+                return _Truth(truth, error)
+            return bool_op
+
+        if isinstance(sub_node, Compare):
+            compare_funcs = [compile_compare(left, op_name, right) for left, op_name, right
+                             in zip([sub_node.left] + sub_node.comparators[:-1], sub_node.ops, sub_node.comparators)]
+
+            def compare_chain(columns):
+                result = compare_funcs[0](columns)
+                truth, error = result.truth, result.error
+                for func in compare_funcs[1:]:
+                    operand = func(columns)
+                    error = error | (truth & operand.error)
+                    truth = truth & operand.truth
+                return _Truth(truth, error)
+            return compare_chain
+
+        if isinstance(sub_node, Call):
+            func = sub_node.func
+            if not isinstance(func, Attribute) or func.attr != 'startswith' \
+                    or not isinstance(func.value, Name) or kind_of(func.value) != _TEXT \
+                    or len(sub_node.args) != 1 or not isinstance(sub_node.args[0], Literal) \
+                    or not isinstance(sub_node.args[0].value, str):
+                raise Unvectorizable()
+            value_func = compile_value(func.value)
+            prefix = sub_node.args[0].value
+
+            def startswith(columns):
+                value = value_func(columns)
+                truth = _elementwise(lambda v: v.startswith(prefix), value.values, value.null)
+                return _Truth(truth, value.error | value.null)
+            return startswith
+
+        # truth value of a value
+        kind = kind_of(sub_node)
+        value_func = compile_value(sub_node)
+
+        def truth_func(columns):
+            value = value_func(columns)
+            if kind == _NUMERIC:
+                truth = (numpy.asarray(value.values) != 0) & ~value.null
+            elif kind == _TEXT:
+                truth = _elementwise(bool, value.values, value.null) \
+                    if isinstance(value.values, numpy.ndarray) else numpy.asarray(bool(value.values))
+            elif kind == _TIME:
+                truth = ~value.null
+            else:
+                truth = numpy.asarray(False)
+            return _Truth(truth, value.error)
+        return truth_func
+
+    root_func = compile_truth(node)
+
+    def evaluate(columns, count):
+        result = root_func(columns)
+        return numpy.broadcast_to(result.truth & ~result.error, (count,))
+
+    return evaluate
@@ -0,0 +1,510 @@
+"""
+Parser of RCDB search queries
+
+rcdb.lexer only tokenizes a query like "event_count > 1000 and run_type in ['a', 'b']". This module turns the token
+stream to an AST once. The AST is then validated against condition names and is used by:
+    - rcdb.query_evaluator - compiles AST to python closures to evaluate the query for each run
+    - rcdb.query_pushdown  - translates AST to SQL WHERE fragments
+
+The grammar is a subset of python expressions (python precedence is preserved):
+
+    or_test     := and_test ('or' and_test)*
+    and_test    := not_test ('and' not_test)*
+    not_test    := 'not' not_test | comparison
+    comparison  := bit_or (comp_op bit_or)*          comp_op: < > == >= <= != <> in, not in
+    bit_or      := bit_xor ('|' bit_xor)*
+    bit_xor     := bit_and ('^' bit_and)*
+    bit_and     := shift ('&' shift)*
+    shift       := arith (('<<'|'>>') arith)*
+    arith       := term (('+'|'-') term)*
+    term        := factor (('*'|'/'|'//'|'%') factor)*
+    factor      := ('+'|'-'|'~') factor | power
+    power       := primary ['**' factor]
+    primary     := atom ('.' NAME | '(' [args] ')' | '[' or_test ']')*
+    atom        := NAME | number | string+ | '(' [or_test (',' or_test)* [',']] ')' | '[' [or_test (',' ...)] ']'
+"""
+
+import ast
+import math
+
+from ply.lex import LexToken
+
+from rcdb import lexer
+from rcdb.errors import QueryFormatError
+
+
+# --------------------------------------------
+# AST nodes
+# --------------------------------------------
+class Node(object):
+    """Base class of query AST nodes"""
+
+    def children(self):
+        return []
+
+    def walk(self):
+        """Iterates over this node and all its descendants (depth first, left to right)"""
+        yield self
+        for child in self.children():
+            for node in child.walk():
+                yield node
+
+
+class Name(Node):
+    """Condition name (or 'math' module)"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "Name({})".format(self.name)
+
+
+class Literal(Node):
+    """Number, string, True, False or None"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return "Literal({!r})".format(self.value)
+
+
+class Sequence(Node):
+    """List [a, b] or tuple (a, b) display"""
+
+    def __init__(self, items, is_tuple=False):
+        self.items = items
+        self.is_tuple = is_tuple
+
+    def children(self):
+        return list(self.items)
+
+    @property
+    def is_constant(self):
+        return all(isinstance(item, Literal) for item in self.items)
+
+    def __repr__(self):
+        return "Sequence({!r}, is_tuple={})".format(self.items, self.is_tuple)
+
+
+class UnaryOp(Node):
+    """-a, +a, ~a"""
+
+    def __init__(self, op, operand):
+        self.op = op
+        self.operand = operand
+
+    def children(self):
+        return [self.operand]
+
+    def __repr__(self):
+        return "UnaryOp({!r}, {!r})".format(self.op, self.operand)
+
+
+class Not(Node):
+    """not a"""
+
+    def __init__(self, operand):
+        self.operand = operand
+
+    def children(self):
+        return [self.operand]
+
+    def __repr__(self):
+        return "Not({!r})".format(self.operand)
+
+
+class BinOp(Node):
+    """a + b, a * b, ..."""
+
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+
+    def children(self):
+        return [self.left, self.right]
+
+    def __repr__(self):
+        return "BinOp({!r}, {!r}, {!r})".format(self.op, self.left, self.right)
+
+
+class BoolOp(Node):
+    """a and b and c, a or b or c"""
+
+    AND = 'and'
+    OR = 'or'
+
+    def __init__(self, op, values):
+        self.op = op
+        self.values = values
+
+    def children(self):
+        return list(self.values)
+
+    def __repr__(self):
+        return "BoolOp({!r}, {!r})".format(self.op, self.values)
+
+
+class Compare(Node):
+    """a < b, 1 < a < 5, a in [1, 2], a not in [1, 2]"""
+
+    def __init__(self, left, ops, comparators):
+        self.left = left
+        self.ops = ops
+        self.comparators = comparators
+
+    def children(self):
+        return [self.left] + list(self.comparators)
+
+    def __repr__(self):
+        return "Compare({!r}, {!r}, {!r})".format(self.left, self.ops, self.comparators)
+
+
+class Attribute(Node):
+    """math.pi, run_config.startswith"""
+
+    def __init__(self, value, attr):
+        self.value = value
+        self.attr = attr
+
+    def children(self):
+        return [self.value]
+
+    def __repr__(self):
+        return "Attribute({!r}, {!r})".format(self.value, self.attr)
+
+
+class Call(Node):
+    """math.sqrt(a), run_config.startswith('x')"""
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+
+    def children(self):
+        return [self.func] + list(self.args)
+
+    def __repr__(self):
+        return "Call({!r}, {!r})".format(self.func, self.args)
+
+
+class Subscript(Node):
+    """a[0]"""
+
+    def __init__(self, value, index):
+        self.value = value
+        self.index = index
+
+    def children(self):
+        return [self.value, self.index]
+
+    def __repr__(self):
+        return "Subscript({!r}, {!r})".format(self.value, self.index)
+
+
+# --------------------------------------------
+# Parser
+# --------------------------------------------
+_comparison_ops = {
+    'DEQ': '==',
+    'NEQ': '!=',
+    'NEQ2': '!=',
+    'LANG': '<',
+    'RANG': '>',
+    'LEQ': '<=',
+    'GEQ': '>=',
+}
+
+_binary_levels = [
+    {'PIPE': '|'},
+    {'CARET': '^'},
+    {'AMPERSAND': '&'},
+    {'DBL_LANG': '<<', 'DBL_RANG': '>>'},
+    {'PLUS': '+', 'MINUS': '-'},
+    {'STAR': '*', 'SLASH': '/', 'DBL_SLASH': '//', 'MOD': '%'},
+]
+
+_unary_ops = {'PLUS': '+', 'MINUS': '-', 'TILDE': '~'}
+
+_number_tokens = ['DECIMALINTEGER', 'FLOATNUMBER', 'HEXINTEGER', 'OCTINTEGER', 'BININTEGER']
+
+_constants = {'True': True, 'False': False, 'None': None}
+
+# Methods that can be called on condition values
+allowed_methods = ['startswith']
+
+
+class _Parser(object):
+    def __init__(self, tokens):
+        self.tokens = [token for token in tokens if isinstance(token, LexToken)]
+        self.pos = 0
+
+    def _peek_type(self, offset=0):
+        pos = self.pos + offset
+        return self.tokens[pos].type if pos < len(self.tokens) else None
+
+    def _next(self):
+        if self.pos >= len(self.tokens):
+            raise QueryFormatError("Query is incomplete")
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def _expect(self, token_type, what):
+        token = self._next()
+        if token.type != token_type:
+            self._unexpected(token, what)
+        return token
+
+    @staticmethod
+    def _unexpected(token, expected=None):
+        message = "Unexpected '{}' at position {}".format(token.value, token.lexpos)
+        if expected:
+            message += ", expected {}".format(expected)
+        raise QueryFormatError(message)
+
+    def parse(self):
+        if not self.tokens:
+            return None
+        node = self._or_test()
+        if self.pos != len(self.tokens):
+            self._unexpected(self.tokens[self.pos])
+        return node
+
+    def _or_test(self):
+        values = [self._and_test()]
+        while self._peek_type() == 'OR':
+            self._next()
+            values.append(self._and_test())
+        return values[0] if len(values) == 1 else BoolOp(BoolOp.OR, values)
+
+    def _and_test(self):
+        values = [self._not_test()]
+        while self._peek_type() == 'AND':
+            self._next()
+            values.append(self._not_test())
+        return values[0] if len(values) == 1 else BoolOp(BoolOp.AND, values)
+
+    def _not_test(self):
+        if self._peek_type() == 'NOT':
+            self._next()
+            return Not(self._not_test())
+        return self._comparison()
+
+    def _comparison(self):
+        left = self._binary(0)
+        ops = []
+        comparators = []
+        while True:
+            token_type = self._peek_type()
+            if token_type in _comparison_ops:
+                self._next()
+                ops.append(_comparison_ops[token_type])
+            elif token_type == 'IN':
+                self._next()
+                ops.append('in')
+            elif token_type == 'NOT' and self._peek_type(1) == 'IN':
+                self._next()
+                self._next()
+                ops.append('not in')
+            else:
+                break
+            comparators.append(self._binary(0))
+
+        return Compare(left, ops, comparators) if ops else left
+
+    def _binary(self, level):
+        if level == len(_binary_levels):
+            return self._factor()
+
+        operators = _binary_levels[level]
+        left = self._binary(level + 1)
+        while self._peek_type() in operators:
+            op = operators[self._next().type]
+            right = self._binary(level + 1)
+            left = BinOp(op, left, right)
+        return left
+
+    def _factor(self):
+        if self._peek_type() in _unary_ops:
+            op = _unary_ops[self._next().type]
+            operand = self._factor()
+
+            # fold -5 to a literal. It is easier for SQL translation
+            if op in ('-', '+') and isinstance(operand, Literal) \
+                    and isinstance(operand.value, (int, float)) and not isinstance(operand.value, bool):
+                return Literal(-operand.value if op == '-' else operand.value)
+            return UnaryOp(op, operand)
+        return self._power()
+
+    def _power(self):
+        node = self._primary()
+        if self._peek_type() == 'DBL_STAR':
+            self._next()
+            node = BinOp('**', node, self._factor())
+        return node
+
+    def _primary(self):
+        node = self._atom()
+        while True:
+            token_type = self._peek_type()
+            if token_type == 'DOT':
+                self._next()
+                node = Attribute(node, self._expect('NAME', 'attribute name').value)
+            elif token_type == 'LPAREN':
+                self._next()
+                args = []
+                while self._peek_type() != 'RPAREN':
+                    args.append(self._or_test())
+                    if self._peek_type() != 'COMMA':
+                        break
+                    self._next()
+                self._expect('RPAREN', "')'")
+                node = Call(node, args)
+            elif token_type == 'LSQ':
+                self._next()
+                index = self._or_test()
+                self._expect('RSQ', "']'")
+                node = Subscript(node, index)
+            else:
+                return node
+
+    def _atom(self):
+        token = self._next()
+
+        if token.type == 'NAME':
+            if token.value in _constants:
+                return Literal(_constants[token.value])
+            return Name(token.value)
+
+        if token.type in _number_tokens:
+            return Literal(self._literal_value(token))
+
+        if token.type == 'STRINGLITERAL':
+            value = self._literal_value(token)
+            # 'abc' 'def' is concatenated in python
+            while self._peek_type() == 'STRINGLITERAL':
+                value += self._literal_value(self._next())
+            return Literal(value)
+
+        if token.type == 'LPAREN':
+            if self._peek_type() == 'RPAREN':
+                self._next()
+                return Sequence([], is_tuple=True)
+            first = self._or_test()
+            if self._peek_type() != 'COMMA':
+                self._expect('RPAREN', "')'")
+                return first
+            items = [first]
+            while self._peek_type() == 'COMMA':
+                self._next()
+                if self._peek_type() == 'RPAREN':
+                    break
+                items.append(self._or_test())
+            self._expect('RPAREN', "')'")
+            return Sequence(items, is_tuple=True)
+
+        if token.type == 'LSQ':
+            items = []
+            while self._peek_type() != 'RSQ':
+                items.append(self._or_test())
+                if self._peek_type() != 'COMMA':
+                    break
+                self._next()
+            self._expect('RSQ', "']'")
+            return Sequence(items)
+
+        self._unexpected(token)
+
+    @staticmethod
+    def _literal_value(token):
+        try:
+            return ast.literal_eval(token.value)
+        except (ValueError, SyntaxError) as err:
+            raise QueryFormatError("Wrong literal {} at position {}: {}".format(token.value, token.lexpos, err))
+
+
+def tokenize(search_str):
+    """Tokenizes query and checks it doesn't contain restricted tokens
+
+    :param search_str: Search query
+    :type search_str: str
+    :return: list of lexer tokens
+    """
+    search_str = search_str.replace('\n', ' ')
+    search_str = search_str.replace('\r', ' ')
+
+    tokens = [token for token in lexer.tokenize(search_str) if isinstance(token, LexToken)]
+    for token in tokens:
+        if token.type in lexer.rcdb_query_restricted:
+            raise QueryFormatError("Query contains restricted symbol: '{}'".format(token.value))
+    return tokens
+
+
+def parse(tokens):
+    """Parses tokens to AST
+
+    :param tokens: list of tokens from rcdb.lexer
+    :return: Root node of AST or None if there are no tokens
+    :rtype: Node or None
+    """
+    return _Parser(tokens).parse()
+
+
+def parse_query(search_str):
+    """Tokenizes and parses search query
+
+    :param search_str: Search query like "event_count > 1000 and run_type in ['a', 'b']"
+    :type search_str: str
+    :return: Root node of AST or None if query is empty
+    :rtype: Node or None
+    """
+    return parse(tokenize(search_str))
+
+
+def validate(node, condition_names):
+    """Validates AST and returns condition names used in the query in order of appearance.
+
+    Query may contain only:
+        - condition names
+        - math.xxx public functions and constants
+        - value.startswith(...)
+
+    :param node: AST root
+    :type node: Node
+    :param condition_names: names of all conditions types in DB
+    :return: list of unique condition names used in the query
+    :rtype: list[str]
+    """
+    names = []
+    if node is None:
+        return names
+
+    math_names = set()     # ids of Name('math') nodes in math.xxx
+    called = set()         # ids of Attribute nodes that are called: xxx.startswith(...)
+    for sub_node in node.walk():
+        if isinstance(sub_node, Call):
+            if not isinstance(sub_node.func, Attribute):
+                raise QueryFormatError("Only math functions and methods {} can be called in queries"
+                                       .format(allowed_methods))
+            called.add(id(sub_node.func))
+
+    for sub_node in node.walk():
+        if isinstance(sub_node, Attribute):
+            if isinstance(sub_node.value, Name) and sub_node.value.name == 'math':
+                if sub_node.attr.startswith('_') or not hasattr(math, sub_node.attr):
+                    raise QueryFormatError("math module has no public attribute '{}'".format(sub_node.attr))
+                math_names.add(id(sub_node.value))
+            elif sub_node.attr not in allowed_methods or id(sub_node) not in called:
+                raise QueryFormatError("Attribute '{}' is not allowed in queries".format(sub_node.attr))
+
+        elif isinstance(sub_node, Name) and id(sub_node) not in math_names:
+            if sub_node.name not in condition_names:
+                message = "Name '{}' is not found in ConditionTypes".format(sub_node.name)
+                raise QueryFormatError(message)
+            if sub_node.name not in names:
+                names.append(sub_node.name)
+
+    return names
@@ -0,0 +1,337 @@
+"""
+Planning of select_values queries
+
+select_values joins conditions table once per condition type used in a query. This module decides:
+
+    - which joins can be INNER: a condition, that must be set (not None) for the query to select a run.
+      E.g. in "a > 1 and (b or c == 2)" only 'a' is required. Rows where python evaluation would
+      raise NoneValueError or give False for a None value are not selected anyway,
+      so an INNER JOIN selects the same runs
+    - the order of joins: the most selective required conditions first
+    - the order of 'and' operands evaluated in python, so evaluation stops at the most selective one first
+
+Selectivity (the fraction of runs a predicate selects) is estimated from ConditionStatistics:
+the number of values of a condition type, their min, max and number of distinct values.
+Without statistics the order is not changed.
+"""
+
+from rcdb.model import ConditionType
+from rcdb.query_parser import Name, Literal, Sequence, UnaryOp, Not, BinOp, BoolOp, Compare, Call, Subscript
+from rcdb.query_pushdown import split_conjuncts
+
+
+# Selectivity of a predicate we know nothing about
+DEFAULT_SELECTIVITY = 0.5
+
+_swapped_comparisons = {'==': '==', '!=': '!=', '<': '>', '>': '<', '<=': '>=', '>=': '<='}
+
+_ordering_comparisons = ('<', '>', '<=', '>=')
+
+_numeric_value_types = (ConditionType.INT_FIELD, ConditionType.FLOAT_FIELD, ConditionType.BOOL_FIELD)
+
+_text_value_types = (ConditionType.STRING_FIELD, ConditionType.JSON_FIELD, ConditionType.BLOB_FIELD)
+
+
+class ConditionStatistics(object):
+    """Statistics of condition values of one type"""
+
+    def __init__(self, name, count, min_value, max_value, distinct_count, run_count):
+        """
+        :param name: condition type name
+        :param count: number of values (runs which have this condition)
+        :param min_value: minimal value
+        :param max_value: maximal value
+        :param distinct_count: number of distinct values
+        :param run_count: number of runs in DB
+        """
+        self.name = name
+        self.count = count
+        self.min_value = min_value
+        self.max_value = max_value
+        self.distinct_count = distinct_count
+        self.run_count = run_count
+
+    @property
+    def fill_fraction(self):
+        """Fraction of runs which have this condition"""
+        if not self.run_count:
+            return 1.0
+        return min(1.0, float(self.count) / self.run_count)
+
+    def __repr__(self):
+        return "<ConditionStatistics name='{}' count={} min={!r} max={!r} distinct={}>"\
+            .format(self.name, self.count, self.min_value, self.max_value, self.distinct_count)
+
+
+def _operand_names(node):
+    """Names, which make evaluation of a value expression raise if they are None (arithmetic, functions)"""
+    if isinstance(node, Name):
+        return {node.name}
+    if isinstance(node, UnaryOp):
+        return _operand_names(node.operand)
+    if isinstance(node, BinOp):
+        return _operand_names(node.left) | _operand_names(node.right)
+    if isinstance(node, Subscript):
+        return _operand_names(node.value) | _operand_names(node.index)
+    if isinstance(node, Call):
+        if isinstance(node.func.value, Name) and node.func.value.name == 'math':
+            names = set()
+            for arg in node.args:
+                names |= _operand_names(arg)
+            return names
+        return _operand_names(node.func.value)     # None.startswith(...) raises
+    return set()
+
+
+def _raising_names(node):
+    """Names, which make evaluation of the node raise NoneValueError if they are None"""
+    if isinstance(node, (UnaryOp, BinOp, Subscript, Call)):
+        return _operand_names(node)
+    if isinstance(node, Not):
+        return _raising_names(node.operand)
+    if isinstance(node, BoolOp):
+        # Only the first operand is always evaluated
+        return _raising_names(node.values[0])
+    if isinstance(node, Compare):
+        names = set()
+        left = node.left
+        for op, right in zip(node.ops, node.comparators):
+            names |= _raising_names(left) | _raising_names(right)
+            if op in _ordering_comparisons:
+                names |= _operand_names(left) | _operand_names(right)
+            elif op in ('in', 'not in') and isinstance(right, Name):
+                names.add(right.name)       # 'x' in None raises
+            # Only the first comparison in a chain is always evaluated
+            break
+        return names
+    return set()
+
+
+def non_null_names(node):
+    """Names of conditions, that must not be None for the query to be True
+
+    :param node: query AST
+    :type node: rcdb.query_parser.Node
+    :rtype: set
+    """
+    if node is None:
+        return set()
+
+    if isinstance(node, Name):
+        return {node.name}      # None is False
+
+    if isinstance(node, BoolOp):
+        sets = [non_null_names(value) for value in node.values]
+        if node.op == BoolOp.AND:
+            return set().union(*sets)
+        return set.intersection(*sets)
+
+    if isinstance(node, Compare):
+        names = set()
+        left = node.left
+        for op, right in zip(node.ops, node.comparators):
+            names |= _raising_names(left) | _raising_names(right)
+            if op in _ordering_comparisons:
+                names |= _operand_names(left) | _operand_names(right)
+            elif op == '==':
+                # None == x is False if x is not None
+                if isinstance(left, Name) and isinstance(right, Literal) and right.value is not None:
+                    names.add(left.name)
+                if isinstance(right, Name) and isinstance(left, Literal) and left.value is not None:
+                    names.add(right.name)
+            elif op == 'in':
+                if isinstance(right, Name):
+                    names.add(right.name)
+                elif isinstance(left, Name) and isinstance(right, Sequence) and right.is_constant \
+                        and all(item.value is not None for item in right.items):
+                    names.add(left.name)
+            elif op == 'not in' and isinstance(right, Name):
+                names.add(right.name)
+            left = right
+        return names
+
+    # Not, arithmetic, function calls: None may only make them raise
+    return _raising_names(node)
+
+
+def estimate_selectivity(node, statistics):
+    """Estimates the fraction of runs for which the query (or its part) is True
+
+    :param node: query AST
+    :param statistics: {condition name: ConditionStatistics}
+    :rtype: float
+    """
+    if isinstance(node, BoolOp):
+        selectivities = [estimate_selectivity(value, statistics) for value in node.values]
+        result = 1.0
+        if node.op == BoolOp.AND:
+            for selectivity in selectivities:
+                result *= selectivity
+            return result
+        for selectivity in selectivities:
+            result *= 1.0 - selectivity
+        return 1.0 - result
+
+    if isinstance(node, Not):
+        return 1.0 - estimate_selectivity(node.operand, statistics)
+
+    if isinstance(node, Name):
+        stats = statistics.get(node.name)
+        return stats.fill_fraction if stats else DEFAULT_SELECTIVITY
+
+    if isinstance(node, Compare) and len(node.ops) == 1:
+        left, op, right = node.left, node.ops[0], node.comparators[0]
+        if isinstance(left, Literal) and isinstance(right, Name) and op in _swapped_comparisons:
+            left, op, right = right, _swapped_comparisons[op], left
+        if isinstance(left, Name) and left.name in statistics:
+            return _estimate_comparison(statistics[left.name], op, right)
+
+    return DEFAULT_SELECTIVITY
+
+
+def _estimate_comparison(stats, op, right):
+    """Selectivity of 'name op right' by statistics of name"""
+    fill = stats.fill_fraction
+    distinct = max(1, stats.distinct_count or 1)
+
+    if op in ('in', 'not in') and isinstance(right, Sequence) and right.is_constant:
+        selectivity = fill * min(1.0, float(len(right.items)) / distinct)
+        return selectivity if op == 'in' else 1.0 - selectivity
+
+    if not isinstance(right, Literal):
+        return DEFAULT_SELECTIVITY
+
+    value = right.value
+    if op == '==':
+        return fill / distinct if value is not None else 1.0 - fill
+    if op == '!=':
+        return 1.0 - fill / distinct if value is not None else fill
+
+    if op in _ordering_comparisons:
+        low, high = stats.min_value, stats.max_value
+        numbers = (int, float)
+        if not all(isinstance(x, numbers) and not isinstance(x, bool) for x in (low, high, value)):
+            return fill * DEFAULT_SELECTIVITY
+        if high == low:
+            fraction = 1.0 if _compare(low, op, value) else 0.0
+        elif op in ('>', '>='):
+            fraction = (high - value) / float(high - low)
+        else:
+            fraction = (value - low) / float(high - low)
+        return fill * min(1.0, max(0.0, fraction))
+
+    return DEFAULT_SELECTIVITY
+
+
+def _compare(left, op, right):
+    if op == '<':
+        return left < right
+    if op == '>':
+        return left > right
+    if op == '<=':
+        return left <= right
+    return left >= right
+
+
+def _value_kind(node, value_types):
+    """'numeric', 'text' or None if the kind of value is not known or evaluation may raise not only on None"""
+    if isinstance(node, Name):
+        value_type = value_types.get(node.name)
+        if value_type in _numeric_value_types:
+            return 'numeric'
+        if value_type in _text_value_types:
+            return 'text'
+        return None
+    if isinstance(node, Literal):
+        if isinstance(node.value, (int, float)):
+            return 'numeric'
+        if isinstance(node.value, str):
+            return 'text'
+        return None
+    if isinstance(node, UnaryOp) and node.op in ('-', '+'):
+        return 'numeric' if _value_kind(node.operand, value_types) == 'numeric' else None
+    if isinstance(node, BinOp) and node.op in ('+', '-', '*'):
+        if _value_kind(node.left, value_types) == 'numeric' and _value_kind(node.right, value_types) == 'numeric':
+            return 'numeric'
+    return None
+
+
+def can_raise_only_on_none(node, value_types):
+    """True if evaluation of the node may raise only NoneValueError. Such 'and' operands can be reordered:
+    the row selection doesn't change, as a row is not selected if the query is False or raises NoneValueError
+
+    :param node: query AST
+    :param value_types: {condition name: ConditionType.xxx_FIELD}
+    """
+    if isinstance(node, (Name, Literal)):
+        return True
+    if isinstance(node, Not):
+        return can_raise_only_on_none(node.operand, value_types)
+    if isinstance(node, BoolOp):
+        return all(can_raise_only_on_none(value, value_types) for value in node.values)
+    if isinstance(node, Compare):
+        left = node.left
+        for op, right in zip(node.ops, node.comparators):
+            if op in ('in', 'not in'):
+                if not (isinstance(right, Sequence) and right.is_constant) \
+                        or _value_kind(left, value_types) is None:
+                    return False
+            else:
+                left_kind = _value_kind(left, value_types)
+                right_kind = _value_kind(right, value_types)
+                if left_kind is None or right_kind is None:
+                    return False
+                if op in _ordering_comparisons and left_kind != right_kind:
+                    return False    # 'a' < 1 raises TypeError
+            left = right
+        return True
+    return _value_kind(node, value_types) is not None
+
+
+def order_conjuncts(node, statistics, value_types):
+    """Reorders top level 'and' operands by selectivity, so the most selective one is evaluated first
+
+    Operands are reordered only if none of them can raise anything but NoneValueError,
+    otherwise an error could appear or disappear
+
+    :param node: query AST
+    :param statistics: {condition name: ConditionStatistics}
+    :param value_types: {condition name: ConditionType.xxx_FIELD}
+    :return: (new or the same node, True if the order is changed)
+    """
+    conjuncts = split_conjuncts(node)
+    if len(conjuncts) < 2 or not statistics:
+        return node, False
+    if not all(can_raise_only_on_none(conjunct, value_types) for conjunct in conjuncts):
+        return node, False
+
+    ordered = sorted(conjuncts, key=lambda conjunct: estimate_selectivity(conjunct, statistics))
+    if ordered == conjuncts:
+        return node, False
+    return BoolOp(BoolOp.AND, ordered), True
+
+
+def plan_joins(node, names, statistics):
+    """Decides the order and kind of joins of conditions
+
+    :param node: query AST (or None)
+    :param names: names of conditions to join
+    :param statistics: {condition name: ConditionStatistics}
+    :return: (list of names in join order, set of names which can be joined with INNER JOIN)
+    """
+    required = non_null_names(node) & set(names)
+
+    def required_selectivity(name):
+        selectivity = 1.0
+        for conjunct in split_conjuncts(node) if node is not None else []:
+            if {sub_node.name for sub_node in conjunct.walk() if isinstance(sub_node, Name)} == {name}:
+                selectivity *= estimate_selectivity(conjunct, statistics)
+        if selectivity == 1.0 and name in statistics:
+            selectivity = statistics[name].fill_fraction
+        return selectivity
+
+    inner = [name for name in names if name in required]
+    if statistics:
+        inner.sort(key=required_selectivity)
+    left = [name for name in names if name not in required]
+    return inner + left, required
@@ -0,0 +1,374 @@
+"""
+Translation of RCDB search queries to SQL WHERE fragments
+
+select_values gets a search string like "event_count > 1000 and run_type in ['a', 'b']" and, originally,
+evaluated it in python for each and every run in the range. This module takes the query AST (see rcdb.query_parser)
+and translates everything that can be expressed in SQL to WHERE fragments against the typed value columns
+of conditions table. So the database returns only matching runs.
+
+The translation is done per top level 'and' conjunct. Each conjunct is either:
+    - exact:      SQL gives exactly the same result as python eval. Such conjunct is removed from python eval
+    - inexact:    SQL gives a superset of python eval result (e.g. case insensitive MySQL collation).
+                  The SQL is used as a prefilter, but the conjunct is also evaluated in python
+    - python:     can't be translated. Evaluated in python only
+
+Python semantics that has to be preserved:
+    - A row, where evaluation raises an exception (like None > 1), is not selected at all,
+      even if the failed comparison is under 'not' or 'or'
+    - None == x is False, None != x is True, None in [...] is False
+    - Truth value of None, 0, 0.0, '' is False
+
+To get it right, every predicate is translated to two SQL fragments: one that selects rows where python
+expression is True, and one that selects rows where it is False. Rows where python raises are selected by neither.
+'not' just swaps them. SQL fragments are never negated, so a superset stays a superset through and/or/not.
+"""
+
+from rcdb.model import ConditionType
+from rcdb.query_parser import Name, Literal, Sequence, Not, BoolOp, Compare, Attribute, Call
+
+
+# What comparison turns to, if left and right operands are swapped: 5 < a  => a > 5
+_swapped_comparisons = {'==': '==', '!=': '!=', '<': '>', '>': '<', '<=': '>=', '>=': '<='}
+
+# Negated comparison for not null values
+_negated_comparisons = {'==': '!=', '!=': '==', '<': '>=', '>': '<=', '<=': '>', '>=': '<'}
+
+_sql_comparisons = {'==': '=', '!=': '<>', '<': '<', '>': '>', '<=': '<=', '>=': '>='}
+
+_numeric_value_types = [ConditionType.INT_FIELD, ConditionType.FLOAT_FIELD, ConditionType.BOOL_FIELD]
+
+_text_value_types = [ConditionType.STRING_FIELD, ConditionType.JSON_FIELD, ConditionType.BLOB_FIELD]
+
+_like_escape = '!'
+
+
+class _Untranslatable(Exception):
+    """Raised by the translator when some part of the query can't be expressed in SQL"""
+    pass
+
+
+class _Sql(object):
+    """SQL fragment. exact=False means that the fragment selects a superset of what python selects.
+    sql=None means 'no restriction' which is always inexact"""
+
+    def __init__(self, sql=None, exact=False):
+        self.sql = sql
+        self.exact = exact and sql is not None
+
+
+class _Predicate(object):
+    """Translated predicate.
+
+    true_sql  - selects rows where python expression is True
+    false_sql - selects rows where python expression is False (and doesn't raise)
+    """
+
+    def __init__(self, true_sql, false_sql):
+        self.true_sql = true_sql
+        self.false_sql = false_sql
+
+    def negated(self):
+        return _Predicate(self.false_sql, self.true_sql)
+
+
+class _Column(object):
+    def __init__(self, sql, value_type):
+        self.sql = sql
+        self.value_type = value_type
+
+
+class PushdownResult(object):
+    """Result of translating the query
+
+    Attributes:
+        where_sql       - SQL to be added to WHERE with AND, or '' if nothing is translated
+        params          - dict of bound parameters used in where_sql
+        python_node     - AST of the query part, that still has to be evaluated in python.
+                          None if python evaluation is not needed at all
+        pushed_count    - number of top level conjuncts translated to SQL
+        exact_count     - number of top level conjuncts fully replaced by SQL
+    """
+
+    def __init__(self):
+        self.where_sql = ''
+        self.params = {}
+        self.python_node = None
+        self.pushed_count = 0
+        self.exact_count = 0
+
+
+def _sql_and(*parts):
+    """AND of _Sql fragments. None fragments are dropped as they don't restrict anything"""
+    sqls = [p.sql for p in parts if p.sql is not None]
+    exact = all(p.exact for p in parts)
+    if not sqls:
+        return _Sql(None)
+    if len(sqls) == 1:
+        return _Sql(sqls[0], exact)
+    return _Sql("(" + " AND ".join(sqls) + ")", exact)
+
+
+def _sql_or(*parts):
+    """OR of _Sql fragments. If any part is not restricted, OR is not restricted"""
+    if any(p.sql is None for p in parts):
+        return _Sql(None)
+    exact = all(p.exact for p in parts)
+    return _Sql("(" + " OR ".join([p.sql for p in parts]) + ")", exact)
+
+
+def _escape_like(value):
+    for char in (_like_escape, '%', '_'):
+        value = value.replace(char, _like_escape + char)
+    return value
+
+
+class _Translator(object):
+    """Translates AST of one conjunct to _Predicate"""
+
+    def __init__(self, columns, dialect, params):
+        self.columns = columns
+        self.dialect = dialect
+        self.params = params
+
+    def _param(self, value):
+        name = "qp_{}".format(len(self.params))
+        self.params[name] = value
+        return ":" + name
+
+    def _column(self, node):
+        if isinstance(node, Name) and node.name in self.columns:
+            return self.columns[node.name]
+        return None
+
+    @property
+    def _text_is_exact(self):
+        # SQLite compares text binary as python does. MySQL collations may be case insensitive
+        return self.dialect == 'sqlite'
+
+    def translate(self, node):
+        if isinstance(node, BoolOp):
+            result = self.translate(node.values[0])
+            for value in node.values[1:]:
+                right = self.translate(value)
+                if node.op == BoolOp.AND:
+                    true_sql = _sql_and(result.true_sql, right.true_sql)
+                    false_sql = _sql_or(result.false_sql, _sql_and(result.true_sql, right.false_sql))
+                else:
+                    true_sql = _sql_or(result.true_sql, _sql_and(result.false_sql, right.true_sql))
+                    false_sql = _sql_and(result.false_sql, right.false_sql)
+                result = _Predicate(true_sql, false_sql)
+            return result
+
+        if isinstance(node, Not):
+            return self.translate(node.operand).negated()
+
+        if isinstance(node, Compare):
+            if len(node.ops) != 1:
+                raise _Untranslatable()     # chained comparisons like 1 < a < 5
+            op = node.ops[0]
+            right = node.comparators[0]
+            if op == 'in':
+                return self._contains(node.left, right)
+            if op == 'not in':
+                return self._contains(node.left, right).negated()
+            return self._compare(node.left, op, right)
+
+        if isinstance(node, Call):
+            return self._startswith(node)
+
+        column = self._column(node)
+        if column is not None:
+            return self._truth(column)
+
+        raise _Untranslatable()
+
+    def _truth(self, column):
+        """Python truth value of a column"""
+        is_null = "{} IS NULL".format(column.sql)
+        not_null = "{} IS NOT NULL".format(column.sql)
+
+        if column.value_type in _numeric_value_types:
+            return _Predicate(_Sql("({} AND {} <> 0)".format(not_null, column.sql), True),
+                              _Sql("({} OR {} = 0)".format(is_null, column.sql), True))
+
+        if column.value_type in _text_value_types:
+            # MySQL PAD SPACE collations consider '  ' = '', so it is exact only for sqlite
+            exact = self._text_is_exact
+            true_sql = _Sql("({} AND {} <> '')".format(not_null, column.sql), True) if exact else _Sql(not_null)
+            return _Predicate(true_sql, _Sql("({} OR {} = '')".format(is_null, column.sql), exact))
+
+        if column.value_type == ConditionType.TIME_FIELD:
+            return _Predicate(_Sql(not_null, True), _Sql(is_null, True))
+
+        raise _Untranslatable()
+
+    @staticmethod
+    def _check_literal_type(column, value):
+        if column.value_type in _numeric_value_types and isinstance(value, (int, float)):
+            return
+        if column.value_type in _text_value_types and isinstance(value, str):
+            return
+        raise _Untranslatable()
+
+    def _compare(self, left, op, right):
+        # normalize to <column> <op> <literal>
+        if isinstance(left, Literal) and self._column(right) is not None:
+            left, right, op = right, left, _swapped_comparisons[op]
+
+        column = self._column(left)
+        if column is None or not isinstance(right, Literal):
+            raise _Untranslatable()
+
+        is_null = "{} IS NULL".format(column.sql)
+        not_null = "{} IS NOT NULL".format(column.sql)
+
+        value = right.value
+        if value is None and op in ('==', '!='):
+            predicate = _Predicate(_Sql(is_null, True), _Sql(not_null, True))
+            return predicate if op == '==' else predicate.negated()
+
+        self._check_literal_type(column, value)
+
+        is_text = column.value_type in _text_value_types
+        exact = not is_text or self._text_is_exact
+        if is_text and not exact and op not in ('==', '!='):
+            raise _Untranslatable()         # collation order may differ from python
+
+        param = self._param(value)
+
+        def cmp(operation):
+            return "{} {} {}".format(column.sql, _sql_comparisons[operation], param)
+
+        if op in ('==', '!='):
+            true_sql = _Sql("({} AND {})".format(not_null, cmp('==')), exact)
+            false_sql = _Sql("({} OR {})".format(is_null, cmp('!=')), exact) if exact else _Sql(None)
+            predicate = _Predicate(true_sql, false_sql)
+            return predicate if op == '==' else predicate.negated()
+
+        # None < 1 raises an exception in python, such rows are never selected
+        true_sql = _Sql("({} AND {})".format(not_null, cmp(op)), True)
+        false_sql = _Sql("({} AND {})".format(not_null, cmp(_negated_comparisons[op])), True)
+        return _Predicate(true_sql, false_sql)
+
+    def _contains(self, left, right):
+        # <column> in [literals]
+        column = self._column(left)
+        if column is not None and isinstance(right, Sequence):
+            if not right.is_constant:
+                raise _Untranslatable()
+            values = [item.value for item in right.items]
+            if not values:
+                return _Predicate(_Sql("1 = 0", True), _Sql("1 = 1", True))
+            for value in values:
+                self._check_literal_type(column, value)
+            exact = column.value_type not in _text_value_types or self._text_is_exact
+            params = ", ".join([self._param(value) for value in values])
+            true_sql = _Sql("({0} IS NOT NULL AND {0} IN ({1}))".format(column.sql, params), exact)
+            false_sql = _Sql("({0} IS NULL OR {0} NOT IN ({1}))".format(column.sql, params), exact) \
+                if exact else _Sql(None)
+            return _Predicate(true_sql, false_sql)
+
+        # 'substring' in <column>
+        column = self._column(right)
+        if column is not None and isinstance(left, Literal):
+            value = left.value
+            if column.value_type not in _text_value_types or not isinstance(value, str):
+                raise _Untranslatable()
+
+            # 'a' in None raises
+            not_null = "{} IS NOT NULL".format(column.sql)
+            if self._text_is_exact:
+                param = self._param(value)
+                true_sql = _Sql("(instr({}, {}) > 0)".format(column.sql, param), True)
+                false_sql = _Sql("({} AND instr({}, {}) = 0)".format(not_null, column.sql, param), True)
+            else:
+                param = self._param('%' + _escape_like(value) + '%')
+                true_sql = _Sql("({} LIKE {} ESCAPE '{}')".format(column.sql, param, _like_escape))
+                false_sql = _Sql(not_null)
+            return _Predicate(true_sql, false_sql)
+
+        raise _Untranslatable()
+
+    def _startswith(self, node):
+        func = node.func
+        if not isinstance(func, Attribute) or func.attr != 'startswith' or len(node.args) != 1:
+            raise _Untranslatable()
+        column = self._column(func.value)
+        prefix = node.args[0]
+        if column is None or column.value_type not in _text_value_types \
+                or not isinstance(prefix, Literal) or not isinstance(prefix.value, str):
+            raise _Untranslatable()
+        prefix = prefix.value
+
+        # None.startswith raises, so NULL is never selected
+        not_null = "{} IS NOT NULL".format(column.sql)
+        if self._text_is_exact:
+            param = self._param(prefix)
+            true_sql = _Sql("(substr({0}, 1, {1}) = {2})".format(column.sql, len(prefix), param), True)
+            false_sql = _Sql("({0} AND substr({1}, 1, {2}) <> {3})"
+                             .format(not_null, column.sql, len(prefix), param), True)
+        else:
+            param = self._param(_escape_like(prefix) + '%')
+            true_sql = _Sql("({} LIKE {} ESCAPE '{}')".format(column.sql, param, _like_escape))
+            false_sql = _Sql(not_null)
+        return _Predicate(true_sql, false_sql)
+
+
+def split_conjuncts(node):
+    """Returns list of top level 'and' operands of the query"""
+    if isinstance(node, BoolOp) and node.op == BoolOp.AND:
+        return list(node.values)
+    return [node]
+
+
+def translate_query(node, columns, dialect):
+    """Translates query AST to SQL where fragments
+
+    :param node: AST of the query (see rcdb.query_parser)
+    :type node: rcdb.query_parser.Node
+    :param columns: {condition_name: (sql_column, ConditionType)}, e.g. {'a': ('a_table.int_value', a_type)}
+    :type columns: dict
+    :param dialect: SQLAlchemy dialect name ('mysql', 'sqlite', ...). Text comparison is exact only for sqlite
+    :type dialect: str
+    :return: PushdownResult
+    :rtype: PushdownResult
+    """
+    result = PushdownResult()
+    if node is None:
+        return result
+
+    col_by_name = {name: _Column(sql, ct.value_type) for name, (sql, ct) in columns.items()}
+
+    python_conjuncts = []
+    where_parts = []
+
+    for conjunct in split_conjuncts(node):
+        params = dict(result.params)
+        translator = _Translator(col_by_name, dialect, params)
+        try:
+            predicate = translator.translate(conjunct)
+        except _Untranslatable:
+            python_conjuncts.append(conjunct)
+            continue
+
+        if predicate.true_sql.sql is None:
+            python_conjuncts.append(conjunct)
+            continue
+
+        result.params = params
+        result.pushed_count += 1
+        where_parts.append(predicate.true_sql.sql)
+
+        if predicate.true_sql.exact:
+            result.exact_count += 1
+        else:
+            python_conjuncts.append(conjunct)
+
+    result.where_sql = " AND ".join(where_parts)
+
+    if len(python_conjuncts) == 1:
+        result.python_node = python_conjuncts[0]
+    elif python_conjuncts:
+        result.python_node = BoolOp(BoolOp.AND, python_conjuncts)
+
+    return result
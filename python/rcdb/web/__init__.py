@@ -34,6 +34,7 @@ app.config.from_object(__name__)
 def before_request():
     g.tdb = rcdb.ConfigurationProvider()
     g.tdb.connect(app.config["SQL_CONNECTION_STRING"])
+    g.tdb.enable_lazy_text_values()
     app.jinja_env.globals['datetime_now'] = datetime.now
 
 
@@ -1,5 +1,6 @@
 from flask import Blueprint, request, render_template, flash, g, session, redirect, url_for, Response
 from rcdb.model import ConfigurationFile
+from rcdb.file_archiver import decompress_content
 #from werkzeug import check_password_hash, generate_password_hash
 
 #from app import db
@@ -28,5 +29,6 @@ def info(file_db_id):
 def raw(file_db_id):
 
     content = g.tdb.session.query(ConfigurationFile.content).filter(ConfigurationFile.id == file_db_id).scalar()
+    content = decompress_content(content)
     resp = Response(response=content, status=200, mimetype="text/plain")
     return resp
\ No newline at end of file
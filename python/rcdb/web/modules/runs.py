@@ -1,4 +1,3 @@
-import json
 import re
 import sys
 from time import time
@@ -121,7 +120,7 @@ def info(run_number):
     conditions_by_name = run.get_conditions_by_name()
 
     if rcdb.DefaultConditions.COMPONENT_STATS in conditions_by_name:
-        component_stats = json.loads(conditions_by_name[rcdb.DefaultConditions.COMPONENT_STATS].value)
+        component_stats = conditions_by_name[rcdb.DefaultConditions.COMPONENT_STATS].parsed_value
         component_sorted_keys = natural_sort_key([str(key) for key in component_stats.keys()])
     else:
         component_stats = None
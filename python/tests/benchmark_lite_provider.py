@@ -0,0 +1,95 @@
+"""
+Compares RCDBLiteProvider with RCDBProvider on the same DB: time and peak python memory of
+    - get_runs + get_condition for each run (typical walker script)
+    - select_values over all runs
+    - get_run_snapshots over all runs
+
+Usage:
+    python benchmark_lite_provider.py                      # creates a temporary SQLite DB with 5000 runs
+    python benchmark_lite_provider.py <connection string>  # uses existing DB
+"""
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import rcdb
+from rcdb.lite_provider import RCDBLiteProvider
+from rcdb.model import ConditionType
+from rcdb.provider import destroy_all_create_schema
+
+run_count = 5000
+selection = "event_count > 1000 and run_type == 'hd_all'"
+values = ['event_count', 'beam_current', 'run_type']
+
+
+def create_test_db(connection_str):
+    db = rcdb.RCDBProvider(connection_str, check_version=False)
+    destroy_all_create_schema(db)
+    db.create_condition_type("event_count", ConditionType.INT_FIELD, "")
+    db.create_condition_type("beam_current", ConditionType.FLOAT_FIELD, "")
+    db.create_condition_type("run_type", ConditionType.STRING_FIELD, "")
+    db.create_runs(range(1, run_count + 1))
+    rows = []
+    for run in range(1, run_count + 1):
+        rows.append((run, "event_count", run * 10))
+        rows.append((run, "beam_current", run * 0.01))
+        rows.append((run, "run_type", "hd_all" if run % 3 else "cosmic"))
+    db.add_conditions_bulk(rows)
+    db.disconnect()
+
+
+def walk_runs(db):
+    total = 0
+    for run in db.get_runs(0, sys.maxsize):
+        condition = db.get_condition(run.number, "event_count")
+        if condition is not None:
+            total += condition.value
+    return total
+
+
+def select(db):
+    return len(db.select_values(values, selection, run_min=0, run_max=sys.maxsize))
+
+
+def snapshots(db):
+    return sum(run.values['event_count'] for run in db.get_run_snapshots(0, sys.maxsize, ['event_count']))
+
+
+def benchmark(name, provider_class, connection_str, func):
+    """Times func without memory tracing, then measures its peak memory in a separate call"""
+    db = provider_class(connection_str)
+    db.get_condition_types()
+    start = time.perf_counter()
+    result = func(db)
+    elapsed = time.perf_counter() - start
+    db.disconnect()
+
+    db = provider_class(connection_str)
+    db.get_condition_types()
+    tracemalloc.start()
+    func(db)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    db.disconnect()
+    print(f"  {name:25} {func.__name__:12} {elapsed:8.3f} s  peak {peak / 1024 / 1024:8.2f} MB  result={result}")
+
+
+if __name__ == "__main__":
+    db_file_name = None
+    if len(sys.argv) > 1:
+        connection_str = sys.argv[1]
+    else:
+        db_file_name = tempfile.NamedTemporaryFile(suffix=".db", delete=False).name
+        connection_str = "sqlite:///" + db_file_name
+        create_test_db(connection_str)
+
+    try:
+        for func in (walk_runs, select, snapshots):
+            benchmark("RCDBProvider", rcdb.RCDBProvider, connection_str, func)
+            benchmark("RCDBLiteProvider", RCDBLiteProvider, connection_str, func)
+    finally:
+        if db_file_name:
+            os.remove(db_file_name)
@@ -0,0 +1,56 @@
+import os
+import tempfile
+import unittest
+from click.testing import CliRunner
+from rcdb.cli.app import rcdb_cli
+from rcdb.provider import RCDBProvider
+from rcdb.provider import destroy_all_create_schema
+
+
+class TestAddRuns(unittest.TestCase):
+    def setUp(self):
+        # Create a named temporary file for SQLite
+        tmp_file = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+        self.db_file_name = tmp_file.name
+        tmp_file.close()   # we only need the name
+
+        self.connection_str = "sqlite:///" + self.db_file_name
+        self.db = RCDBProvider(self.connection_str, check_version=False)
+        destroy_all_create_schema(self.db)
+        self.db.create_run(1002)
+        self.db.disconnect()    # To remove lock from file
+
+    def tearDown(self):
+        self.db.disconnect()  # Should be no harm. Just in case
+        if os.path.exists(self.db_file_name):
+            try:
+                os.remove(self.db_file_name)   # Try deleting file
+            except:
+                pass  # Do nothing
+
+    def test_add_runs_range(self):
+        """
+        Test creating runs of a range via the CLI
+        """
+        runner = CliRunner()
+        result = runner.invoke(rcdb_cli, [
+            "--connection", self.connection_str,
+            "add", "runs", "1000-1004", "--start-time", "2024-01-01 10:00:00"
+        ])
+
+        self.assertEqual(result.exit_code, 0, msg=result.output)
+        self.assertIn("Created 4 runs", result.output)
+
+        runs = self.db.get_runs(0, 2000)
+        self.assertEqual([run.number for run in runs], [1000, 1001, 1002, 1003, 1004])
+        self.assertEqual(runs[0].start_time.year, 2024)
+        self.assertIsNone(runs[2].start_time)
+
+    def test_add_runs_bad_range(self):
+        """
+        Wrong run range is reported
+        """
+        runner = CliRunner()
+        result = runner.invoke(rcdb_cli, ["--connection", self.connection_str, "add", "runs", "abc"])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("Can't parse run range", result.output)
@@ -0,0 +1,137 @@
+import os
+import tempfile
+import unittest
+
+import sqlalchemy
+from click.testing import CliRunner
+from sqlalchemy import text
+
+from rcdb.cli.app import rcdb_cli
+from rcdb.model import ConditionType
+from rcdb.provider import RCDBProvider, destroy_all_create_schema
+
+
+class TestDbIndex(unittest.TestCase):
+    def setUp(self):
+        tmp_file = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+        self.db_file_name = tmp_file.name
+        tmp_file.close()
+
+        self.connection_str = "sqlite:///" + self.db_file_name
+        self.db = RCDBProvider(self.connection_str, check_version=False)
+        destroy_all_create_schema(self.db)
+        self.db.create_condition_type("event_count", ConditionType.INT_FIELD, "")
+        self.db.create_run(1)
+        self.db.add_condition(1, "event_count", 100)
+        self.db.disconnect()
+
+    def tearDown(self):
+        self.db.disconnect()
+        if os.path.exists(self.db_file_name):
+            try:
+                os.remove(self.db_file_name)
+            except:
+                pass
+
+    def get_index_names(self):
+        engine = sqlalchemy.create_engine(self.connection_str)
+        try:
+            return {index["name"] for index in sqlalchemy.inspect(engine).get_indexes("conditions")}
+        finally:
+            engine.dispose()
+
+    def test_schema_has_indexes(self):
+        """destroy_all_create_schema creates hot query indexes"""
+        self.assertIn("ix_conditions_type_run_int", self.get_index_names())
+
+        result = CliRunner().invoke(rcdb_cli, ["--connection", self.connection_str, "db", "index", "--check"])
+        self.assertEqual(result.exit_code, 0, msg=result.output)
+        self.assertIn("All RCDB indexes exist", result.output)
+
+    def test_create_missing_indexes(self):
+        """'rcdb db index' creates indexes missing in an older DB"""
+        engine = sqlalchemy.create_engine(self.connection_str)
+        with engine.begin() as conn:
+            conn.execute(text("DROP INDEX ix_conditions_type_run_int"))
+        engine.dispose()
+
+        runner = CliRunner()
+        result = runner.invoke(rcdb_cli, ["--connection", self.connection_str, "db", "index", "--check"])
+        self.assertEqual(result.exit_code, 1, msg=result.output)
+        self.assertIn("Missing index ix_conditions_type_run_int", result.output)
+
+        result = runner.invoke(rcdb_cli, ["--connection", self.connection_str, "db", "index"])
+        self.assertEqual(result.exit_code, 0, msg=result.output)
+        self.assertIn("Benchmark query", result.output)
+        self.assertIn("ix_conditions_type_run_int", self.get_index_names())
+
+    def test_unique_conditions(self):
+        """'rcdb db unique-conditions' removes duplicates and creates the unique key"""
+        engine = sqlalchemy.create_engine(self.connection_str)
+        with engine.begin() as conn:
+            conn.execute(text("DROP INDEX uq_conditions_run_type"))
+            conn.execute(text("INSERT INTO conditions (run_number, condition_type_id, int_value, float_value, "
+                              "bool_value) SELECT run_number, condition_type_id, 200, 0, 0 FROM conditions"))
+        engine.dispose()
+
+        result = CliRunner().invoke(rcdb_cli, ["--connection", self.connection_str, "db", "unique-conditions",
+                                               "--confirm"])
+        self.assertEqual(result.exit_code, 0, msg=result.output)
+        self.assertIn("Duplicated values to remove: 1", result.output)
+        self.assertIn("uq_conditions_run_type", self.get_index_names())
+        engine = sqlalchemy.create_engine(self.connection_str)
+        with engine.connect() as conn:
+            descriptions = [row[0] for row in conn.execute(text("SELECT description FROM logs"))]
+            self.assertIn("Removed 1 duplicated condition values, added unique key", descriptions)
+        engine.dispose()
+
+        db = RCDBProvider(self.connection_str, check_version=False)
+        try:
+            self.assertEqual(db.get_condition(1, "event_count").value, 100)
+            db.add_condition(1, "event_count", 300, replace=True)
+            self.assertEqual(db.get_condition(1, "event_count").value, 300)
+        finally:
+            db.disconnect()
+
+    def test_unique_conditions_replaces_not_unique_index(self):
+        """A not unique index on the same columns isn't taken for the unique key"""
+        engine = sqlalchemy.create_engine(self.connection_str)
+        with engine.begin() as conn:
+            conn.execute(text("DROP INDEX uq_conditions_run_type"))
+            conn.execute(text("CREATE INDEX uq_conditions_run_type ON conditions (run_number, condition_type_id)"))
+        engine.dispose()
+
+        result = CliRunner().invoke(rcdb_cli, ["--connection", self.connection_str, "db", "unique-conditions",
+                                               "--confirm"])
+        self.assertEqual(result.exit_code, 0, msg=result.output)
+        self.assertIn("Created unique index uq_conditions_run_type", result.output)
+
+        db = RCDBProvider(self.connection_str, check_version=False)
+        try:
+            self.assertTrue(db._can_upsert_conditions())
+        finally:
+            db.disconnect()
+
+    def test_update_v2_to_v3(self):
+        """'rcdb db update' removes duplicates, creates indexes of v3 and stamps the version"""
+        engine = sqlalchemy.create_engine(self.connection_str)
+        with engine.begin() as conn:
+            conn.execute(text("DROP INDEX uq_conditions_run_type"))
+            conn.execute(text("DROP INDEX ix_conditions_created"))
+            conn.execute(text("INSERT INTO conditions (run_number, condition_type_id, int_value, float_value, "
+                              "bool_value) SELECT run_number, condition_type_id, 200, 0, 0 FROM conditions"))
+            conn.execute(text("UPDATE schema_versions SET version = 2"))
+        engine.dispose()
+
+        result = CliRunner().invoke(rcdb_cli, ["--connection", self.connection_str, "db", "update", "--confirm"])
+        self.assertEqual(result.exit_code, 0, msg=result.output)
+        self.assertIn("Found DB v2", result.output)
+        self.assertTrue({"uq_conditions_run_type", "ix_conditions_created"} <= self.get_index_names())
+
+        db = RCDBProvider(self.connection_str)
+        try:
+            self.assertEqual(db.get_schema_version(), 3)
+            self.assertEqual(db.get_condition(1, "event_count").value, 100)
+            self.assertEqual(len(db.get_run(1).conditions), 1)
+        finally:
+            db.disconnect()
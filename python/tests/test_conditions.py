@@ -1,7 +1,11 @@
 from datetime import datetime
 import unittest
+from unittest import mock
+
+import sqlalchemy
 import rcdb
 import rcdb.model
+import rcdb.query_cache
 from rcdb.model import ConditionType, Condition, Run
 
 import logging
@@ -229,3 +233,214 @@ class TestConditions(unittest.TestCase):
 
 
 
+
+    def test_add_conditions_upsert(self):
+        """With the unique key replace=True upserts values. The same values are not touched"""
+        self.assertTrue(self.db._can_upsert_conditions())
+        self.db.create_condition_type("one", ConditionType.INT_FIELD, "")
+        self.db.create_condition_type("two", ConditionType.FLOAT_FIELD, "")
+        self.db.create_condition_type("three", ConditionType.STRING_FIELD, "")
+        result = self.db.add_conditions(1, {"one": 10, "two": 0.5}, replace=True)
+        self.assertEqual(sorted(condition.value for condition in result), [0.5, 10])
+        created = self.db.get_condition(1, "one").created
+
+        self.db.add_conditions(1, {"one": 10, "two": 1.5, "three": "x"}, replace=True)
+        self.assertEqual(self.db.get_condition(1, "one").created, created)
+        self.assertEqual(self.db.get_condition(1, "two").value, 1.5)
+        self.assertEqual(self.db.get_condition(1, "three").value, "x")
+        self.assertEqual(len(self.db.get_run(1).conditions), 3)
+
+    def test_add_conditions_upsert_in_batch(self):
+        """Upserted values are seen inside a batch. The result has the same shape as without the unique key"""
+        self.db.create_condition_type("one", ConditionType.INT_FIELD, "")
+        self.db.create_condition_type("two", ConditionType.INT_FIELD, "")
+        self.db.add_condition(1, "one", 1)
+        self.db.add_condition(1, "two", 5)
+        with self.db.batch():
+            self.assertEqual(self.db.get_condition(1, "one").value, 1)
+            result = self.db.add_conditions(1, [("one", 2), ("two", 5)], replace=True)
+            self.assertEqual(len(result), 2)
+            self.assertEqual(result[0].value, 2)
+            self.assertEqual(result[1], self.db.get_condition_type("two"))
+            self.assertEqual(self.db.get_condition(1, "one").value, 2)
+            self.db.create_condition_type("three", ConditionType.INT_FIELD, "")
+            self.db.add_conditions(1, [("three", 3)], replace=True)
+            self.assertEqual(len(self.db.get_run(1).conditions), 3)
+        self.assertEqual(self.db.get_condition(1, "one").value, 2)
+
+    def test_add_conditions_upsert_statements(self):
+        """The upsert writes values without reading them first. Without RETURNING written ids are read after it"""
+        self.db.create_condition_type("one", ConditionType.INT_FIELD, "")
+        self.db.create_condition_type("two", ConditionType.INT_FIELD, "")
+        self.db.add_condition(1, "one", 1)
+        run = self.db.get_run(1)
+        statements = []
+        sqlalchemy.event.listen(self.db.engine, "before_cursor_execute",
+                                lambda conn, cursor, statement, *args: statements.append(statement))
+
+        with self.db.batch():
+            self.db.add_conditions(run, {"one": 1, "two": 0}, replace=True)    # checks the unique key once
+            del statements[:]
+            result = self.db.add_conditions(run, {"one": 1, "two": 2}, replace=True)
+            self.assertEqual(len(statements), 1)
+        self.assertEqual(result[0].value, 2)
+        self.assertEqual(result[1], self.db.get_condition_type("one"))
+
+        with mock.patch.object(self.db.engine.dialect.dbapi, "sqlite_version_info", (3, 34, 0)):
+            with self.db.batch():
+                self.db.add_conditions(run, {"one": 1, "two": 2}, replace=True)
+                del statements[:]
+                result = self.db.add_conditions(run, {"one": 1, "two": 3}, replace=True)
+                self.assertEqual(len(statements), 2)
+        self.assertEqual(len(result), 2)
+        self.assertEqual(result[0].value, 3)
+        self.assertIs(result[0], self.db.get_condition(1, "two"))
+        self.assertEqual(result[1], self.db.get_condition_type("one"))
+
+    def test_add_conditions_bulk(self):
+        """Values of many runs are added by chunks, existing values are compared as in add_conditions"""
+        self.db.create_condition_type("one", ConditionType.INT_FIELD, "")
+        self.db.create_condition_type("two", ConditionType.FLOAT_FIELD, "")
+        for run_number in range(2, 6):
+            self.db.create_run(run_number)
+        self.db.add_condition(1, "one", 10)
+
+        rows = [(run_number, "one", run_number * 10) for run_number in range(1, 6)]
+        rows += [(self.db.get_run(run_number), "two", run_number / 2.0) for run_number in range(1, 6)]
+        self.assertEqual(self.db.add_conditions_bulk(rows, chunk_size=3), (9, 0, 1))
+        self.assertEqual(self.db.get_condition(4, "two").value, 2.0)
+
+        self.assertRaises(rcdb.OverrideConditionValueError, self.db.add_conditions_bulk, [(2, "one", 1)])
+        self.assertEqual(self.db.add_conditions_bulk([(2, "one", 1), (3, "one", 30)], replace=True), (0, 1, 1))
+        self.assertEqual(self.db.get_condition(2, "one").value, 1)
+
+        self.assertRaises(rcdb.NoRunFoundError, self.db.add_conditions_bulk, [(100, "one", 1)])
+        self.assertRaises(KeyError, self.db.add_conditions_bulk, [(2, "one", 1), (2, "one", 2)])
+
+    def test_batch(self):
+        """Inside a batch changes are committed once at the end or rolled back on error"""
+        commits = []
+        sqlalchemy.event.listen(self.db.session, "after_commit", lambda session: commits.append(session))
+
+        with self.db.batch():
+            self.db.create_condition_type("one", ConditionType.INT_FIELD, "")
+            self.db.create_run(2)
+            self.db.add_conditions(2, {"one": 10})
+            self.db.add_condition(1, "one", 20)
+            self.db.add_log_record("", "Batch test", 2)
+            self.assertTrue(self.db.in_batch)
+        self.assertEqual(len(commits), 1)
+        self.assertEqual(self.db.get_condition(2, "one").value, 10)
+
+        with self.assertRaises(rcdb.OverrideConditionValueError):
+            with self.db.batch():
+                self.db.create_run(3)
+                self.db.add_condition(3, "one", 30)
+                self.db.add_condition(2, "one", 11)
+        self.assertFalse(self.db.in_batch)
+        self.assertIsNone(self.db.get_run(3))
+        self.assertEqual(self.db.get_condition(2, "one").value, 10)
+
+    def test_lazy_text_values(self):
+        """With lazy text values JSON values are loaded on first access, string values at once"""
+        self.db.create_condition_type("comment", ConditionType.STRING_FIELD, "")
+        self.db.create_condition_type("stats", ConditionType.JSON_FIELD, "")
+        self.db.add_conditions(1, {"comment": "cosmics", "stats": '{"roc1": 100}'})
+        self.db.enable_lazy_text_values()
+        self.db.session.expunge(self.db.get_run(1))
+        self.db.session.expire_all()
+
+        run = self.db.session.query(Run).options(sqlalchemy.orm.subqueryload(Run.conditions)).one()
+        conditions = {condition.name: condition for condition in run.conditions}
+        self.assertNotIn("text_value", sqlalchemy.inspect(conditions["comment"]).unloaded)
+        self.assertIn("text_value", sqlalchemy.inspect(conditions["stats"]).unloaded)
+        self.assertEqual(conditions["comment"].value, "cosmics")
+        self.assertEqual(conditions["stats"].value, '{"roc1": 100}')
+        self.assertEqual(self.db.get_condition(1, "stats").value, '{"roc1": 100}')
+
+    def test_parsed_value(self):
+        """JSON values are parsed once and cached by condition id and created time"""
+        self.db.create_condition_type("stats", ConditionType.JSON_FIELD, "")
+        self.db.create_run(2)
+        self.db.add_condition(1, "stats", '{"roc1": 100}')
+        self.db.add_condition(2, "stats", '{"roc1": 200}')
+
+        condition = self.db.get_condition(1, "stats")
+        self.assertEqual(condition.parsed_value, {"roc1": 100})
+        self.assertIs(condition.parsed_value, condition.parsed_value)
+
+        values = self.db.get_parsed_values("stats", 1, 10)
+        self.assertEqual(values, {1: {"roc1": 100}, 2: {"roc1": 200}})
+        self.assertIs(values[1], condition.parsed_value)
+        self.assertEqual(self.db.get_parsed_values("stats", runs=[2, 3]), {2: {"roc1": 200}})
+
+        # A replaced value has other created time and is parsed again
+        self.db.add_condition(1, "stats", '{"roc1": 101}', replace=True)
+        self.assertEqual(self.db.get_condition(1, "stats").parsed_value, {"roc1": 101})
+        self.assertEqual(self.db.get_parsed_values("stats", runs=[1])[1], {"roc1": 101})
+
+    def test_parsed_value_replaced_in_same_second(self):
+        """A value replaced with the same id and created time (DATETIME precision) is parsed again"""
+        self.db.create_condition_type("stats", ConditionType.JSON_FIELD, "")
+        self.db.create_run(2)
+        self.db.add_condition(1, "stats", '{"roc1": 100}')
+        self.db.add_condition(2, "stats", '{"roc1": 200}')
+        created = self.db.get_condition(1, "stats").created
+        self.assertEqual(self.db.get_condition(1, "stats").parsed_value, {"roc1": 100})
+        self.assertEqual(self.db.get_parsed_values("stats", runs=[2]), {2: {"roc1": 200}})
+
+        def reset_created():
+            self.db.session.execute(sqlalchemy.update(Condition).values(created=created))
+            self.db.session.commit()
+
+        self.db.add_condition(1, "stats", '{"roc1": 101}', replace=True)
+        reset_created()
+        self.assertEqual(self.db.get_condition(1, "stats").parsed_value, {"roc1": 101})
+        self.db.add_conditions_bulk([(2, "stats", '{"roc1": 201}')], replace=True)
+        reset_created()
+        self.assertEqual(self.db.get_parsed_values("stats", runs=[2]), {2: {"roc1": 201}})
+
+    def test_parsed_value_of_other_db(self):
+        """Conditions with the same id in different DBs don't share parsed values"""
+        other_db = rcdb.RCDBProvider("sqlite://", check_version=False)
+        try:
+            rcdb.provider.destroy_all_create_schema(other_db)
+            for db, text in ((self.db, '[1]'), (other_db, '[2]')):
+                db.create_condition_type("stats", ConditionType.JSON_FIELD, "")
+                db.create_run(1)
+                db.add_condition(1, "stats", text)
+            self.assertEqual(self.db.get_condition(1, "stats").parsed_value, [1])
+            self.assertEqual(other_db.get_condition(1, "stats").parsed_value, [2])
+            self.assertEqual(other_db.get_parsed_values("stats"), {1: [2]})
+        finally:
+            other_db.disconnect()
+
+    def test_json_value_cache_budget(self):
+        """JsonValueCache drops least recently used values above the byte budget"""
+        cache = rcdb.query_cache.JsonValueCache(max_bytes=20)
+        cache.parse('[1, 2, 3]', "a")
+        cache.parse('[4, 5, 6]', "b")
+        cache.parse('[1, 2, 3]', "a")
+        cache.parse('[7, 8, 9]', "c")
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertEqual(cache.bytes, 18)
+        self.assertEqual(cache.hits, 1)
+        cache.parse('[' + '1, ' * 10 + '1]', "d")
+        self.assertNotIn("d", cache)
+
+    def test_value_accessors(self):
+        """Value accessors are resolved once per type. Conditions get types from the provider cache"""
+        ct = self.db.create_condition_type("event_count", ConditionType.INT_FIELD, "")
+        self.assertIs(ct.value_accessors, ct.value_accessors)
+        self.assertEqual(ct.get_value_field_name(), "int_value")
+        self.assertIs(ct.value_field, Condition.int_value)
+        self.assertEqual(ct.convert_value("10"), 10)
+        self.assertRaises(ValueError, ct.convert_value, "ten")
+
+        self.db.add_condition(1, "event_count", 10)
+        self.db.session.expire_all()
+        condition = self.db.session.query(Condition).one()
+        self.assertEqual(condition.value, 10)
+        self.assertEqual(condition.name, "event_count")
+        self.assertNotIn("type", condition.__dict__)
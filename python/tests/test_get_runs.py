@@ -1,4 +1,5 @@
 import unittest
+from datetime import datetime
 
 import rcdb
 import rcdb.model
@@ -24,6 +25,16 @@ class TestRun(unittest.TestCase):
         self.assertEqual(run, run2)
         self.assertEqual(run.number, 1)
 
+    def test_create_runs(self):
+        """Only missing runs are created. Start times may be given per run"""
+        start_time = datetime(2024, 1, 1, 10, 0)
+        created = self.db.create_runs(list(range(0, 4)) + [10], start_time={2: start_time})
+        self.assertEqual(created, [0, 2, 3, 10])
+        self.assertEqual(self.db.get_run(2).start_time, start_time)
+        self.assertIsNone(self.db.get_run(3).start_time)
+        self.assertEqual([run.number for run in self.db.get_runs(0, 100)], [0, 1, 2, 3, 10])
+        self.assertEqual(self.db.create_runs(range(0, 4)), [])
+
     def test_get_next_prev_run(self):
         run1 = self.db.create_run(1)
         run3 = self.db.create_run(3)
@@ -50,6 +61,23 @@ class TestRun(unittest.TestCase):
         self.assertEqual(runs[0].number, 1)
         self.assertEqual(runs[1].number, 3)
 
+    def test_get_run_snapshots(self):
+        """Snapshots have values of requested conditions and can't be changed"""
+        self.db.create_condition_type("event_count", ConditionType.INT_FIELD, "")
+        self.db.create_condition_type("run_type", ConditionType.STRING_FIELD, "")
+        self.db.create_runs([2, 3, 5])
+        self.db.add_conditions_bulk([(1, "event_count", 100), (3, "event_count", 300), (3, "run_type", "cosmic")])
+
+        snapshots = self.db.get_run_snapshots(0, 4, ["event_count", "run_type"], sort_desc=True)
+        self.assertEqual([run.number for run in snapshots], [3, 2, 1])
+        self.assertEqual(dict(snapshots[0].values), {"event_count": 300, "run_type": "cosmic"})
+        self.assertEqual(dict(snapshots[1].values), {"event_count": None, "run_type": None})
+        self.assertEqual(snapshots[2].get_condition_value("event_count"), 100)
+        self.assertRaises(AttributeError, setattr, snapshots[0], "number", 10)
+        with self.assertRaises(TypeError):
+            snapshots[0].values["event_count"] = 10
+        self.assertRaises(rcdb.errors.NoConditionTypeFound, self.db.get_run_snapshots, 0, 4, ["no_such_condition"])
+
     def test_get_run_fail_safe(self):
         run1 = self.db.create_run(1)
         
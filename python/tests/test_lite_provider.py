@@ -0,0 +1,73 @@
+import os
+import tempfile
+import unittest
+
+import rcdb
+from rcdb.lite_provider import RCDBLiteProvider, RunRecord, ConditionRecord
+from rcdb.model import ConditionType
+from rcdb.provider import destroy_all_create_schema
+
+
+class TestLiteProvider(unittest.TestCase):
+    """RCDBLiteProvider reads the same data as RCDBProvider"""
+
+    def setUp(self):
+        tmp_file = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+        self.db_file_name = tmp_file.name
+        tmp_file.close()
+        self.connection_str = "sqlite:///" + self.db_file_name
+
+        self.db = rcdb.RCDBProvider(self.connection_str, check_version=False)
+        destroy_all_create_schema(self.db)
+        self.db.create_condition_type("event_count", ConditionType.INT_FIELD, "")
+        self.db.create_condition_type("run_type", ConditionType.STRING_FIELD, "")
+        self.db.create_runs(range(1, 11))
+        self.db.add_conditions_bulk([(run, "event_count", run * 100) for run in range(1, 11)] +
+                                    [(run, "run_type", "hd_all" if run % 2 else "cosmic") for run in range(1, 11)])
+        self.lite = RCDBLiteProvider(self.connection_str)
+
+    def tearDown(self):
+        self.lite.disconnect()
+        self.db.disconnect()
+        if os.path.exists(self.db_file_name):
+            try:
+                os.remove(self.db_file_name)
+            except:
+                pass
+
+    def test_get_runs(self):
+        """Runs are plain records"""
+        run = self.lite.get_run(3)
+        self.assertIsInstance(run, RunRecord)
+        self.assertEqual(run.number, 3)
+        self.assertIsNone(self.lite.get_run(100))
+        self.assertEqual([run.number for run in self.lite.get_runs(2, 4, sort_desc=True)], [4, 3, 2])
+        self.assertFalse(hasattr(run, "__dict__"))
+
+    def test_get_condition(self):
+        """Conditions are plain records with typed values"""
+        condition = self.lite.get_condition(3, "event_count")
+        self.assertIsInstance(condition, ConditionRecord)
+        self.assertEqual(condition.value, 300)
+        self.assertEqual(condition.name, "event_count")
+        self.assertEqual(self.lite.get_condition(self.lite.get_run(4), "run_type").value, "cosmic")
+        self.assertIsNone(self.lite.get_condition(100, "event_count"))
+        self.assertRaises(rcdb.errors.NoConditionTypeFound, self.lite.get_condition, 3, "no_such_condition")
+        self.assertEqual(sorted(ct.name for ct in self.lite.get_condition_types()), ["event_count", "run_type"])
+
+    def test_select_values(self):
+        """select_values gives the same rows as RCDBProvider.select_values"""
+        query = "event_count > 300 and run_type == 'hd_all'"
+        expected = [list(row) for row in self.db.select_values(["event_count", "run_type"], query)]
+        self.assertEqual(self.lite.select_values(["event_count", "run_type"], query), expected)
+        self.assertEqual(expected, [[5, 500, "hd_all"], [7, 700, "hd_all"], [9, 900, "hd_all"]])
+
+        self.assertEqual(self.lite.select_values(["event_count"], "event_count > 300", runs=[1, 5, 7],
+                                                 sort_desc=True, insert_run_number=False), [[700], [500]])
+
+    def test_get_run_snapshots(self):
+        """Snapshots are the same as RCDBProvider.get_run_snapshots gives"""
+        expected = [(run.number, dict(run.values)) for run in self.db.get_run_snapshots(2, 5, ["run_type"])]
+        self.assertEqual([(run.number, dict(run.values)) for run in self.lite.get_run_snapshots(2, 5, ["run_type"])],
+                         expected)
+        self.assertEqual(expected[:2], [(2, {"run_type": "cosmic"}), (3, {"run_type": "hd_all"})])
@@ -0,0 +1,88 @@
+import os
+import tempfile
+import unittest
+
+import rcdb
+from rcdb.model import LogRecord
+from rcdb.provider import destroy_all_create_schema
+from rcdb.log_writer import LogRecordWriter
+
+
+class TestLogWriter(unittest.TestCase):
+    """Tests buffered writing of log records"""
+
+    def test_writer_batches(self):
+        """Rows are written by batches of batch_size"""
+        batches = []
+        writer = LogRecordWriter(batches.append, synchronous=True, batch_size=2)
+        for i in range(5):
+            writer.put({"description": str(i)})
+        self.assertEqual(writer.pending_count, 5)
+        writer.close()
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        self.assertEqual(writer.written_count, 5)
+
+    def test_background_writer(self):
+        """Background thread writes all rows before flush returns. Errors don't reach the caller"""
+        batches = []
+        writer = LogRecordWriter(batches.append, max_queue_size=3)
+        for i in range(10):
+            writer.put({"description": str(i)})
+        writer.flush()
+        self.assertEqual([row["description"] for batch in batches for row in batch], [str(i) for i in range(10)])
+
+        def fail(rows):
+            raise ValueError("DB is down")
+        failing_writer = LogRecordWriter(fail)
+        failing_writer.put({"description": "x"})
+        failing_writer.close()
+        self.assertEqual(failing_writer.error_count, 1)
+
+    def test_provider_synchronous(self):
+        """In synchronous mode records of a batch are written at its end"""
+        db = rcdb.RCDBProvider("sqlite://", check_version=False)
+        destroy_all_create_schema(db)
+        db.enable_log_writer()
+        self.assertTrue(db.log_writer.synchronous)
+
+        db.add_log_record("", "One", 0)
+        self.assertEqual(db.session.query(LogRecord).count(), 1)
+        with db.batch():
+            db.create_run(1)
+            db.add_log_record("", "Two", 1)
+            self.assertEqual(db.log_writer.pending_count, 1)
+        self.assertEqual([record.description for record in db.session.query(LogRecord).order_by(LogRecord.id)],
+                         ["One", "Two"])
+        db.disconnect()
+
+    def test_provider_synchronous_error(self):
+        """A failed synchronous write rolls the session back, so the next writes work"""
+        db = rcdb.RCDBProvider("sqlite://", check_version=False)
+        destroy_all_create_schema(db)
+        db.enable_log_writer()
+        LogRecord.__table__.drop(db.session.connection())
+        db.session.commit()
+
+        db.add_log_record("", "Lost", 0)
+        self.assertEqual(db.log_writer.error_count, 1)
+        self.assertFalse(db.session.in_transaction())
+        db.create_run(1)
+        self.assertEqual(db.get_run(1).number, 1)
+        db.disconnect()
+
+    def test_provider_background(self):
+        """Records are written by a background thread"""
+        tmp_file = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+        tmp_file.close()
+        db = rcdb.RCDBProvider("sqlite:///" + tmp_file.name, check_version=False)
+        try:
+            destroy_all_create_schema(db)
+            db.enable_log_writer(synchronous=False)
+            for i in range(20):
+                db.add_log_record("", "Record {}".format(i), i)
+            db.disable_log_writer()
+            self.assertEqual(db.session.query(LogRecord).count(), 20)
+        finally:
+            db.disconnect()
+            db.engine.dispose()
+            os.remove(tmp_file.name)
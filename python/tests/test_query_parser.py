@@ -0,0 +1,58 @@
+import unittest
+
+from rcdb.errors import QueryFormatError
+from rcdb.query_parser import parse_query, validate
+from rcdb.query_evaluator import compile_evaluator, NoneValueError
+
+
+class TestQueryParser(unittest.TestCase):
+    """Tests parsing, validation and evaluation of search queries"""
+
+    names = ['a', 'b', 'd']
+
+    def evaluate(self, query, values):
+        node = parse_query(query)
+        validate(node, self.names)
+        evaluator = compile_evaluator(node, {name: i for i, name in enumerate(self.names)})
+        return evaluator(values)
+
+    def test_precedence(self):
+        """Python operator precedence is preserved"""
+        self.assertEqual(repr(parse_query("not a > 1 or b and d")),
+                         "BoolOp('or', [Not(Compare(Name(a), ['>'], [Literal(1)])), "
+                         "BoolOp('and', [Name(b), Name(d)])])")
+        self.assertEqual(self.evaluate("a + 2 * b ** 2 == 19", [1, 3, '']), True)
+        self.assertEqual(self.evaluate("-a < 0 < b", [1, 3, '']), True)
+
+    def test_evaluation(self):
+        """Evaluation gives the same results as python eval"""
+        values = [4, 2.5, 'hoho']
+        for query in ["a in [1, 2, 4] and b > 2", "a not in (1, 2)", "d.startswith('ho') or a",
+                      "'oh' in d", "math.sqrt(a) == 2", "d[0] == 'h'", "a // 3 + a % 3 == 2",
+                      "a == 4 and not b"]:
+            expected = eval(query, {'math': __import__('math')}, {'a': 4, 'b': 2.5, 'd': 'hoho'})
+            self.assertEqual(self.evaluate(query, values), expected, query)
+
+    def test_none_values(self):
+        """Operations with None raise NoneValueError, comparison for equality doesn't"""
+        self.assertTrue(self.evaluate("a == None and a != 1 and a not in [1, 2] and not a", [None, 1, 'x']))
+        self.assertRaises(NoneValueError, self.evaluate, "a > 1", [None, 1, 'x'])
+        self.assertRaises(NoneValueError, self.evaluate, "b == 1 or a > 1", [None, 2, 'x'])
+        self.assertRaises(NoneValueError, self.evaluate, "d.startswith('x')", [1, 2, None])
+        self.assertRaises(NoneValueError, self.evaluate, "'x' in d", [1, 2, None])
+
+    def test_validation(self):
+        """Only condition names, math and allowed methods are accepted"""
+        self.assertEqual(validate(parse_query("d and b > math.pi or a > b"), self.names), ['d', 'b', 'a'])
+        self.assertRaises(QueryFormatError, validate, parse_query("x > 1"), self.names)
+        self.assertRaises(QueryFormatError, validate, parse_query("a.__class__"), self.names)
+        self.assertRaises(QueryFormatError, validate, parse_query("d.upper()"), self.names)
+        self.assertRaises(QueryFormatError, validate, parse_query("math.__dict__"), self.names)
+        self.assertRaises(QueryFormatError, validate, parse_query("len(d)"), self.names)
+
+    def test_format_errors(self):
+        """Syntax errors and restricted keywords are reported as QueryFormatError"""
+        self.assertRaises(QueryFormatError, parse_query, "a >")
+        self.assertRaises(QueryFormatError, parse_query, "a b")
+        self.assertRaises(QueryFormatError, parse_query, "lambda: a")
+        self.assertRaises(QueryFormatError, parse_query, "a if b else d")
@@ -0,0 +1,55 @@
+import unittest
+
+from rcdb.model import ConditionType
+from rcdb.query_parser import parse_query
+from rcdb.query_planner import ConditionStatistics, non_null_names, estimate_selectivity, order_conjuncts, \
+    plan_joins
+
+
+class TestQueryPlanner(unittest.TestCase):
+    """Tests planning of select_values queries"""
+
+    def setUp(self):
+        self.statistics = {"a": ConditionStatistics("a", 100, 0, 100, 100, 100),
+                           "d": ConditionStatistics("d", 50, "aa", "zz", 2, 100)}
+        self.value_types = {"a": ConditionType.INT_FIELD, "d": ConditionType.STRING_FIELD}
+
+    def test_non_null_names(self):
+        """Conditions which must be set for a query to be True"""
+        self.assertEqual(non_null_names(parse_query("a > 1 and (d or b == 2)")), {"a"})
+        self.assertEqual(non_null_names(parse_query("a > 1 or a < -1")), {"a"})
+        self.assertEqual(non_null_names(parse_query("d.startswith('x') and a in [1, 2]")), {"a", "d"})
+        self.assertEqual(non_null_names(parse_query("not a > 1")), {"a"})
+        self.assertEqual(non_null_names(parse_query("not a")), set())
+        self.assertEqual(non_null_names(parse_query("a != 1 or a == None")), set())
+        self.assertEqual(non_null_names(parse_query("a in [1, None]")), set())
+
+    def test_estimate_selectivity(self):
+        """Selectivity by min, max and distinct values"""
+        self.assertAlmostEqual(estimate_selectivity(parse_query("a > 90"), self.statistics), 0.1)
+        self.assertAlmostEqual(estimate_selectivity(parse_query("10 > a"), self.statistics), 0.1)
+        self.assertAlmostEqual(estimate_selectivity(parse_query("d == 'x'"), self.statistics), 0.25)
+        self.assertAlmostEqual(estimate_selectivity(parse_query("d"), self.statistics), 0.5)
+
+    def test_order_conjuncts(self):
+        """The most selective 'and' operand goes first, unless operands may raise not only on None"""
+        node, reordered = order_conjuncts(parse_query("d == 'x' and a > 90"), self.statistics, self.value_types)
+        self.assertTrue(reordered)
+        self.assertEqual(repr(node.values[0]), "Compare(Name(a), ['>'], [Literal(90)])")
+
+        node, reordered = order_conjuncts(parse_query("a > 1 and a > 90"), {}, self.value_types)
+        self.assertFalse(reordered)
+
+        # d < 1 raises TypeError, so it must stay after a > 1
+        node, reordered = order_conjuncts(parse_query("a > 1 and d < 1"), self.statistics, self.value_types)
+        self.assertFalse(reordered)
+
+    def test_plan_joins(self):
+        """Required conditions are joined first, the most selective of them goes first"""
+        order, inner = plan_joins(parse_query("d == 'x' and a > 90 or a > 95"), ["d", "a", "b"], self.statistics)
+        self.assertEqual(order, ["a", "d", "b"])
+        self.assertEqual(inner, {"a"})
+
+        order, inner = plan_joins(parse_query("d == 'x' and a > 90"), ["d", "a", "b"], self.statistics)
+        self.assertEqual(order, ["a", "d", "b"])
+        self.assertEqual(inner, {"a", "d"})
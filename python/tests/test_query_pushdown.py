@@ -0,0 +1,61 @@
+import unittest
+
+from rcdb.model import ConditionType
+from rcdb.query_parser import parse_query, BoolOp
+from rcdb.query_pushdown import translate_query
+
+
+class TestQueryPushdown(unittest.TestCase):
+    """Tests translation of search queries to SQL where fragments"""
+
+    def setUp(self):
+        int_type = ConditionType()
+        int_type.name = "a"
+        int_type.value_type = ConditionType.INT_FIELD
+
+        str_type = ConditionType()
+        str_type.name = "d"
+        str_type.value_type = ConditionType.STRING_FIELD
+
+        self.columns = {"a": ("a_table.int_value", int_type),
+                        "d": ("d_table.text_value", str_type)}
+
+    def translate(self, query, dialect='sqlite'):
+        return translate_query(parse_query(query), self.columns, dialect)
+
+    def test_exact_translation(self):
+        """Fully translated query doesn't need python evaluation"""
+        result = self.translate("a > 5 and d in ['x', 'y']")
+        self.assertEqual(result.pushed_count, 2)
+        self.assertEqual(result.exact_count, 2)
+        self.assertIsNone(result.python_node)
+        self.assertEqual(sorted(result.params.values(), key=str), [5, 'x', 'y'])
+
+    def test_untranslatable_conjunct(self):
+        """Arithmetic is left to python, the rest goes to SQL"""
+        result = self.translate("a + 1 > 5 and d == 'x'")
+        self.assertEqual(result.pushed_count, 1)
+        self.assertEqual(repr(result.python_node), "Compare(BinOp('+', Name(a), Literal(1)), ['>'], [Literal(5)])")
+        self.assertIn("d_table.text_value", result.where_sql)
+
+    def test_top_level_or(self):
+        """'a and b or c' is not split to conjuncts"""
+        result = self.translate("a > 5 and d == 'x' or a + 1 > 5")
+        self.assertEqual(result.pushed_count, 0)
+        self.assertEqual(result.where_sql, "")
+        self.assertIsInstance(result.python_node, BoolOp)
+
+    def test_mysql_text_is_prefilter(self):
+        """MySQL collation may be case insensitive, so python has to check text comparisons"""
+        result = self.translate("d == 'x'", dialect='mysql')
+        self.assertEqual(result.pushed_count, 1)
+        self.assertEqual(result.exact_count, 0)
+        self.assertIsNotNone(result.python_node)
+
+        result = self.translate("d != 'x'", dialect='mysql')
+        self.assertEqual(result.pushed_count, 0)
+
+    def test_wrong_literal_type(self):
+        """Comparison of int column with string is left to python"""
+        result = self.translate("a == 'x'")
+        self.assertEqual(result.pushed_count, 0)
@@ -2,7 +2,11 @@ import os
 import tempfile
 import unittest
 
+import sqlalchemy
+from click.testing import CliRunner
+
 import rcdb
+from rcdb.cli.app import rcdb_cli
 from rcdb.model import ConfigurationFile
 from rcdb.provider import RCDBProvider, destroy_all_create_schema
 
@@ -103,3 +107,93 @@ class TestSaveFiles(unittest.TestCase):
 
         # Check if the known marker string is in the content
         self.assertIn("</coda>", content, "Expected '</coda>' inside large_run.log content")
+
+    def test_non_ascii_content(self):
+        """
+        A file and its content give the same hash, also for non-ASCII text. The file is stored once.
+        """
+        tmp_file = tempfile.NamedTemporaryFile(suffix=".conf", delete=False)
+        tmp_file.write("Detector: Ångström\nT = 4 °K\n".encode('utf-8'))
+        tmp_file.close()
+        try:
+            file_by_path = self.db.add_configuration_file(1, tmp_file.name)
+            self.assertEqual(file_by_path.content, "Detector: Ångström\nT = 4 °K\n")
+
+            with open(tmp_file.name, encoding='utf-8') as io_file:
+                content = io_file.read()
+            file_by_content = self.db.add_configuration_file(2, tmp_file.name, content=content)
+            self.assertEqual(file_by_content.id, file_by_path.id)
+            self.assertEqual(self.db.session.query(ConfigurationFile).count(), 1)
+            self.assertEqual([run.number for run in file_by_path.runs], [1, 2])
+        finally:
+            os.remove(tmp_file.name)
+
+    def test_compressed_content(self):
+        """
+        With file_compression set, content is stored compressed and is read as plain text.
+        Small files, which don't get shorter, stay plain.
+        """
+        content = "".join("crate ROC{} slot {} threshold 100\n".format(i % 8, i % 21) for i in range(500))
+        self.db.file_compression = "zlib"
+        conf_file = self.db.add_configuration_file(1, "/daq/roc.cnf", content=content)
+        small_file = self.db.add_configuration_file(1, "/daq/small.cnf", content="a=1")
+
+        self.assertTrue(conf_file.is_compressed)
+        self.assertLess(len(conf_file.stored_content), len(content) / 5)
+        self.assertFalse(small_file.is_compressed)
+        self.db.session.expire_all()
+        self.assertEqual(self.db.get_file(1, "/daq/roc.cnf").content, content)
+        self.assertEqual(self.db.get_file(1, "/daq/small.cnf").content, "a=1")
+
+        # The hash is of the plain content, so the same file is found and not added twice
+        self.db.add_configuration_file(2, "/daq/roc.cnf", content=content)
+        self.assertEqual(self.db.session.query(ConfigurationFile).count(), 2)
+
+    def test_compress_files_command(self):
+        """
+        'rcdb db compress-files' compresses existing files and --codec=none reverts it
+        """
+        content = "".join("channel {} pedestal 200\n".format(i % 16) for i in range(1000))
+        self.db.add_configuration_file(1, "/daq/fadc.cnf", content=content)
+        self.db.add_configuration_file(1, "/daq/small.cnf", content="a=1")
+        self.db.disconnect()
+
+        runner = CliRunner()
+        result = runner.invoke(rcdb_cli, ["--connection", self.connection_str, "db", "compress-files",
+                                          "--batch-size", "1", "--confirm"])
+        self.assertNotEqual(result.exit_code, 0, msg="--codec is required")
+
+        result = runner.invoke(rcdb_cli, ["--connection", self.connection_str, "db", "compress-files",
+                                          "--codec", "zlib", "--batch-size", "1", "--confirm"])
+        self.assertEqual(result.exit_code, 0, msg=result.output)
+        self.assertIn("Updated 1 of 2 files", result.output)
+
+        db = rcdb.RCDBProvider(self.connection_str, check_version=False)
+        try:
+            conf_file = db.get_file(1, "/daq/fadc.cnf")
+            self.assertTrue(conf_file.is_compressed)
+            self.assertEqual(conf_file.content, content)
+        finally:
+            db.disconnect()
+
+        result = runner.invoke(rcdb_cli, ["--connection", self.connection_str, "db", "compress-files",
+                                          "--codec", "none", "--confirm"])
+        self.assertEqual(result.exit_code, 0, msg=result.output)
+        db = rcdb.RCDBProvider(self.connection_str, check_version=False)
+        try:
+            self.assertEqual(db.session.query(ConfigurationFile.content).filter_by(path="/daq/fadc.cnf").scalar(),
+                             content)
+        finally:
+            db.disconnect()
+
+    def test_deferred_content(self):
+        """
+        Content is not loaded with files of a run. content_length is
+        """
+        self.db.add_configuration_file(1, "/daq/roc.cnf", content="threshold 100\n")
+        self.db.session.expunge_all()
+
+        conf_file = self.db.get_run(1).files[0]
+        self.assertIn("stored_content", sqlalchemy.inspect(conf_file).unloaded)
+        self.assertEqual(conf_file.content_length, 14)
+        self.assertEqual(conf_file.content, "threshold 100\n")
@@ -1,8 +1,11 @@
 import unittest
 
+import sqlalchemy
+
 import rcdb
 import rcdb.model
-from rcdb.model import Run, ConditionType
+import rcdb.provider
+from rcdb.model import Run, ConditionType, Condition
 
 
 class TestRun(unittest.TestCase):
@@ -169,3 +172,40 @@ class TestRun(unittest.TestCase):
 
 
 
+
+    def test_get_values_chunks(self):
+        """Values are fetched by chunks of runs, by range for consecutive runs"""
+        old_chunk_size = rcdb.provider.GET_VALUES_CHUNK_SIZE
+        try:
+            rcdb.provider.GET_VALUES_CHUNK_SIZE = 2
+            result = self.db.select_runs(run_min=1, run_max=9)
+            rows = result.get_values(['a', 'd', 'a'], insert_run_number=True)
+            awaited_rows = [[1, 1, 'haha', 1],
+                            [2, 2, None, 2],
+                            [3, 3, None, 3],
+                            [4, 4, 'hoho', 4],
+                            [5, None, 'bang', None],
+                            [9, 9, 'mew', 9]]
+            self.assertEqual(rows, awaited_rows)
+        finally:
+            rcdb.provider.GET_VALUES_CHUNK_SIZE = old_chunk_size
+
+        # No values of the condition for selected runs
+        rows = self.db.select_runs(run_min=1, run_max=3).get_values(['f'])
+        self.assertEqual(rows, [[None], [None], [None]])
+
+    def test_get_values_duplicated_values(self):
+        """Of duplicated values of a condition for a run the first added one is returned"""
+        self.db.session.execute(sqlalchemy.text("DROP INDEX uq_conditions_run_type"))
+        a_type = self.db.get_condition_type("a")
+        for value in (30, 31):
+            self.db.session.add(Condition(run_number=3, condition_type_id=a_type.id, int_value=value))
+        self.db.session.commit()
+
+        old_chunk_size = rcdb.provider.GET_VALUES_CHUNK_SIZE
+        try:
+            rcdb.provider.GET_VALUES_CHUNK_SIZE = 2
+            rows = self.db.select_runs(run_min=2, run_max=4).get_values(['a'], insert_run_number=True)
+            self.assertEqual(rows, [[2, 2], [3, 3], [4, 4]])
+        finally:
+            rcdb.provider.GET_VALUES_CHUNK_SIZE = old_chunk_size
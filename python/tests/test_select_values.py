@@ -1,9 +1,16 @@
+import os
+import tempfile
 import unittest
 
+import sqlalchemy
+
 import rcdb
 import rcdb.model
+import rcdb.provider
 from rcdb.model import Run, ConditionType
 from rcdb.provider import destroy_all_create_schema
+from rcdb import query_numpy
+from rcdb.alias import ConditionSearchAlias
 
 
 class TestRun(unittest.TestCase):
@@ -111,12 +118,284 @@ class TestRun(unittest.TestCase):
         result = self.db.select_values(['a', 'd'], runs=[9, self.db.get_run(4)], insert_run_number=False)
         self.assertEqual(result.rows, [[4, u'hoho'], [9, u'mew']])
 
-
-
-
-
-
-
-
-
-
+    def test_select_values_none_in_or(self):
+        """None in ordering comparison excludes the run even under 'or' (as python eval does)"""
+        result = self.db.select_values(['a'], "a > 2 or d == 'bang'", insert_run_number=False)
+        self.assertEqual(result.rows, [[3], [4], [9]])
+
+    def test_select_values_not(self):
+        """'not' over a comparison with None value"""
+        result = self.db.select_values(['a'], "not a > 2")
+        self.assertEqual(result.rows, [[1, 1], [2, 2]])
+
+    def test_select_values_string_functions(self):
+        """startswith and substring search"""
+        result = self.db.select_values(['d'], "d.startswith('h')")
+        self.assertEqual(result.rows, [[1, u'haha'], [4, u'hoho']])
+
+        result = self.db.select_values(['d'], "'a' in d and a")
+        self.assertEqual(result.rows, [[1, u'haha']])
+
+    def test_select_values_partially_translated(self):
+        """Part of the query is done in SQL, the rest is evaluated in python"""
+        result = self.db.select_values(['a', 'b'], "a + 1 > 3 and b < 2.5", insert_run_number=False)
+        self.assertEqual(result.rows, [[4, 1.64], [9, 2.02]])
+
+    @unittest.skipIf(not query_numpy.is_available(), "NumPy is not installed")
+    def test_select_values_vectorized(self):
+        """NumPy evaluation gives the same result as row by row evaluation"""
+        queries = ["a + 1 > 3 and b < 2.5", "a * b > 5 or d == 'bang'", "not (a - 2 > 0 or c)", "a > 1 and not d or -b > -2",
+                   "d.startswith('h') or a / 2 in [1, None]", "b - a < 0 or d < 'i'"]
+        for query in queries:
+            vectorized = self.db.select_values(['a', 'b', 'd'], query, vectorize=True)
+            self.assertEqual(vectorized.performance["evaluation"], "numpy", query)
+            by_row = self.db.select_values(['a', 'b', 'd'], query, vectorize=False)
+            self.assertEqual(by_row.performance["evaluation"], "row", query)
+            self.assertEqual(vectorized.rows, by_row.rows, query)
+
+    @unittest.skipIf(not query_numpy.is_available(), "NumPy is not installed")
+    def test_select_values_vectorized_fallback(self):
+        """Queries that can't be vectorized are evaluated row by row"""
+        result = self.db.select_values(['a'], "a + 1 > math.sqrt(4)", vectorize=True)
+        self.assertEqual(result.performance["evaluation"], "row")
+        self.assertEqual(result.rows, [[2, 2], [3, 3], [4, 4], [9, 9]])
+
+        self.assertRaises(rcdb.QueryEvaluationError, self.db.select_values, ['a'], "a / (a - 2) > 0", vectorize=True)
+
+    def test_select_values_query_cache(self):
+        """Prepared queries are reused and invalidated when condition types or aliases change"""
+        result = self.db.select_values(['a'], "a > 2", insert_run_number=False)
+        self.assertEqual(result.performance["query_cache"], "miss")
+        result = self.db.select_values(['a'], "  a >  2 ", insert_run_number=False, sort_desc=True)
+        self.assertEqual(result.performance["query_cache"], "hit")
+        self.assertEqual(result.rows, [[9], [4], [3]])
+
+        # New condition type
+        self.db.create_condition_type("h", ConditionType.INT_FIELD, "Test condition 'h'")
+        result = self.db.select_values(['a'], "a > 2")
+        self.assertEqual(result.performance["query_cache"], "miss")
+
+        # Aliases
+        self.db.aliases = [ConditionSearchAlias("big_a", "a > 2", ""),
+                           ConditionSearchAlias("big_a_long", "a > 3", "")]
+        result = self.db.select_values(['a'], "@big_a_long", insert_run_number=False)
+        self.assertEqual(result.rows, [[4], [9]])
+        self.db.aliases = [ConditionSearchAlias("big_a", "a > 2", ""),
+                           ConditionSearchAlias("big_a_long", "a > 4", "")]
+        result = self.db.select_values(['a'], "@big_a_long", insert_run_number=False)
+        self.assertEqual(result.performance["query_cache"], "miss")
+        self.assertEqual(result.rows, [[9]])
+
+    def test_select_values_result_cache(self):
+        """Cached results are returned until runs or conditions are changed"""
+        self.assertEqual(self.db.select_values(['a'], "a > 2").performance["result_cache"], "off")
+
+        self.db.enable_result_cache()
+        result = self.db.select_values(['a'], "a > 2", insert_run_number=False)
+        self.assertEqual(result.performance["result_cache"], "miss")
+        result.rows[0][0] = 100
+        result = self.db.select_values(['a'], "a > 2", insert_run_number=False)
+        self.assertEqual(result.performance["result_cache"], "hit")
+        self.assertEqual(result.performance["result_cache_hits"], 1)
+        self.assertEqual(result.rows, [[3], [4], [9]])
+
+        # Other parameters - other result
+        result = self.db.select_values(['a'], "a > 2", insert_run_number=False, run_max=4)
+        self.assertEqual(result.performance["result_cache"], "miss")
+        self.assertEqual(result.rows, [[3], [4]])
+
+        # Conditions changed
+        self.db.add_condition(5, "a", 5)
+        result = self.db.select_values(['a'], "a > 2", insert_run_number=False)
+        self.assertEqual(result.performance["result_cache"], "miss")
+        self.assertEqual(result.rows, [[3], [4], [5], [9]])
+
+        # A deleted condition is seen by the log record added with the delete
+        self.db.session.execute(sqlalchemy.text("DELETE FROM conditions WHERE id = :id"),
+                                {"id": self.db.get_condition(3, "a").id})
+        self.db.session.commit()
+        self.db.add_log_record("conditions", "Removed a value of 'a' of run 3", 3)
+        result = self.db.select_values(['a'], "a > 2", insert_run_number=False)
+        self.assertEqual(result.performance["result_cache"], "miss")
+        self.assertEqual(result.rows, [[4], [5], [9]])
+
+    def test_iter_values(self):
+        """iter_values yields the same rows as select_values"""
+        queries = ["", "a > 2", "a + 1 > 3 and b < 2.5", "d.startswith('h') or a in [2, None]"]
+        for query in queries:
+            expected = self.db.select_values(['a', 'd'], query, sort_desc=True).rows
+            self.assertEqual(list(self.db.iter_values(['a', 'd'], query, sort_desc=True, yield_per=2)), expected)
+
+        rows = self.db.iter_values(['a'], "b > 2", runs=[2, 3, 5], insert_run_number=False)
+        self.assertEqual(list(rows), [[2], [3], [None]])
+
+        # Errors in query are raised right away
+        self.assertRaises(rcdb.QueryFormatError, self.db.iter_values, ['a'], "a >")
+
+    def test_select_values_runs_strategies(self):
+        """Lists of runs are passed to DB as bound parameters, by chunks or through a temporary table"""
+        runs = [9, 1, 4, 2, 3, 5, 4]
+        expected = [[9, 9], [4, 4], [3, 3]]
+
+        result = self.db.select_values(['a'], "a > 2", runs=runs, sort_desc=True)
+        self.assertEqual(result.performance["runs_strategy"], "bind")
+        self.assertEqual(result.rows, expected)
+
+        old_chunk_size, old_temp_table_min = rcdb.provider.RUNS_BIND_CHUNK_SIZE, rcdb.provider.RUNS_TEMP_TABLE_MIN
+        try:
+            rcdb.provider.RUNS_BIND_CHUNK_SIZE = 2
+            result = self.db.select_values(['a'], "a > 2", runs=runs, sort_desc=True)
+            self.assertEqual(result.performance["runs_strategy"], "chunked")
+            self.assertEqual(result.rows, expected)
+            self.assertEqual(list(self.db.iter_values(['a'], "a > 2", runs=runs, sort_desc=True)), expected)
+
+            rcdb.provider.RUNS_TEMP_TABLE_MIN = 3
+            result = self.db.select_values(['a'], "a > 2", runs=runs, sort_desc=True)
+            self.assertEqual(result.performance["runs_strategy"], "temp_table")
+            self.assertEqual(result.rows, expected)
+            result = self.db.select_values(['a'], "", runs=[1, 2, 3])
+            self.assertEqual(result.rows, [[1, 1], [2, 2], [3, 3]])
+
+            # Pivot over the temporary table
+            val_names = ['a', 'b', 'c', 'd', 'e']
+            expected = self.db.select_values(val_names, "a > 2", runs=runs, join_strategy="joins").rows
+            result = self.db.select_values(val_names, "a > 2", runs=runs, join_strategy="pivot")
+            self.assertEqual(result.performance["runs_strategy"], "temp_table")
+            self.assertEqual(result.rows, expected)
+        finally:
+            rcdb.provider.RUNS_BIND_CHUNK_SIZE = old_chunk_size
+            rcdb.provider.RUNS_TEMP_TABLE_MIN = old_temp_table_min
+
+    def test_temp_table_is_referenced_once(self):
+        """MySQL can't refer to a temporary table twice in one statement"""
+        _, plan, _ = self.db._get_select_values_plan(['a', 'b', 'c', 'd', 'e'], "a > 2")
+        for join_strategy in ("joins", "pivot"):
+            for sort_desc in (False, True):
+                sql = str(plan.get_statement(join_strategy, "temp_table", sort_desc))
+                # The join and its ON clause only
+                self.assertEqual(sql.count("rcdb_selected_runs"), 2, msg=sql)
+                self.assertEqual(sql.count("JOIN rcdb_selected_runs"), 1, msg=sql)
+
+    def test_select_values_pivot(self):
+        """Pivot query (one scan of conditions) gives the same result as joins"""
+        queries = ["", "a > 2", "a > 2 or d == 'bang'", "not a > 2", "d.startswith('h') or a in [2, None]",
+                   "a + 1 > 3 and b < 2.5", "c and not f", "'o' in d or g"]
+        val_names = ['a', 'b', 'c', 'd', 'e', 'f', 'g']
+        for query in queries:
+            joins = self.db.select_values(val_names, query, join_strategy="joins")
+            pivot = self.db.select_values(val_names, query, join_strategy="pivot")
+            self.assertEqual(pivot.performance["join_strategy"], "pivot")
+            self.assertEqual(pivot.rows, joins.rows, query)
+
+            pivot = self.db.select_values(val_names, query, runs=[1, 4, 5], join_strategy="pivot")
+            joins = self.db.select_values(val_names, query, runs=[1, 4, 5], join_strategy="joins")
+            self.assertEqual(pivot.rows, joins.rows, query)
+
+        # Planner: many conditions over many runs
+        self.assertEqual(self.db.select_values(val_names).performance["join_strategy"], "pivot")
+        self.assertEqual(self.db.select_values(val_names, runs=[1, 2]).performance["join_strategy"], "joins")
+        self.assertEqual(self.db.select_values(['a', 'b']).performance["join_strategy"], "joins")
+
+    @unittest.skipIf(not query_numpy.is_available(), "NumPy is not installed")
+    def test_select_values_columnar(self):
+        """Columnar result has the same rows and converts to NumPy arrays"""
+        val_names = ['a', 'b', 'c', 'd']
+        by_rows = self.db.select_values(val_names, "b > 1.5")
+        columnar = self.db.select_values(val_names, "b > 1.5", columnar=True)
+        self.assertTrue(columnar.is_columnar)
+        self.assertEqual(len(columnar), len(by_rows))
+        self.assertEqual(columnar[-1], by_rows[-1])
+        self.assertEqual(list(columnar), by_rows.rows)
+
+        arrays = columnar.to_numpy()
+        self.assertEqual(arrays['run'].tolist(), [2, 3, 4, 5, 9])
+        self.assertEqual(arrays['a'].dtype.kind, 'i')
+        self.assertEqual(arrays['a'].tolist(), [2, 3, 4, None, 9])
+        self.assertEqual(arrays['c'].dtype.kind, 'b')
+        self.assertEqual(arrays['b'].dtype.kind, 'f')
+
+        # Rows backed result converts too
+        self.assertEqual(by_rows.to_numpy()['a'].tolist(), [2, 3, 4, None, 9])
+
+        # Modification converts columnar result to rows
+        del columnar[0]
+        self.assertFalse(columnar.is_columnar)
+        self.assertEqual(columnar.rows, by_rows.rows[1:])
+
+        # Without columns the result still has a row per selected run
+        no_columns = self.db.select_values([], "b > 1.5", insert_run_number=False, columnar=True)
+        self.assertEqual(len(no_columns), len(by_rows))
+        self.assertEqual(list(no_columns), [[]] * len(by_rows))
+        self.assertEqual(no_columns[-1], [])
+
+    def test_select_values_shards(self):
+        """Sharded query gives the same result as one query"""
+        self.db.create_run_period("p1", "", 2, 3, None, None)
+        self.db.create_run_period("p2", "", 5, 20, None, None)
+        for query in ["", "a > 2 or d == 'bang'", "a + 1 > 3 and b < 2.5"]:
+            for sort_desc in [False, True]:
+                expected = self.db.select_values(['a', 'd'], query, sort_desc=sort_desc).rows
+                for shards in [3, 100, "run_periods"]:
+                    result = self.db.select_values(['a', 'd'], query, sort_desc=sort_desc, shards=shards)
+                    self.assertEqual(result.rows, expected, (query, shards))
+        self.assertEqual(self.db.select_values(['a'], shards=3).performance["shards"], 3)
+        self.assertEqual(self.db.select_values(['a'], shards="run_periods").performance["shards"], 4)
+
+    def test_select_values_shards_parallel(self):
+        """Shards are queried on separate connections if DB is not in memory"""
+        tmp_file = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+        tmp_file.close()
+        db = rcdb.RCDBProvider("sqlite:///" + tmp_file.name, check_version=False)
+        try:
+            destroy_all_create_schema(db)
+            db.create_condition_type("a", ConditionType.INT_FIELD, "")
+            for run_number in range(1, 21):
+                db.create_run(run_number)
+                db.add_condition(run_number, "a", run_number * 10)
+            expected = db.select_values(['a'], "a % 20 == 0").rows
+            self.assertEqual(db.select_values(['a'], "a % 20 == 0", shards=4).rows, expected)
+
+            old_chunk_size = rcdb.provider.GET_VALUES_CHUNK_SIZE
+            rcdb.provider.GET_VALUES_CHUNK_SIZE = 5
+            try:
+                rows = db.select_runs().get_values(['a'], max_workers=2)
+                self.assertEqual(rows, [[n * 10] for n in range(1, 21)])
+            finally:
+                rcdb.provider.GET_VALUES_CHUNK_SIZE = old_chunk_size
+        finally:
+            db.disconnect()
+            db.engine.dispose()
+            os.remove(tmp_file.name)
+
+    def test_condition_statistics(self):
+        """Statistics of condition values"""
+        statistics = self.db.get_condition_statistics("a")
+        self.assertEqual(statistics.count, 5)
+        self.assertEqual((statistics.min_value, statistics.max_value), (1, 9))
+        self.assertEqual(statistics.distinct_count, 5)
+        self.assertEqual(statistics.run_count, 6)
+
+    def test_select_values_plan(self):
+        """Planned query selects the same rows. The plan is reported in performance"""
+        queries = ["a > 1 and b > 2.0 and d == 'mew'", "a * b > 1 and d", "not (a > 1) and b", "a in [1, None]",
+                   "d != None and a", "a == 1 or not (b > 2 and d)", "not d", "c == False and b < 2.4"]
+        expected = {(query, join_strategy): self.db.select_values(['a', 'b', 'd'], query, join_strategy=join_strategy)
+                    for query in queries for join_strategy in ("joins", "pivot")}
+
+        result = self.db.select_values(['a', 'b', 'd'], "a * b > 1 and d")
+        self.assertEqual(result.performance["plan"]["joins"],
+                         [("a_table", "inner"), ("b_table", "inner"), ("d_table", "inner")])
+        self.assertFalse(result.performance["plan"]["statistics"])
+
+        self.db.enable_statistics()
+        for (query, join_strategy), expected_result in expected.items():
+            result = self.db.select_values(['a', 'b', 'd'], query, join_strategy=join_strategy)
+            self.assertEqual(result.rows, expected_result.rows, query)
+            self.assertTrue(result.performance["plan"]["statistics"])
+
+        # 'mew' is the most selective: 1 of 4 distinct values of 'd'
+        result = self.db.select_values(['a', 'b', 'd'], "a > 1 and b > 2.0 and d == 'mew'")
+        self.assertEqual(result.performance["plan"]["joins"][0], ("d_table", "inner"))
+        self.assertEqual(result.rows, [[9, 9, 2.02, 'mew']])
+        result = self.db.select_values(['a'], "not a", join_strategy="pivot")
+        self.assertEqual(result.performance["plan"]["joins"], [("pivot_table", "left")])
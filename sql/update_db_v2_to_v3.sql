@@ -0,0 +1,41 @@
+-- RCDB schema v2 --> v3
+--
+-- Removes duplicated condition values (of values of the same condition for the same run the first
+-- added one, with the smallest id, is kept), adds unique (run_number, condition_type_id) key on conditions
+-- and indexes for hot queries.
+--
+-- 'rcdb db update' does the same and skips indexes which already exist
+-- (e.g. created by 'rcdb db index' or 'rcdb db unique-conditions'). This script doesn't check that.
+
+SET @OLD_UNIQUE_CHECKS=@@UNIQUE_CHECKS, UNIQUE_CHECKS=0;
+SET @OLD_FOREIGN_KEY_CHECKS=@@FOREIGN_KEY_CHECKS, FOREIGN_KEY_CHECKS=0;
+
+DELETE c FROM `rcdb`.`conditions` c
+  JOIN (SELECT run_number, condition_type_id, MIN(id) AS keep_id
+        FROM `rcdb`.`conditions`
+        GROUP BY run_number, condition_type_id
+        HAVING COUNT(*) > 1) d
+    ON c.run_number = d.run_number AND c.condition_type_id = d.condition_type_id AND c.id <> d.keep_id;
+
+ALTER TABLE `rcdb`.`conditions`
+  ADD UNIQUE INDEX `uq_conditions_run_type` (`run_number` ASC, `condition_type_id` ASC),
+  ADD INDEX `ix_conditions_type_run_int` (`condition_type_id` ASC, `run_number` ASC, `int_value` ASC),
+  ADD INDEX `ix_conditions_type_run_float` (`condition_type_id` ASC, `run_number` ASC, `float_value` ASC),
+  ADD INDEX `ix_conditions_created` (`created` ASC);
+
+ALTER TABLE `rcdb`.`files`
+  ADD INDEX `ix_files_sha256_path` (`sha256` ASC, `path`(255) ASC);
+
+ALTER TABLE `rcdb`.`logs`
+  ADD INDEX `ix_logs_related_run_id` (`related_run` ASC, `id` ASC);
+
+-- Deletes don't change the select_values result cache watermark, a log record does
+INSERT INTO `rcdb`.`logs` (`table_ids`, `created`, `description`)
+  VALUES ('conditions', NOW(), 'Schema v2 --> v3. Removed duplicated condition values, added unique key');
+
+DELETE FROM `rcdb`.`schema_versions`;
+INSERT INTO `rcdb`.`schema_versions` (`version`, `created`, `comment`)
+  VALUES (3, NOW(), 'Schema V3 for RCDB>v0.9 (2023)');
+
+SET FOREIGN_KEY_CHECKS=@OLD_FOREIGN_KEY_CHECKS;
+SET UNIQUE_CHECKS=@OLD_UNIQUE_CHECKS;